@@ -0,0 +1,236 @@
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http import HTTPStatus
+from typing import Callable, Dict, Iterable, Optional, Tuple
+import asyncio
+import logging
+import os
+import symbolcodec
+import symbolserver
+
+MAX_HEADER_SIZE = 64 * 1024
+
+class BadRequest(Exception):
+    pass
+
+class HTTPRequest:
+    def __init__(self, method: str, target: str, version: str, headers: Dict[str, str]):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+
+    def keep_alive(self) -> bool:
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+def parse_request(head: bytes) -> Optional[HTTPRequest]:
+    """ Parses the request line and headers of a single request, None if malformed. """
+
+    lines = head.decode("latin-1").split("\r\n")
+    words = lines[0].split()
+    if len(words) != 3 or not words[2].startswith("HTTP/"):
+        return None
+
+    headers = {}
+    for line in lines[1:]:
+        if len(line) == 0:
+            continue
+        name, sep, value = line.partition(":")
+        if not sep:
+            return None
+        headers[name.strip().lower()] = value.strip()
+
+    return HTTPRequest(words[0], words[1], words[2], headers)
+
+def response_head(status: int, headers: Iterable[Tuple[str, str]], keep_alive: bool) -> bytes:
+    lines = ["HTTP/1.1 %d %s" % (status, HTTPStatus(status).phrase),
+             "Date: " + formatdate(usegmt=True),
+             "Connection: " + ("keep-alive" if keep_alive else "close")]
+    for name, value in headers:
+        lines.append(name + ": " + value)
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+class AsyncSymbolServer:
+    """
+    Single threaded asyncio symbol server. Connections are plain coroutines, so idle keep-alive
+    connections cost no threads. Database lookups and opening the files are bounded by max_disk_reads,
+    the slot is released before the file is sent, so slow clients don't hold up other lookups.
+    """
+    def __init__(self, host: str, port: int, max_disk_reads: int = 64, keep_alive_timeout: float = 60.0,
+                 resolve: Callable[[str], symbolserver.Resolution] = symbolserver.resolve):
+        self.host = host
+        self.resolve = resolve
+        self.port = port
+        self.max_disk_reads = max_disk_reads
+        self.keep_alive_timeout = keep_alive_timeout
+        self.server = None
+        self._disk_reads = None
+        self._lookup_executor = ThreadPoolExecutor(max_disk_reads, thread_name_prefix="lookup")
+
+    async def start(self):
+        self._disk_reads = asyncio.Semaphore(self.max_disk_reads)
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port, limit=MAX_HEADER_SIZE)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logging.info(f"Serving symbols at {self.host}:{self.port}")
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        self._lookup_executor.shutdown(wait=False)
+
+    async def read_request(self, reader: asyncio.StreamReader) -> Optional[HTTPRequest]:
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.keep_alive_timeout)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            return None
+
+        request = parse_request(head[:-4])
+        if request is None:
+            return None
+
+        # Symbol requests have no body, but a pipelined stream must skip any that is sent
+        length = request.headers.get("content-length", "0") or "0"
+        if not (length.isascii() and length.isdigit()):
+            raise BadRequest(f"invalid Content-Length: {length}")
+        length = int(length)
+        if length > 0:
+            await reader.readexactly(length)
+        return request
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except BadRequest as e:
+                    logging.debug(e)
+                    writer.write(response_head(400, [("Content-Length", "0")], False))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+
+                keep_alive = request.keep_alive()
+                if request.method not in ("GET", "HEAD"):
+                    writer.write(response_head(501, [("Content-Length", "0")], keep_alive))
+                else:
+                    await self.send_resolution(request, writer, keep_alive)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            writer.close()
+
+    async def send_resolution(self, request: HTTPRequest, writer: asyncio.StreamWriter, keep_alive: bool):
+        loop = asyncio.get_running_loop()
+        send_body = request.method == "GET"
+
+        # The slot covers the lookup and opening the file, not sending it
+        async with self._disk_reads:
+            resolution = await loop.run_in_executor(self._lookup_executor, self.resolve, request.target)
+            resolution = symbolserver.negotiate_encoding(resolution, request.headers.get("accept-encoding"), request.headers.get("range"))
+            logging.debug(f"{request.method} {request.target} {resolution.status}")
+
+            opened = None
+            if resolution.file_path:
+                opened = await loop.run_in_executor(self._lookup_executor, self.open_file, resolution.file_path)
+                if opened is None:
+                    resolution = symbolserver.NOT_FOUND
+
+        if opened is None:
+            headers = [("Content-Length", str(len(resolution.body)))]
+            if resolution.location:
+                headers.append(("Location", resolution.location))
+            writer.write(response_head(resolution.status, headers, keep_alive))
+            if send_body and resolution.body:
+                writer.write(resolution.body)
+            return
+
+        f, size, mtime = opened
+        with f:
+            if resolution.decode:
+                # Ranges are decompressed up to their end before the response starts
+                response = await loop.run_in_executor(self._lookup_executor, symbolserver.decoded_response, resolution.codec, f,
+                                                      request.headers.get("range"), request.headers.get("if-range"))
+                writer.write(response_head(response.status, response.headers, keep_alive))
+                if not send_body:
+                    return
+                if response.body is not None:
+                    writer.write(response.body)
+                else:
+                    await self.send_decoded(f, resolution.codec, writer)
+                return
+
+            response = symbolserver.file_response(size, mtime, request.headers.get("range"), request.headers.get("if-range"))
+            headers = response.headers + symbolserver.encoding_headers(resolution.codec)
+            writer.write(response_head(response.status, headers, keep_alive))
+            if not send_body:
+                return
+
+            for part in response.parts:
+                if part.head:
+                    writer.write(part.head)
+                if part.count > 0:
+                    await writer.drain()
+                    # Uses os.sendfile where the transport supports it
+                    await loop.sendfile(writer.transport, f, part.offset, part.count)
+            if response.tail:
+                writer.write(response.tail)
+
+    async def send_decoded(self, f, codec: symbolcodec.Codec, writer: asyncio.StreamWriter):
+        """ Sends the file decompressed as a chunked body, decompression runs on the lookup threads. """
+
+        loop = asyncio.get_running_loop()
+        with codec.open_decompressed(f) as decompressed:
+            while True:
+                data = await loop.run_in_executor(self._lookup_executor, decompressed.read, symbolcodec.CHUNK_SIZE)
+                writer.write(symbolserver.chunk(data))
+                await writer.drain()
+                if not data:
+                    break
+
+    @staticmethod
+    def open_file(path: str) -> Optional[Tuple[object, int, float]]:
+        try:
+            f = open(path, "rb")
+        except OSError:
+            logging.warning(f"Failed to open {path}")
+            return None
+        fs = os.fstat(f.fileno())
+        return f, fs.st_size, fs.st_mtime
+
+def install_uvloop() -> bool:
+    """ Switches asyncio to uvloop if it is installed. """
+
+    try:
+        import uvloop
+    except ImportError:
+        logging.warning("uvloop is not installed, using the default asyncio event loop")
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+def run(host: str = "0.0.0.0", port: int = 8000, max_disk_reads: int = 64, keep_alive_timeout: float = 60.0, use_uvloop: bool = False,
+        resolve: Callable[[str], symbolserver.Resolution] = symbolserver.resolve):
+    if use_uvloop:
+        install_uvloop()
+
+    server = AsyncSymbolServer(host, port, max_disk_reads, keep_alive_timeout, resolve)
+    try:
+        asyncio.run(server.serve_forever())
+    finally:
+        server.close()
@@ -2,9 +2,50 @@
 
 from __future__ import absolute_import
 
+from contextlib import contextmanager
+from io import UnsupportedOperation
 import errno
 import errs
+import hashlib
 import os
+import secrets
+import select
+import ssl
+import stat
+import struct
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, stores are never cloned there
+    fcntl = None
+
+SEND_BUFFER_SIZE = 1024 * 1024
+
+# Chunk size of write_opened_file
+COPY_BUFFER_SIZE = 256 * 1024
+
+# ioctl cloning a whole file, sharing its extents on XFS and btrfs,
+# _IOW(0x94, 9, int) on Linux
+FICLONE = 0x40049409
+
+# ioctl mapping the extents of a file, _IOWR('f', 11, struct fiemap)
+FS_IOC_FIEMAP = 0xC020660B
+# struct fiemap without its extents: start, length, flags, mapped extents,
+# extent count, reserved
+FIEMAP = struct.Struct("=QQIIII")
+# struct fiemap_extent: logical, physical, length, 2 reserved, flags,
+# 3 reserved
+FIEMAP_EXTENT = struct.Struct("=QQQQQIIII")
+FIEMAP_FLAG_SYNC = 0x1
+FIEMAP_EXTENT_SHARED = 0x2000
+
+# errors of cloning or kernel copies between files that can not be done
+# on the given files or filesystems, the data is copied by other means
+KERNEL_COPY_UNSUPPORTED = (errno.EBADF, errno.EINVAL, errno.ENOSYS,
+                           errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+                           errno.ETXTBSY)
 
 
 def read_all(fname, mode=None):
@@ -36,27 +77,235 @@ def open_rb(filepath):
         # unexpected error
         raise e
 
+def _wait_writable(sock):
+    select.select([], [sock], [], sock.gettimeout())
+
+
+def _sendfile(sock, file, offset, count):
+    """
+    send using os.sendfile, the data is copied by the kernel
+
+    :return: number of bytes sent before sendfile turned out to be unsupported
+    """
+    sent = 0
+    while sent < count:
+        try:
+            n = os.sendfile(sock.fileno(), file.fileno(),
+                            offset + sent, count - sent)
+        except BlockingIOError:
+            # socket with a timeout is non-blocking under the hood
+            _wait_writable(sock)
+            continue
+        except OSError as e:
+            if e.errno in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK,
+                           errno.EOPNOTSUPP) and sent == 0:
+                return sent
+            raise e
+        if n == 0:
+            raise EOFError("%s is shorter than expected" % file.name)
+        sent += n
+    return sent
+
+
+def send_file(sock, file, offset, count):
+    """
+    send a part of an opened file to a socket
+
+    Uses os.sendfile so the data never passes through python buffers and falls
+    back to a readinto loop over one large buffer where sendfile can not be
+    used, e.g. on TLS sockets.
+
+    :param sock: connected socket
+    :param file: file opened in binary mode
+    :param offset: offset of the first byte to send
+    :param count: number of bytes to send
+    """
+    if hasattr(os, "sendfile") and not isinstance(sock, ssl.SSLSocket):
+        try:
+            sent = _sendfile(sock, file, offset, count)
+        except (AttributeError, UnsupportedOperation):
+            # no usable file descriptor, e.g. an in-memory file
+            sent = 0
+        offset += sent
+        count -= sent
+
+    if count <= 0:
+        return
+
+    buf = memoryview(bytearray(min(SEND_BUFFER_SIZE, count)))
+    file.seek(offset)
+    while count > 0:
+        n = file.readinto(buf[:min(len(buf), count)])
+        if not n:
+            raise EOFError("%s is shorter than expected" % file.name)
+        sock.sendall(buf[:n])
+        count -= n
+
+
 def copy_buffered_io_to_file(io, file):
     """ Copy the given BufferedIOBase to the given opened file """
 
     
 
-def write_opened_file(file, path: str):
-    #file.seek(0, os.SEEK_END)
-    #fsize = file.tell()
-    file.seek(0, os.SEEK_SET)
+def _regular_fileno(file):
+    """
+    file descriptor of an opened regular file
+
+    :return: None for streams without a descriptor, sockets, pipes etc.
+             and for spooled temporary files still in memory, asking
+             those for a descriptor writes them to disk first
+    """
+    if isinstance(file, tempfile.SpooledTemporaryFile) and \
+            not file._rolled:
+        return None
+    try:
+        fd = file.fileno()
+    except (AttributeError, UnsupportedOperation, OSError):
+        return None
+    return fd if stat.S_ISREG(os.fstat(fd).st_mode) else None
+
+
+def _clone(src_fd, dst_fd):
+    """
+    make dst_fd a reflink clone of src_fd, no data is copied
+
+    :return: False where the filesystem or platform does not support clones
+    """
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except OSError as e:
+        if e.errno in KERNEL_COPY_UNSUPPORTED:
+            return False
+        raise e
+    return True
+
 
+def _first_extent(fd):
+    """
+    (physical offset, flags) of the first extent of fd
+
+    :return: None where the platform or filesystem does not map extents
+    """
+    if fcntl is None:
+        return None
+    buf = bytearray(FIEMAP.size + FIEMAP_EXTENT.size)
+    FIEMAP.pack_into(buf, 0, 0, 0xFFFFFFFFFFFFFFFF, FIEMAP_FLAG_SYNC, 0, 1, 0)
     try:
-        with open(path, "wb") as f_new:
-            f_new.seek(0, os.SEEK_SET)
-            bufsize: int = 256 * 1024
-            while True:
-                buf = file.read(bufsize)
-                if not buf:
-                    break
-                f_new.write(buf)
-            f_new.truncate
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buf)
+    except OSError:
+        return None
+    if FIEMAP.unpack_from(buf, 0)[3] == 0:
+        return None
+    extent = FIEMAP_EXTENT.unpack_from(buf, FIEMAP.size)
+    return extent[1], extent[5]
+
+
+def shares_data(path_a, path_b):
+    """
+    whether two files are the same file, or reflink clones sharing their
+    data where the filesystem tells
+    """
+    stat_a = os.stat(path_a)
+    stat_b = os.stat(path_b)
+    if (stat_a.st_dev, stat_a.st_ino) == (stat_b.st_dev, stat_b.st_ino):
+        return True
+    if stat_a.st_dev != stat_b.st_dev:
+        return False
+    with open(path_a, "rb") as file_a, open(path_b, "rb") as file_b:
+        extent_a = _first_extent(file_a.fileno())
+        extent_b = _first_extent(file_b.fileno())
+    return extent_a is not None and extent_a == extent_b and \
+        extent_a[1] & FIEMAP_EXTENT_SHARED != 0
+
+
+def _kernel_copy(src_fd, dst_fd, count):
+    """
+    copy the first count bytes of src_fd to the start of dst_fd, by a reflink
+    clone or in the kernel with copy_file_range or sendfile
+
+    :return: number of bytes copied, 0 if the kernel can not copy between
+             the files and less than count if the source is shorter
+    """
+    if _clone(src_fd, dst_fd):
+        return count
+
+    copy_file_range = getattr(os, "copy_file_range", None)
+    sendfile = getattr(os, "sendfile", None)
+    copied = 0
+    while copied < count:
+        try:
+            if copy_file_range is not None:
+                n = copy_file_range(src_fd, dst_fd, count - copied,
+                                    copied, copied)
+            elif sendfile is not None:
+                os.lseek(dst_fd, copied, os.SEEK_SET)
+                n = sendfile(dst_fd, src_fd, copied, count - copied)
+            else:
+                break
+        except OSError as e:
+            if e.errno not in KERNEL_COPY_UNSUPPORTED or copied > 0:
+                raise e
+            # fall back to the next way of copying
+            if copy_file_range is not None:
+                copy_file_range = None
+            else:
+                sendfile = None
+            continue
+        if n == 0:
+            break
+        copied += n
+    return copied
+
+
+def _temp_path(path):
+    """
+    unique name of a temporary file next to path, hidden on POSIX
+    """
+    directory, name = os.path.split(path)
+    return os.path.join(directory,
+                        ".%s.%s.tmp" % (name, secrets.token_hex(8)))
+
+
+def _sync_directory(directory):
+    """
+    persist a rename in directory, a no-op where directories can not be
+    opened, e.g. on Windows
+    """
+    try:
+        fd = os.open(directory or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def atomic_open(path):
+    """
+    open a temporary file in the directory of path for writing, it is
+    synced and renamed over path when the block completes and removed if
+    the block fails, so readers see either no file or the complete one
+
+    :param path: destination path, its directory must exist
+    """
+    temp_path = _temp_path(path)
+    try:
+        fd = os.open(temp_path,
+                     os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                     getattr(os, "O_BINARY", 0), 0o666)
+        with os.fdopen(fd, "wb") as f_new:
+            yield f_new
+            f_new.flush()
+            os.fsync(fd)
+        os.replace(temp_path, path)
     except IOError as e:
+        _remove_temp(temp_path)
         # to be backward compatible with python 2,
         # catch IOError exception and check the errnor,
         # to detect when specified file does not exits
@@ -64,3 +313,131 @@ def write_opened_file(file, path: str):
             raise errs.FileNotFound(e.filename)
         # unexpected error
         raise e
+    except BaseException:
+        _remove_temp(temp_path)
+        raise
+
+    _sync_directory(os.path.dirname(path))
+
+
+@contextmanager
+def atomic_path(path):
+    """
+    temporary path next to path for tools that write a file by its name,
+    it is renamed over path when the block completes and removed if the
+    block fails
+
+    :param path: destination path, its directory must exist
+    """
+    temp_path = _temp_path(path)
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    except BaseException:
+        _remove_temp(temp_path)
+        raise
+
+    _sync_directory(os.path.dirname(path))
+
+
+def write_opened_file(file, path: str, checksum=None):
+    """
+    atomically write the whole contents of an opened file to path
+
+    The data is written through atomic_open, a crash never leaves
+    a truncated file at path. Regular files are copied without passing
+    the data through python: as a reflink clone on filesystems sharing
+    extents (XFS, btrfs), otherwise with copy_file_range or sendfile.
+
+    :param file: file opened in binary mode
+    :param path: destination path, its directory must exist
+    :param checksum: name of a hashlib algorithm, the digest is computed
+                     while the data is copied, which needs the data in
+                     python, so kernel copies are not used then
+    :return: hex digest of the contents if checksum was given, else None
+    """
+    digest = hashlib.new(checksum) if checksum is not None else None
+
+    with atomic_open(path) as f_new:
+        copied = 0
+        src_fd = _regular_fileno(file) if digest is None else None
+        if src_fd is not None:
+            copied = _kernel_copy(src_fd, f_new.fileno(),
+                                  os.fstat(src_fd).st_size)
+
+        file.seek(copied, os.SEEK_SET)
+        f_new.seek(copied, os.SEEK_SET)
+        while True:
+            buf = file.read(COPY_BUFFER_SIZE)
+            if not buf:
+                break
+            if digest is not None:
+                digest.update(buf)
+            f_new.write(buf)
+
+    return digest.hexdigest() if digest is not None else None
+
+
+def _remove_temp(temp_path):
+    try:
+        os.remove(temp_path)
+    except OSError:
+        pass
+
+
+def file_digest(path, checksum="sha1"):
+    """
+    hex digest of a file's contents
+
+    :param checksum: name of a hashlib algorithm
+    """
+    digest = hashlib.new(checksum)
+    buf = memoryview(bytearray(COPY_BUFFER_SIZE))
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            digest.update(buf[:n])
+    return digest.hexdigest()
+
+
+def link_file(existing, path):
+    """
+    atomically replace path by a file sharing the data of existing, without
+    copying it: a reflink clone where the filesystem supports it, so both
+    stay independent files, otherwise a hard link
+
+    Store files are only ever replaced as a whole, by atomic_open,
+    atomic_path or write_opened_file, never modified in place, so hard
+    linked copies can not diverge.
+
+    :return: "reflink" or "hardlink", None if neither is possible, e.g.
+             across filesystems, path is left untouched then
+    """
+    temp_path = _temp_path(path)
+    try:
+        with open(existing, "rb") as src:
+            fd = os.open(temp_path,
+                         os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                         getattr(os, "O_BINARY", 0), 0o666)
+            try:
+                cloned = _clone(src.fileno(), fd)
+            finally:
+                os.close(fd)
+        if not cloned:
+            os.remove(temp_path)
+            try:
+                os.link(existing, temp_path)
+            except OSError as e:
+                if e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK,
+                               errno.EOPNOTSUPP):
+                    return None
+                raise e
+        os.replace(temp_path, path)
+    except BaseException:
+        _remove_temp(temp_path)
+        raise
+
+    _sync_directory(os.path.dirname(path))
+    return "reflink" if cloned else "hardlink"
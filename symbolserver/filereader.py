@@ -0,0 +1,577 @@
+import io
+import mmap
+import requests
+import tempfile
+
+# Granularity of fetched and cached data of RemoteReader
+BLOCK_SIZE = 4 * 1024
+
+# Ranges of a single prefetch closer than this are fetched as one range
+MERGE_GAP = 64 * 1024
+
+# Ranges per multi-range request, the symbol server accepts up to 64
+MAX_RANGES = 32
+
+# Response body read per iteration
+CHUNK_SIZE = 64 * 1024
+
+# Data of a SpoolReader kept in memory, beyond it is spooled to a temporary
+# file
+SPOOL_MEMORY = 8 * 1024 * 1024
+
+
+class FileReader:
+    """
+    Random access reader over a seekable file object, every read is a
+    seek followed by a read. Used for streams that can't be memory-mapped,
+    e.g. httpio remote files.
+    """
+    def __init__(self, f):
+        self.f = f
+
+    def read_at(self, offset, size):
+        """
+        read up to size bytes at offset
+
+        :param offset: offset of the first byte
+        :param size: number of bytes to read
+        """
+        self.f.seek(offset)
+        return self.f.read(size)
+
+    def prefetch(self, ranges):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MappedReader:
+    """
+    Random access reader over a memory-mapped local file. Reads return
+    memoryview slices of the mapping, so parsing headers costs neither a
+    copy nor a syscall per field. The mapping stays alive until the last
+    returned slice is released.
+    """
+    def __init__(self, f):
+        self.f = f
+        self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mm)
+        self.size = len(self._mm)
+
+    def read_at(self, offset, size):
+        """
+        read up to size bytes at offset
+
+        :param offset: offset of the first byte
+        :param size: number of bytes to read
+        """
+        if offset < 0:
+            raise ValueError("negative offset")
+        return self._view[offset:offset + size]
+
+    def prefetch(self, ranges):
+        pass
+
+    def close(self):
+        self._view.release()
+        try:
+            self._mm.close()
+        except BufferError:
+            # slices handed out are still in use, the mapping is
+            # unmapped when they are garbage collected
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _parse_content_range(value):
+    """
+    parse a Content-Range header value
+
+    :return: (start, end, total) with None for an unknown part,
+             None if the value can't be parsed
+    """
+    if value is None:
+        return None
+    unit, _, spec = value.strip().partition(" ")
+    span, _, total = spec.partition("/")
+    if unit != "bytes" or not total:
+        return None
+    try:
+        total = int(total) if total != "*" else None
+        if span == "*":
+            return None, None, total
+        start, _, end = span.partition("-")
+        return int(start), int(end), total
+    except ValueError:
+        return None
+
+
+def _multipart_parts(body, content_type):
+    """
+    split a multipart/byteranges body into its parts
+
+    :return: iterable of (start, data, total)
+    """
+    _, _, boundary = content_type.partition("boundary=")
+    delimiter = b"--" + boundary.strip().strip('"').encode("latin-1")
+
+    pos = body.find(delimiter)
+    while pos >= 0 and not body.startswith(b"--", pos + len(delimiter)):
+        headers_end = body.find(b"\r\n\r\n", pos)
+        if headers_end < 0:
+            return
+        content_range = None
+        for line in body[pos + len(delimiter):headers_end].split(b"\r\n"):
+            name, _, value = line.partition(b":")
+            if name.strip().lower() == b"content-range":
+                content_range = value.decode("latin-1")
+
+        parsed = _parse_content_range(content_range)
+        if parsed is None or parsed[0] is None:
+            return
+        start, end, total = parsed
+        data_start = headers_end + 4
+        data_end = data_start + end - start + 1
+        yield start, body[data_start:data_end], total
+        pos = body.find(delimiter, data_end)
+
+
+class BlockReader:
+    """
+    Base of readers that fetch data in blocks of block_size and cache them
+    for later reads. Parsers announce the ranges they are about to read
+    with prefetch(), the missing blocks are grouped into [first, last]
+    spans, merging spans closer than merge_gap, and handed to _fetch()
+    in ascending order.
+
+    With max_blocks the cache keeps only that many of the most recently
+    fetched blocks, evicted blocks are fetched again when read.
+    """
+    def __init__(self, block_size=BLOCK_SIZE, merge_gap=MERGE_GAP,
+                 max_blocks=None):
+        self.block_size = block_size
+        self.merge_gap = merge_gap
+        self.max_blocks = max_blocks
+        # None until known
+        self.size = None
+        self._blocks = {}
+
+    def read_at(self, offset, size):
+        """
+        read up to size bytes at offset
+
+        :param offset: offset of the first byte
+        :param size: number of bytes to read
+        """
+        if offset < 0:
+            raise ValueError("negative offset")
+        if self.size is not None:
+            size = min(size, self.size - offset)
+        if size <= 0:
+            return b""
+
+        self.prefetch([(offset, size)])
+
+        first = offset // self.block_size
+        last = (offset + size - 1) // self.block_size
+        chunks = []
+        for idx in range(first, last + 1):
+            block = self._blocks.get(idx)
+            if block is None:
+                # evicted since the prefetch, or beyond the end of the file
+                self._fetch([[idx, idx]])
+                block = self._blocks.get(idx)
+            if block is None:
+                break
+            chunks.append(block)
+            if len(block) < self.block_size:
+                break
+
+        start = offset - first * self.block_size
+        return b"".join(chunks)[start:start + size]
+
+    def prefetch(self, ranges):
+        """
+        fetch the blocks of all given ranges that are not cached yet
+
+        :param ranges: iterable of (offset, size)
+        """
+        missing = set()
+        for offset, size in ranges:
+            end = offset + size
+            if self.size is not None:
+                end = min(end, self.size)
+            if end <= offset:
+                continue
+            missing.update(
+                idx for idx in range(offset // self.block_size,
+                                     (end - 1) // self.block_size + 1)
+                if idx not in self._blocks)
+        if len(missing) == 0:
+            return
+
+        # [first, last] block spans, gaps up to merge_gap are fetched along
+        gap_blocks = self.merge_gap // self.block_size
+        spans = []
+        for idx in sorted(missing):
+            if len(spans) > 0 and idx - spans[-1][1] - 1 <= gap_blocks:
+                spans[-1][1] = idx
+            else:
+                spans.append([idx, idx])
+
+        self._fetch(spans)
+
+    def _fetch(self, spans):
+        raise NotImplementedError()
+
+    def clear_cache(self):
+        """
+        drop all cached blocks, e.g. to release the memory of an idle reader
+        """
+        self._blocks = {}
+
+    def _cached(self, first, last):
+        if self.size is not None:
+            last = min(last, (self.size - 1) // self.block_size)
+        return all(idx in self._blocks for idx in range(first, last + 1))
+
+    def _store(self, start, data, total):
+        """
+        cache the whole blocks of data fetched from start, and the last
+        block of the file
+        """
+        if total is not None:
+            self.size = total
+
+        block_size = self.block_size
+        idx = -(-start // block_size)
+        offset = idx * block_size - start
+        while offset < len(data):
+            block = data[offset:offset + block_size]
+            if len(block) < block_size and \
+                    (self.size is None or
+                     idx * block_size + len(block) != self.size):
+                break
+            self._blocks.pop(idx, None)
+            self._blocks[idx] = block
+            idx += 1
+            offset += block_size
+
+        if self.max_blocks is not None:
+            while len(self._blocks) > self.max_blocks:
+                del self._blocks[next(iter(self._blocks))]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SpoolReader:
+    """
+    Random access reader over a stream that can only be read forward
+    cheaply, e.g. a compressed zip member that is decompressed again from
+    the start on every seek back. The stream is read once, in order, into a
+    spool: in memory up to spool_memory bytes, in a temporary file beyond.
+    Reads behind the furthest read are served from the spool, and
+    spooled_file() completes it to copy the whole file without reading the
+    stream again.
+    """
+    def __init__(self, f, size=None, spool_memory=SPOOL_MEMORY):
+        self.f = f
+        self.size = size
+        self._spool = tempfile.SpooledTemporaryFile(max_size=spool_memory)
+        # bytes of the stream in the spool
+        self._spooled = 0
+
+    def _spool_to(self, end):
+        """
+        read the stream into the spool up to end, or up to its end
+        """
+        self._spool.seek(self._spooled)
+        while end is None or self._spooled < end:
+            count = CHUNK_SIZE if end is None else \
+                min(CHUNK_SIZE, end - self._spooled)
+            data = self.f.read(count)
+            if not data:
+                self.size = self._spooled
+                break
+            self._spool.write(data)
+            self._spooled += len(data)
+
+    def read_at(self, offset, size):
+        """
+        read up to size bytes at offset
+
+        :param offset: offset of the first byte
+        :param size: number of bytes to read
+        """
+        if offset < 0:
+            raise ValueError("negative offset")
+        if self.size is not None:
+            size = min(size, self.size - offset)
+        if size <= 0:
+            return b""
+
+        if self._spooled < offset + size:
+            self._spool_to(offset + size)
+        self._spool.seek(offset)
+        return self._spool.read(max(min(size, self._spooled - offset), 0))
+
+    def prefetch(self, ranges):
+        pass
+
+    def spooled_file(self):
+        """
+        the whole stream as a file object positioned at its start, valid
+        until the reader is closed
+        """
+        self._spool_to(None)
+        self._spool.seek(0)
+        return self._spool
+
+    def close(self):
+        self._spool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class WindowReader:
+    """
+    Reader of size bytes at offset of another reader, e.g. a member
+    stored uncompressed in a zip archive
+    """
+    def __init__(self, reader, offset, size):
+        self.reader = reader
+        self.offset = offset
+        self.size = size
+
+    def read_at(self, offset, size):
+        """
+        read up to size bytes at offset of the window
+
+        :param offset: offset of the first byte in the window
+        :param size: number of bytes to read
+        """
+        if offset < 0:
+            raise ValueError("negative offset")
+        size = min(size, self.size - offset)
+        if size <= 0:
+            return b""
+        return self.reader.read_at(self.offset + offset, size)
+
+    def prefetch(self, ranges):
+        self.reader.prefetch([(self.offset + offset,
+                               min(size, self.size - offset))
+                              for offset, size in ranges])
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RemoteReader(BlockReader):
+    """
+    Block reader over an HTTP resource, fetched with Range requests. The
+    spans of a prefetch() are fetched with a single multi-range request.
+    Servers that answer a multi-range request with anything but a
+    multipart response get one request per span from then on. Hashing a
+    PDB takes 4 requests whatever its size: the header, the root index
+    pages, the root stream and the first pages of the PDB and DBI streams.
+    A PE file takes one.
+
+    :param session: requests session to reuse, a new one is opened and
+        closed with the reader if None
+    :param kwargs: additional arguments to pass to the session's get(),
+        e.g. auth, cert or verify
+    """
+    def __init__(self, url, session=None, block_size=BLOCK_SIZE,
+                 merge_gap=MERGE_GAP, max_ranges=MAX_RANGES, max_blocks=None,
+                 **kwargs):
+        BlockReader.__init__(self, block_size, merge_gap, max_blocks)
+        self.url = url
+        self.max_ranges = max_ranges
+        self.multi_range = True
+        # number of HTTP requests made
+        self.requests = 0
+        self._owns_session = session is None
+        self._session = session if session is not None else requests.Session()
+        self._kwargs = kwargs
+
+    def _fetch(self, spans):
+        if len(spans) > 1 and self.multi_range:
+            for group in range(0, len(spans), self.max_ranges):
+                self._request(spans[group:group + self.max_ranges])
+
+        for first, last in spans:
+            if not self._cached(first, last):
+                self._request([(first, last)])
+
+    def _request(self, spans):
+        block_size = self.block_size
+        self.requests += 1
+        range_header = "bytes=" + ",".join(
+            "%d-%d" % (first * block_size, (last + 1) * block_size - 1)
+            for first, last in spans)
+
+        # ranges are of the file as it is, never of a compressed encoding
+        # of it, e.g. requests asks for gzip by default
+        kwargs = dict(self._kwargs)
+        kwargs["headers"] = dict(kwargs.get("headers") or {})
+        kwargs["headers"].update({"Range": range_header,
+                                  "Accept-Encoding": "identity"})
+        with self._session.get(self.url, stream=True,
+                               **kwargs) as response:
+            if response.status_code == 416:
+                # the ranges start beyond the end of the file
+                parsed = _parse_content_range(
+                    response.headers.get("Content-Range"))
+                if parsed is not None and parsed[2] is not None:
+                    self.size = parsed[2]
+                return
+            response.raise_for_status()
+
+            content_type = response.headers.get("Content-Type", "")
+            if response.status_code == 206 and \
+                    content_type.startswith("multipart/byteranges"):
+                for start, data, total in _multipart_parts(
+                        response.content, content_type):
+                    self._store(start, data, total)
+            elif response.status_code == 206:
+                parsed = _parse_content_range(
+                    response.headers.get("Content-Range"))
+                if parsed is None or parsed[0] is None:
+                    return
+                self._store(parsed[0], response.content, parsed[2])
+            elif len(spans) == 1:
+                # Range is not supported, read the file up to the span
+                length = response.headers.get("Content-Length")
+                total = int(length) if length is not None and \
+                    "Content-Encoding" not in response.headers else None
+                self._store(0, self._read_body(
+                    response, (spans[0][1] + 1) * block_size), total)
+                return
+
+        if len(spans) > 1 and not all(self._cached(first, last)
+                                      for first, last in spans):
+            self.multi_range = False
+
+    def _read_body(self, response, limit):
+        data = bytearray()
+        for chunk in response.iter_content(CHUNK_SIZE):
+            data += chunk
+            if len(data) >= limit:
+                break
+        return bytes(data[:limit])
+
+    def close(self):
+        if self._owns_session:
+            self._session.close()
+
+
+class ReaderIO(io.RawIOBase):
+    """
+    Read-only, seekable file object over a reader with a known size, e.g.
+    to open a zip archive over a RemoteReader with zipfile. Wrap it in an
+    io.BufferedReader to read in blocks.
+    """
+    def __init__(self, reader):
+        io.RawIOBase.__init__(self)
+        self.reader = reader
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _size(self):
+        if self.reader.size is None:
+            # remote readers learn the size from the first response
+            self.reader.read_at(0, 1)
+        if self.reader.size is None:
+            raise OSError("size of the file is unknown")
+        return self.reader.size
+
+    def readinto(self, b):
+        data = self.reader.read_at(self._position, len(b))
+        b[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size()
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+
+def as_reader(f):
+    """
+    get a reader for f, f itself if it is a reader already,
+    otherwise a FileReader reading through it
+
+    :param f: reader or opened file handle
+    """
+    if hasattr(f, "read_at"):
+        return f
+    return FileReader(f)
+
+
+def open_reader(f):
+    """
+    get the fastest reader for an opened file: a MappedReader for local
+    files, a RemoteReader of the same URL for httpio streams and a
+    FileReader for anything else, e.g. in memory files or files that can't
+    be mapped (empty files, pipes). The RemoteReader reuses the session and
+    the request arguments (auth, cert, verify, ...) of the httpio stream.
+
+    :param f: opened file handle, readers are returned as they are
+    """
+    if hasattr(f, "read_at"):
+        return f
+
+    url = getattr(f, "url", None)
+    if isinstance(url, str) and url.lower().startswith(("http://", "https://")):
+        return RemoteReader(url, getattr(f, "_session", None),
+                            **(getattr(f, "_kwargs", None) or {}))
+
+    try:
+        f.fileno()
+        return MappedReader(f)
+    except (AttributeError, OSError, ValueError):
+        # io.UnsupportedOperation is both OSError and ValueError
+        return FileReader(f)
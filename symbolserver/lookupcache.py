@@ -0,0 +1,123 @@
+from collections import OrderedDict
+from typing import Callable, Hashable, NamedTuple, Optional
+import threading
+import time
+
+# Returned by LookupCache.get when the key is not cached, None is a cached miss
+MISSING = object()
+
+class CacheStats(NamedTuple):
+    hits: int
+    negative_hits: int
+    misses: int
+    evictions: int
+    expirations: int
+    invalidations: int
+    size: int
+    negative_size: int
+
+class LookupCache:
+    """
+    Size bounded LRU cache of lookup results. Negative results (None) live in their own LRU
+    limited to a share of the cache and expire after negative_ttl seconds, so probes for missing
+    symbols can't push out the symbols that exist. Positive results expire after positive_ttl
+    seconds, invalidate only reaches the cache of the writing process, e.g. not that of a server
+    while a separate publisher process republishes a symbol. Thread safe.
+    """
+    def __init__(self, max_size: int = 100000, negative_ttl: float = 60.0, negative_share: float = 0.25,
+                 positive_ttl: float = 300.0, clock: Callable[[], float] = time.monotonic):
+        self.lock = threading.Lock()
+        self.negative_ttl = negative_ttl
+        self.positive_ttl = positive_ttl
+        self.negative_capacity = max(int(max_size * negative_share), 0)
+        self.positive_capacity = max(max_size - self.negative_capacity, 0)
+        self.clock = clock
+        self.generation = 0
+        self._positive = OrderedDict() # key -> (value, expiry time)
+        self._negative = OrderedDict() # key -> expiry time
+        self._hits = 0
+        self._negative_hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+
+    def get(self, key: Hashable):
+        """ Returns the cached value (None for a cached miss) or MISSING. """
+
+        with self.lock:
+            entry = self._positive.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > self.clock():
+                    self._positive.move_to_end(key)
+                    self._hits += 1
+                    return value
+                del self._positive[key]
+                self._expirations += 1
+
+            expires = self._negative.get(key)
+            if expires is not None:
+                if expires > self.clock():
+                    self._negative.move_to_end(key)
+                    self._negative_hits += 1
+                    return None
+                del self._negative[key]
+                self._expirations += 1
+
+            self._misses += 1
+            return MISSING
+
+    def put(self, key: Hashable, value, generation: Optional[int] = None) -> None:
+        """
+        Caches a lookup result. When the generation read before the lookup is given, the result
+        is dropped if an invalidation happened in between, as it may already be stale.
+        """
+
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            if value is None:
+                self._positive.pop(key, None)
+                self._insert(self._negative, key, self.clock() + self.negative_ttl, self.negative_capacity)
+            else:
+                self._negative.pop(key, None)
+                self._insert(self._positive, key, (value, self.clock() + self.positive_ttl), self.positive_capacity)
+
+    def _insert(self, entries: OrderedDict, key: Hashable, value, capacity: int) -> None:
+        if capacity <= 0:
+            return
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > capacity:
+            entries.popitem(last=False)
+            self._evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        """ Drops the entry for a key, e.g. after its value has been stored. """
+
+        with self.lock:
+            self.generation += 1
+            for entries in (self._positive, self._negative):
+                if entries.pop(key, MISSING) is not MISSING:
+                    self._invalidations += 1
+
+    def invalidate_negative(self) -> None:
+        """ Drops all cached misses, e.g. after something new has been published. """
+
+        with self.lock:
+            self.generation += 1
+            self._invalidations += len(self._negative)
+            self._negative.clear()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.generation += 1
+            self._positive.clear()
+            self._negative.clear()
+
+    def stats(self) -> CacheStats:
+        with self.lock:
+            return CacheStats(self._hits, self._negative_hits, self._misses, self._evictions, self._expirations,
+                              self._invalidations, len(self._positive) + len(self._negative), len(self._negative))
@@ -1,18 +1,55 @@
 from __future__ import absolute_import
 
 import math
-import os
 import struct
+import sys
 import binascii
 import errs
+from array import array
+from filereader import as_reader
+from itertools import accumulate
 
 SIGNATURE = b"Microsoft C/C++ MSF 7.00\r\n\x1ADS\0\0\0"
 
+# signature followed by page size, free page map, number of pages,
+# root directory size and a reserved field
+HEADER_SIZE = len(SIGNATURE) + 4*5
+
+# size of streams that were deleted, such streams have no pages
+NIL_STREAM_SIZE = 0xFFFFFFFF
+
+U32_TYPECODE = "I" if array("I").itemsize == 4 else "L"
+
 
 class PDBFormatError(errs.FileFormatError):
     format_name = "PDB"
 
 
+def _read_at(reader, offset, size):
+    """
+    read exactly size bytes at offset
+
+    :raises PDBFormatError: if the file ends before that
+    """
+    data = reader.read_at(offset, size)
+    if len(data) != size:
+        raise PDBFormatError("unexpected end of file")
+    return data
+
+
+def _u32_array(data):
+    """
+    decode a block of little endian 32-bit integers with a single call
+
+    :param data: bytes like object, its size a multiple of 4
+    """
+    values = array(U32_TYPECODE)
+    values.frombytes(data)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
 def pages(size, page_size):
     """
     calculate number of pages that are required to store the specified
@@ -26,54 +63,95 @@ def pages(size, page_size):
 
 class Root:
     """
-    A bare bones abstraction of the root stream of an PDB files. Provides
-    methods to read raw chunks of the root stream, as well as accessing
-    data about streams containing streams.
+    A bare bones abstraction of the root stream of an PDB files. The root
+    stream is read once, after that stream sizes and page numbers are
+    served from memory, a stream's page list is a slice of the cached
+    page number array.
+
+    fp is an opened file handle or a reader from the filereader module.
     """
     def __init__(self, fp, page_size, size):
-        self.fp = fp
+        self.reader = as_reader(fp)
         self.page_size = page_size
         self.size = size
-        self._pages_idx = None
+        self._data = None
+        self._sizes = None
+        self._page_offsets = None
+        self._page_numbers = None
+
+    def _read_pages(self, page_numbers, size):
+        """
+        read bytes stored in the specified pages, each run of consecutive
+        pages is fetched with a single read, all runs are announced to the
+        reader up front
 
-    def _load_pages(self):
+        :param page_numbers: pages holding the data, in order
+        :param size: number of bytes to read
+        """
+        runs = []
+        run_start = 0
+        for idx in range(1, len(page_numbers) + 1):
+            if idx < len(page_numbers) and \
+                    page_numbers[idx] == page_numbers[idx - 1] + 1:
+                continue
+            run_size = min((idx - run_start) * self.page_size, size)
+            runs.append((page_numbers[run_start] * self.page_size, run_size))
+            size -= run_size
+            run_start = idx
+
+        self.reader.prefetch(runs)
+        chunks = [_read_at(self.reader, offset, run_size)
+                  for offset, run_size in runs]
+
+        # a single run is used as is, a slice of the mapping when mapped
+        return chunks[0] if len(chunks) == 1 else b"".join(chunks)
+
+    def _load(self):
         """
-        get page numbers used by the root stream
+        read the root stream and decode the stream directory
         """
         num_pages = pages(self.size, self.page_size)
 
         # root stream indexes starts 5 int pointers after the signature
-        self.fp.seek(len(SIGNATURE) + 4*5)
         num_root_index_pages = pages(num_pages * 4, self.page_size)
-
-        root_index_pages = struct.unpack(
-            "<%sI" % num_root_index_pages,
-            self.fp.read(4*num_root_index_pages))
-
-        # read in the root page list
-        root_page_data = b""
-        for root_index in root_index_pages:
-            self.fp.seek(root_index * self.page_size)
-            root_page_data += self.fp.read(self.page_size)
-
-        page_list_fmt = "<" + ("%dI" % num_pages)
-        return struct.unpack(page_list_fmt, root_page_data[:num_pages*4])
-
-    def _pages(self):
-        if self._pages_idx is None:
-            self._pages_idx = self._load_pages()
-
-        return self._pages_idx
-
-    def _seek(self, page, byte):
-        """
-        move the root stream to a new position
-
-        :param page: move to this page
-        :param byte: move to the offset in the specified page
-        """
-        offset = self._pages()[page] * self.page_size + byte
-        self.fp.seek(offset)
+        root_index_pages = _u32_array(
+            _read_at(self.reader, HEADER_SIZE, 4*num_root_index_pages))
+
+        root_pages = _u32_array(
+            self._read_pages(root_index_pages, num_pages * 4))
+        data = memoryview(self._read_pages(root_pages, self.size))
+
+        if len(data) < 4:
+            raise PDBFormatError("root stream is truncated")
+        num_streams, = struct.unpack_from("<I", data, 0)
+        sizes_end = 4 + 4*num_streams
+        if sizes_end > len(data):
+            raise PDBFormatError("root stream is truncated")
+        sizes = _u32_array(data[4:sizes_end])
+
+        # first page number index of every stream, nil streams have no pages
+        page_size = self.page_size
+        page_offsets = list(accumulate(
+            ((size + page_size - 1) // page_size
+             if size != NIL_STREAM_SIZE else 0 for size in sizes),
+            initial=0))
+        pages_end = sizes_end + 4*page_offsets[-1]
+        if pages_end > len(data):
+            raise PDBFormatError("root stream is truncated")
+
+        self._data = data
+        self._sizes = sizes
+        self._page_offsets = page_offsets
+        self._page_numbers = _u32_array(data[sizes_end:pages_end])
+
+    def _loaded(self):
+        if self._data is None:
+            self._load()
+        return self
+
+    def _check_index(self, stream_index):
+        if not 0 <= stream_index < len(self._loaded()._sizes):
+            raise PDBFormatError("stream index %d too large" % stream_index)
 
     def read(self, start, length):
         """
@@ -84,57 +162,32 @@ class Root:
 
         :return: root bytes as an bytes array
         """
-
-        start_page = start // self.page_size
-        start_byte = start % self.page_size
-
-        self._seek(start_page, start_byte)
-
-        partial_size = min(length, self.page_size - start_byte)
-        result = self.fp.read(partial_size)
-        length -= partial_size
-        while 0 < length:
-            start_page += 1
-            self._seek(start_page, 0)
-            partial_size = min(self.page_size, length)
-            result += self.fp.read(partial_size)
-            length -= partial_size
-        return result
+        data = self._loaded()._data
+        if start < 0 or start + length > len(data):
+            raise PDBFormatError("read beyond end of root stream")
+        return bytes(data[start:start + length])
 
     def num_streams(self):
         """
         get number of streams listed in this root stream
-        :return:
         """
-        return struct.unpack("<I", self.read(0, 4))[0]
+        return len(self._loaded()._sizes)
 
     def stream_size(self, stream_index):
         """
-        get stream's size in bytes
+        get stream's size in bytes, 0 for nil streams
         """
-        if stream_index >= self.num_streams():
-            raise IndexError("stream index to large")
-
-        return struct.unpack("<I", self.read(stream_index * 4 + 4, 4))[0]
+        self._check_index(stream_index)
+        size = self._sizes[stream_index]
+        return size if size != NIL_STREAM_SIZE else 0
 
     def stream_pages(self, stream_index):
         """
         get stream's page numbers
         """
-        num_streams = self.num_streams()
-
-        pages_offset = 4 + 4 * num_streams
-
-        for sidx in range(stream_index):
-            stream_size = self.stream_size(sidx)
-            stream_num_pages = pages(stream_size, self.page_size)
-            pages_offset += stream_num_pages * 4
-
-        num_pages = pages(self.stream_size(stream_index),
-                          self.page_size)
-
-        return struct.unpack("<%dI" % num_pages,
-                             self.read(pages_offset, 4*num_pages))
+        self._check_index(stream_index)
+        return self._page_numbers[self._page_offsets[stream_index]:
+                                  self._page_offsets[stream_index + 1]]
 
 
 class GUID:
@@ -171,36 +224,54 @@ class PDBFile:
 
         guid - PDB file's GUID as an instance of GUID class
         age  - PDB file's Age, as an integer
+
+    f is an opened file handle or a reader from the filereader module,
+    with a MappedReader the MSF pages are decoded straight from the mapping.
+
+    The first bytes of the file can be passed as header, if they were
+    already read, to avoid reading them again.
     """
-    def __init__(self, f):
-        f.seek(0, os.SEEK_SET)
+    def __init__(self, f, header=None):
+        reader = as_reader(f)
+        if header is None or len(header) < HEADER_SIZE:
+            header = reader.read_at(0, HEADER_SIZE)
 
         # Check signature
-        sig = f.read(len(SIGNATURE))
-        if sig != SIGNATURE:
+        if header[:len(SIGNATURE)] != SIGNATURE:
             raise PDBFormatError("Invalid signature")
+        if len(header) < HEADER_SIZE:
+            raise PDBFormatError("unexpected end of file")
 
         # load page size and root stream definition
         page_size, _, _, root_dir_size, _ = \
-            struct.unpack("<IIIII", f.read(4*5))
+            struct.unpack_from("<IIIII", header, len(SIGNATURE))
+        if page_size == 0:
+            raise PDBFormatError("invalid page size")
 
         # Create Root stream parser
-        root = Root(f, page_size, root_dir_size)
+        root = Root(reader, page_size, root_dir_size)
 
         # load the PDB stream page
         pdb_stream_pages = root.stream_pages(1)
 
         # load GUID from PDB stream
-        f.seek(pdb_stream_pages[0]*page_size)
-        _, _, _, guid_d1, guid_d2, guid_d3, guid_d4 = \
-            struct.unpack("<IIIIHH8s", f.read(4*4 + 2 * 2 + 8))
+        if len(pdb_stream_pages) == 0:
+            raise PDBFormatError("PDB stream is empty")
+
+        # fetch the first pages of both streams at once from remote readers
+        dbi_stream_pages = root.stream_pages(3)
+        reader.prefetch([(stream_pages[0]*page_size, page_size)
+                         for stream_pages in (pdb_stream_pages, dbi_stream_pages)
+                         if len(stream_pages) > 0])
+        _, _, _, guid_d1, guid_d2, guid_d3, guid_d4 = struct.unpack(
+            "<IIIIHH8s",
+            _read_at(reader, pdb_stream_pages[0]*page_size, 4*4 + 2 * 2 + 8))
 
         # load age from the DBI information
         # (PDB information age changes when using PDBSTR)
-        dbi_stream_pages = root.stream_pages(3)
         if 0 < len(dbi_stream_pages):
-            f.seek(dbi_stream_pages[0]*page_size)
-            _, _, age = struct.unpack("<III", f.read(3*4))
+            _, _, age = struct.unpack(
+                "<III", _read_at(reader, dbi_stream_pages[0]*page_size, 3*4))
         else:
             # vc140.pdb however, does not have this stream,
             # so it does not have an age that can be used
@@ -1,97 +1,251 @@
 from __future__ import absolute_import
 
-import os
 import struct
 import errs
+from collections import namedtuple
+from filereader import as_reader
+from pdb import GUID
 
 PE_SIGNATURE = b"PE\0\0"
 PE_SIGNATURE_POINTER = 0x3C
 
-PE_SIG_SIZE = 4
-MACHINE_SIZE = 2
-NUMBER_OF_SECTION_SIZE = 2
-TIME_DATE_STAMP_SIZE = 4
-POINTER_TO_SYMBOL_TABLE_SIZE = 4
-NUMBER_OF_SYMBOLS_SIZE = 4
-SIZE_OF_OPTIONAL_HEADER_SIZE = 2
-CHARACTERISTICS_SIZE = 2
-
-# TimeDateStamp field's offset relative to PE signature
-TIME_DATE_STAMP_OFFSET = \
-    PE_SIG_SIZE + \
-    MACHINE_SIZE + \
-    NUMBER_OF_SECTION_SIZE
-
-# Optional header offset relative to PE signature
-OPTIONAL_HEADER_OFFSET = \
-    PE_SIG_SIZE + \
-    MACHINE_SIZE + \
-    NUMBER_OF_SECTION_SIZE + \
-    TIME_DATE_STAMP_SIZE + \
-    POINTER_TO_SYMBOL_TABLE_SIZE + \
-    NUMBER_OF_SYMBOLS_SIZE + \
-    SIZE_OF_OPTIONAL_HEADER_SIZE + \
-    CHARACTERISTICS_SIZE
+# Bytes read from the start of the file, usually covers the DOS stub,
+# PE headers and section table in a single read
+HEADERS_READ_SIZE = 1024
+
+# Bytes read from the PE signature when the first read did not reach it
+PE_HEADERS_READ_SIZE = 4096
+
+# e_magic, e_lfanew
+DOS_HEADER = struct.Struct("<2s58xI")
+
+# Signature, Machine, NumberOfSections, TimeDateStamp, PointerToSymbolTable,
+# NumberOfSymbols, SizeOfOptionalHeader, Characteristics
+FILE_HEADER = struct.Struct("<4sHHIIIHH")
+
+OPTIONAL_HEADER_MAGIC = struct.Struct("<H")
+PE32_MAGIC = 0x10B
+PE32_PLUS_MAGIC = 0x20B
 
 # SizeOfImage field's offset relative to optional header start
 SIZE_OF_IMAGE_OFFSET = 56
+SIZE_OF_IMAGE = struct.Struct("<I")
+
+# NumberOfRvaAndSizes offset and data directories offset,
+# relative to optional header start
+DATA_DIRECTORIES_OFFSETS = {
+    PE32_MAGIC: (92, 96),
+    PE32_PLUS_MAGIC: (108, 112),
+}
+
+# VirtualAddress, Size
+DATA_DIRECTORY = struct.Struct("<II")
+DEBUG_DIRECTORY_INDEX = 6
+
+# Name, VirtualSize, VirtualAddress, SizeOfRawData, PointerToRawData,
+# PointerToRelocations, PointerToLinenumbers, NumberOfRelocations,
+# NumberOfLinenumbers, Characteristics
+SECTION_HEADER = struct.Struct("<8sIIIIIIHHI")
+
+# Characteristics, TimeDateStamp, MajorVersion, MinorVersion, Type,
+# SizeOfData, AddressOfRawData, PointerToRawData
+DEBUG_DIRECTORY = struct.Struct("<IIHHIIII")
+IMAGE_DEBUG_TYPE_CODEVIEW = 2
+
+# Signature, GUID, Age, followed by a zero terminated PDB path
+CODEVIEW_RSDS = struct.Struct("<4sIHH8sI")
+RSDS_SIGNATURE = b"RSDS"
+
+# CodeView records are small, anything larger is not a valid record
+MAX_CODEVIEW_SIZE = 64 * 1024
 
 
 class PEFormatError(errs.FileFormatError):
     format_name = "PE"
 
 
-def _read_u32(file, size, offset):
-    """
-    Read 32-bit little-endian unsigned integer from an opened file.
-
-    :param file: opended file handle
-    :param size: file szie
-    :param offset: the offset of the integer
-    """
-    if offset + 4 > size:
-        raise PEFormatError("data offset %s beyond end of file %s" %
-                            (offset, size))
+Section = namedtuple("Section", ["Name", "VirtualSize", "VirtualAddress",
+                                 "SizeOfRawData", "PointerToRawData"])
 
-    file.seek(offset)
 
-    return struct.unpack("<I", file.read(4))[0]
+class CodeView(namedtuple("CodeView", ["guid", "age", "pdb_path"])):
+    """
+    PDB reference from a CodeView (RSDS) debug directory entry
+    """
+    @property
+    def pdb_hash(self):
+        """
+        symbol store hash of the referenced PDB file
+        """
+        return "%s%x" % (self.guid, self.age)
 
 
 class PEFile:
     """
-    Simple PE file parser, that loads two fields used by symstore:
+    Simple PE file parser, that loads header fields used by symstore:
 
-    * TimeDateStamp from file header
-    * SizeOfImage from optional header
+    * Machine, NumberOfSections, TimeDateStamp and Characteristics
+      from file header
+    * Magic and SizeOfImage from optional header
     * Hash for symstore
 
-    The values are accessed by reading the object's member variables by
-    the same name, e.g.
+    The headers are fetched with at most two reads and decoded with
+    precompiled structs, which matters when the file is a remote httpio
+    stream. The values are accessed by reading the object's member
+    variables by the same name, e.g.
 
         PEFile(open("some.exe", "rb")).TimeDateStamp
+
+    The PDB file the image references is available via read_codeview(),
+    which reads the debug directory on demand.
+
+    f is an opened file handle or a reader from the filereader module,
+    with a MappedReader the headers are decoded straight from the mapping.
+
+    The first bytes of the file can be passed as header, if they were
+    already read, to avoid reading them again.
     """
-    def __init__(self, f):
-        f.seek(0, os.SEEK_END)
-        fsize = f.tell()
-        f.seek(0, os.SEEK_SET)
+    def __init__(self, f, header=None):
+        self._reader = reader = as_reader(f)
+
+        if header is None or len(header) < DOS_HEADER.size:
+            header = reader.read_at(0, HEADERS_READ_SIZE)
+
+        if len(header) < DOS_HEADER.size:
+            raise PEFormatError("DOS header beyond end of file")
 
         # load PE signature offset
-        pe_sig_offset = _read_u32(f, fsize, PE_SIGNATURE_POINTER)
+        _, pe_sig_offset = DOS_HEADER.unpack_from(header, 0)
+
+        # the headers are parsed from data starting at data_offset
+        data_offset = 0
+        data = header
+        if pe_sig_offset + FILE_HEADER.size > len(header):
+            data_offset = pe_sig_offset
+            data = reader.read_at(pe_sig_offset, PE_HEADERS_READ_SIZE)
+
+        pe_offset = pe_sig_offset - data_offset
+        if pe_offset + FILE_HEADER.size > len(data):
+            raise PEFormatError("PE signature not found")
+
+        (signature, self.Machine, self.NumberOfSections, self.TimeDateStamp,
+         _, _, self.SizeOfOptionalHeader, self.Characteristics) = \
+            FILE_HEADER.unpack_from(data, pe_offset)
 
         # check that file contains valid PE signature
-        f.seek(pe_sig_offset)
-        if f.read(4) != PE_SIGNATURE:
+        if signature != PE_SIGNATURE:
             raise PEFormatError("PE signature not found")
 
-        # load TimeDateStamp field
-        self.TimeDateStamp = \
-            _read_u32(f, fsize, pe_sig_offset+TIME_DATE_STAMP_OFFSET)
+        optional_offset = pe_offset + FILE_HEADER.size
+        if optional_offset + SIZE_OF_IMAGE_OFFSET + SIZE_OF_IMAGE.size > \
+                len(data):
+            raise PEFormatError("optional header beyond end of file")
+
+        self.Magic, = OPTIONAL_HEADER_MAGIC.unpack_from(data, optional_offset)
 
         # load SizeOfImage field
-        self.SizeOfImage = _read_u32(f, fsize,
-                                      pe_sig_offset +
-                                      OPTIONAL_HEADER_OFFSET +
-                                      SIZE_OF_IMAGE_OFFSET)
+        self.SizeOfImage, = SIZE_OF_IMAGE.unpack_from(
+            data, optional_offset + SIZE_OF_IMAGE_OFFSET)
 
         self.hash = "%X%X" % (self.TimeDateStamp, self.SizeOfImage)
+
+        # data available for lazily parsing the debug directory and sections
+        self._data = data
+        self._data_offset = data_offset
+        self._optional_offset = optional_offset
+
+    def _debug_directory(self):
+        """
+        get (VirtualAddress, Size) of the debug data directory,
+        None if the image has none
+        """
+        offsets = DATA_DIRECTORIES_OFFSETS.get(self.Magic)
+        if offsets is None:
+            return None
+
+        count_offset, directories_offset = offsets
+        end = self._optional_offset + directories_offset + \
+            DATA_DIRECTORY.size * (DEBUG_DIRECTORY_INDEX + 1)
+        if end > self._optional_offset + self.SizeOfOptionalHeader or \
+                end > len(self._data):
+            return None
+
+        count, = struct.unpack_from(
+            "<I", self._data, self._optional_offset + count_offset)
+        if count <= DEBUG_DIRECTORY_INDEX:
+            return None
+
+        directory = DATA_DIRECTORY.unpack_from(
+            self._data, self._optional_offset + directories_offset +
+            DATA_DIRECTORY.size * DEBUG_DIRECTORY_INDEX)
+        return directory if directory[0] != 0 and directory[1] != 0 else None
+
+    def sections(self):
+        """
+        get the section table, read from the file if the header
+        reads did not cover it
+        """
+        offset = self._optional_offset + self.SizeOfOptionalHeader
+        size = SECTION_HEADER.size * self.NumberOfSections
+        data = self._data
+        if offset + size > len(data):
+            data = self._reader.read_at(self._data_offset + offset, size)
+            offset = 0
+            if len(data) < size:
+                raise PEFormatError("section table beyond end of file")
+
+        sections = []
+        for idx in range(self.NumberOfSections):
+            fields = SECTION_HEADER.unpack_from(
+                data, offset + idx * SECTION_HEADER.size)
+            sections.append(Section(fields[0].rstrip(b"\0"), *fields[1:5]))
+        return sections
+
+    def _rva_to_offset(self, rva, sections):
+        for section in sections:
+            size = max(section.VirtualSize, section.SizeOfRawData)
+            if section.VirtualAddress <= rva < section.VirtualAddress + size:
+                return rva - section.VirtualAddress + section.PointerToRawData
+        return None
+
+    def read_codeview(self):
+        """
+        get the PDB reference of this image, from its CodeView
+        debug directory entry
+
+        :return: CodeView or None if the image has no CodeView (RSDS) entry
+        """
+        directory = self._debug_directory()
+        if directory is None:
+            return None
+
+        rva, size = directory
+        offset = self._rva_to_offset(rva, self.sections())
+        if offset is None:
+            return None
+
+        entries = self._reader.read_at(offset, size)
+        for entry_offset in range(0, len(entries) - DEBUG_DIRECTORY.size + 1,
+                                  DEBUG_DIRECTORY.size):
+            (_, _, _, _, debug_type, data_size, _, data_offset) = \
+                DEBUG_DIRECTORY.unpack_from(entries, entry_offset)
+            if debug_type != IMAGE_DEBUG_TYPE_CODEVIEW:
+                continue
+            if data_size < CODEVIEW_RSDS.size or \
+                    data_size > MAX_CODEVIEW_SIZE:
+                return None
+
+            record = self._reader.read_at(data_offset, data_size)
+            if len(record) < data_size:
+                raise PEFormatError("CodeView record beyond end of file")
+
+            (signature, guid_d1, guid_d2, guid_d3, guid_d4, age) = \
+                CODEVIEW_RSDS.unpack_from(record, 0)
+            if signature != RSDS_SIGNATURE:
+                return None
+
+            pdb_path = bytes(record[CODEVIEW_RSDS.size:]).split(b"\0", 1)[0]
+            return CodeView(GUID(guid_d1, guid_d2, guid_d3, guid_d4), age,
+                            pdb_path.decode("utf-8", "replace"))
+
+        return None
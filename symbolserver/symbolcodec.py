@@ -0,0 +1,203 @@
+from typing import BinaryIO, Dict, Optional
+import argparse
+import fileio
+import gzip
+import io
+import os
+import shutil
+import time
+import zipfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Read size of the streaming compression and decompression
+CHUNK_SIZE = 256 * 1024
+
+class Codec:
+    """
+    A compression format of stored files. Besides the SymSrv "_" CAB files, the store can keep payloads compressed
+    with zstd, lz4 or gzip as name/hash/name.zst etc., the symbol server passes them through to clients accepting
+    the encoding and decompresses them on the fly for the others. Both ways work on streams, files are never
+    loaded whole.
+    """
+
+    name = ""
+    extension = "" # Appended to the stored file name
+    content_encoding = "" # HTTP Content-Encoding of the payload
+    package = "" # Python package the codec needs
+
+    @property
+    def available(self) -> bool:
+        return True
+
+    def compress_stream(self, src: BinaryIO, dest: BinaryIO) -> None:
+        raise NotImplementedError
+
+    def open_decompressed(self, f: BinaryIO) -> BinaryIO:
+        """ Readable stream of the decompressed contents of f. """
+        raise NotImplementedError
+
+    def write_opened_file(self, file: BinaryIO, path: str) -> None:
+        """ Compresses the whole opened file to path, atomically as fileio.write_opened_file. """
+
+        file.seek(0, os.SEEK_SET)
+        with fileio.atomic_open(path) as dest:
+            self.compress_stream(file, dest)
+
+    def compress_file(self, src_path: str, dest_path: str) -> None:
+        with open(src_path, "rb") as src:
+            self.write_opened_file(src, dest_path)
+
+    def read_all(self, path: str) -> bytes:
+        with open(path, "rb") as f, self.open_decompressed(f) as decompressed:
+            return decompressed.read()
+
+class ZstdCodec(Codec):
+    name = "zstd"
+    extension = ".zst"
+    content_encoding = "zstd"
+    package = "zstandard"
+
+    def __init__(self, level: int = 3):
+        self.level = level
+
+    @property
+    def available(self) -> bool:
+        return zstandard is not None
+
+    def compress_stream(self, src: BinaryIO, dest: BinaryIO) -> None:
+        # The content size is unknown for streams, the frame is written without it
+        zstandard.ZstdCompressor(level=self.level).copy_stream(src, dest, read_size=CHUNK_SIZE)
+
+    def open_decompressed(self, f: BinaryIO) -> BinaryIO:
+        return zstandard.ZstdDecompressor().stream_reader(f, read_size=CHUNK_SIZE)
+
+class Lz4Codec(Codec):
+    name = "lz4"
+    extension = ".lz4"
+    content_encoding = "lz4"
+    package = "lz4"
+
+    @property
+    def available(self) -> bool:
+        return lz4 is not None
+
+    def compress_stream(self, src: BinaryIO, dest: BinaryIO) -> None:
+        with lz4.frame.LZ4FrameFile(dest, "wb") as out:
+            shutil.copyfileobj(src, out, CHUNK_SIZE)
+
+    def open_decompressed(self, f: BinaryIO) -> BinaryIO:
+        return lz4.frame.LZ4FrameFile(f, "rb")
+
+class GzipCodec(Codec):
+    """ Slower than zstd and lz4, but needs no extra package and every HTTP client accepts it. """
+
+    name = "gzip"
+    extension = ".gz"
+    content_encoding = "gzip"
+
+    def __init__(self, level: int = 6):
+        self.level = level
+
+    def compress_stream(self, src: BinaryIO, dest: BinaryIO) -> None:
+        with gzip.GzipFile(fileobj=dest, mode="wb", compresslevel=self.level, mtime=0) as out:
+            shutil.copyfileobj(src, out, CHUNK_SIZE)
+
+    def open_decompressed(self, f: BinaryIO) -> BinaryIO:
+        return gzip.GzipFile(fileobj=f, mode="rb")
+
+# All known codecs by name, including those whose package is not installed
+CODECS: Dict[str, Codec] = {codec.name: codec for codec in [ZstdCodec(), Lz4Codec(), GzipCodec()]}
+
+def get_codec(name: str) -> Codec:
+    """ Returns an available codec, raises ValueError for unknown codecs or codecs without their package. """
+
+    codec = CODECS.get(name.strip().lower())
+    if codec is None:
+        raise ValueError(f"Unknown codec {name}, known codecs are {', '.join(CODECS)}")
+    if not codec.available:
+        raise ValueError(f"The {codec.name} codec needs the {codec.package} package")
+    return codec
+
+def parse_codecs(spec: str) -> Dict[str, Codec]:
+    """
+    Parses the codecs of a store: "zstd" for all files or per extension, e.g. "pdb=zstd,dll=lz4".
+    Returns extension (or "" for all files) -> codec.
+    """
+    codecs = {}
+    for item in spec.split(","):
+        if len(item.strip()) == 0:
+            continue
+        extension, sep, name = item.rpartition("=")
+        codecs[extension.strip().lstrip(".").lower() if sep else ""] = get_codec(name)
+    return codecs
+
+def choose_codec(codecs: Optional[Dict[str, Codec]], filename: str) -> Optional[Codec]:
+    """ Codec a file is stored with, None if it is stored as it is. """
+
+    if not codecs:
+        return None
+    extension = os.path.splitext(filename)[1][1:].lower()
+    return codecs.get(extension, codecs.get(""))
+
+def codec_of_path(path: str) -> Optional[Codec]:
+    """ Codec of a stored file by its extension, None for files stored as they are. """
+
+    lower = path.lower()
+    for codec in CODECS.values():
+        if lower.endswith(codec.extension):
+            return codec
+    return None
+
+def benchmark(archive_path: str, codecs, repeat: int = 3) -> None:
+    """ Prints the compression ratio and the compression and decompression speed of the codecs on the symbol files of a zip. """
+
+    with zipfile.ZipFile(archive_path) as archive:
+        files = [(info.filename, archive.read(info)) for info in archive.infolist()
+                 if info.filename.lower().endswith((".pdb", ".dll", ".exe"))]
+    total = sum(len(data) for _, data in files)
+    print(f"{len(files)} files, {total} bytes")
+
+    for codec in codecs:
+        compressed = []
+        start = time.perf_counter()
+        for _ in range(repeat):
+            compressed = []
+            for _, data in files:
+                out = io.BytesIO()
+                codec.compress_stream(io.BytesIO(data), out)
+                compressed.append(out.getvalue())
+        compress_time = (time.perf_counter() - start) / repeat
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for data in compressed:
+                with codec.open_decompressed(io.BytesIO(data)) as decompressed:
+                    while decompressed.read(CHUNK_SIZE):
+                        pass
+        decompress_time = (time.perf_counter() - start) / repeat
+
+        size = sum(len(data) for data in compressed)
+        print(f"{codec.name:6} ratio {total / size:5.2f}x  "
+              f"compress {total / compress_time / 1e6:8.1f} MB/s  "
+              f"decompress {total / decompress_time / 1e6:8.1f} MB/s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the codecs on the symbol files (pdb, dll, exe) of a zip archive.")
+    parser.add_argument("archive", type=str, help="Zip archive with symbol files, e.g. testdata.zip.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs averaged.")
+    args = parser.parse_args()
+
+    available = [codec for codec in CODECS.values() if codec.available]
+    for codec in CODECS.values():
+        if not codec.available:
+            print(f"{codec.name} skipped, {codec.package} is not installed")
+    benchmark(args.archive, available, args.repeat)
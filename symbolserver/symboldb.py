@@ -1,39 +1,135 @@
+from itertools import islice
+from lookupcache import LookupCache, CacheStats, MISSING
 from pathlib import Path
 from symbolmodel import Symbol, Source
-from typing import Optional
+from typing import Iterable, Iterator, List, Optional, Tuple
 import peewee
+import threading
 
 database_proxy = peewee.DatabaseProxy()
 
+# Optional cache in front of find_symbol_exact, see enable_lookup_cache
+lookup_cache: Optional[LookupCache] = None
+
+# Stored in PRAGMA user_version, bumped by every migration in _migrate
+SCHEMA_VERSION = 4
+
+# Rows written per transaction by the bulk store functions
+BATCH_SIZE = 1000
+
+# Rows per INSERT statement, keeps the bound parameters below SQLite's limit
+ROWS_PER_STATEMENT = 200
+
+# Pragmas applied to every connection, selected by the profile argument of init_db
+PROFILES = {
+  # SQLite defaults, also works for ":memory:" databases
+  "default": {},
+  # Readers never wait for the writer (WAL), commits don't fsync the database file (synchronous=NORMAL),
+  # pages are read through a shared memory map and writers wait for each other instead of failing
+  "production": {
+    "journal_mode": "wal",
+    "synchronous": 1,
+    "mmap_size": 1024 * 1024 * 1024,
+    "cache_size": -64 * 1024, # KiB per connection
+    "busy_timeout": 30 * 1000, # ms
+    "temp_store": 2, # memory
+  },
+}
+
+# Serializes writers within the process, so publishing threads queue up here instead of in SQLite's busy handler
+write_lock = threading.Lock()
+
 class BaseModel(peewee.Model):
     class Meta:
         database = database_proxy
 
 class SymbolModel(BaseModel):
-    hash = peewee.CharField(index=True)
-    filename = peewee.CharField(index=True)
+    # Looked up by the (hash, filename) unique index, SymSrv clients vary the case of both
+    hash = peewee.CharField(collation="NOCASE")
+    filename = peewee.CharField(index=True, collation="NOCASE")
     url = peewee.CharField()
     store_path = peewee.CharField()
 
+    class Meta:
+        indexes = (
+            (("hash", "filename"), True),
+        )
+
     def as_str(self):
         return str("hash: " + str(self.hash) + "  filename: " + str(self.filename)
                   + "  url: " + str(self.url)
                   + "  store_path: " + str(self.store_path))
 
 class SourceModel(BaseModel):
-    path = peewee.CharField(index=True)
+    path = peewee.CharField(unique=True)
     loaded = peewee.BooleanField()
     failure_count = peewee.IntegerField()
+    sha1 = peewee.CharField(null=True)
+    size = peewee.BigIntegerField(null=True)
+    last_modified = peewee.CharField(null=True)
 
     def as_str(self):
         return str("path: " + str(self.path) + "  loaded: " + str(self.loaded)
-                  + "  failure_count: " + str(self.failure_count))
+                  + "  failure_count: " + str(self.failure_count)
+                  + "  sha1: " + str(self.sha1) + "  size: " + str(self.size)
+                  + "  last_modified: " + str(self.last_modified))
+
+def _migrate(db: peewee.SqliteDatabase) -> None:
+  """ Brings an existing database up to SCHEMA_VERSION, must run before create_tables adds new indexes. """
+  version = db.execute_sql("PRAGMA user_version").fetchone()[0]
+
+  if version < 1 and db.table_exists(SymbolModel._meta.table_name):
+    with db.atomic():
+      # Symbols used to be matched on hash or filename, keep the latest row of each (hash, filename)
+      db.execute_sql("DELETE FROM symbolmodel WHERE id NOT IN "
+                     "(SELECT MAX(id) FROM symbolmodel GROUP BY hash, filename)")
+      db.execute_sql("DROP INDEX IF EXISTS symbolmodel_hash")
+      db.execute_sql("CREATE UNIQUE INDEX IF NOT EXISTS symbolmodel_hash_filename ON symbolmodel (hash, filename)")
 
-def init_db(path: Path):
+  if version < 2 and db.table_exists(SourceModel._meta.table_name):
+    with db.atomic():
+      # Upserts need a unique path, keep the latest row of each
+      db.execute_sql("DELETE FROM sourcemodel WHERE id NOT IN "
+                     "(SELECT MAX(id) FROM sourcemodel GROUP BY path)")
+      db.execute_sql("DROP INDEX IF EXISTS sourcemodel_path")
+      db.execute_sql("CREATE UNIQUE INDEX sourcemodel_path ON sourcemodel (path)")
+
+  if version < 3 and db.table_exists(SourceModel._meta.table_name):
+    with db.atomic():
+      # What the source looked like when it was stored, for incremental crawls
+      db.execute_sql("ALTER TABLE sourcemodel ADD COLUMN sha1 VARCHAR(255)")
+      db.execute_sql("ALTER TABLE sourcemodel ADD COLUMN size INTEGER")
+      db.execute_sql("ALTER TABLE sourcemodel ADD COLUMN last_modified VARCHAR(255)")
+
+  if version < 4 and db.table_exists(SymbolModel._meta.table_name):
+    with db.atomic():
+      # Hash and filename compare case-insensitively, columns can't change their collation so the table is
+      # rebuilt, keeping the latest row of each (hash, filename) regardless of case
+      db.execute_sql("ALTER TABLE symbolmodel RENAME TO symbolmodel_v3")
+      db.execute_sql("DROP INDEX IF EXISTS symbolmodel_hash_filename")
+      db.execute_sql("DROP INDEX IF EXISTS symbolmodel_filename")
+      db.create_tables([SymbolModel])
+      db.execute_sql("INSERT INTO symbolmodel (id, hash, filename, url, store_path) "
+                     "SELECT id, hash, filename, url, store_path FROM symbolmodel_v3 WHERE id IN "
+                     "(SELECT MAX(id) FROM symbolmodel_v3 GROUP BY hash COLLATE NOCASE, filename COLLATE NOCASE)")
+      db.execute_sql("DROP TABLE symbolmodel_v3")
+
+  db.execute_sql("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
+def init_db(path: Path, profile: str = "default"):
+  """
+  Opens the database at path with the pragmas of the given profile (see PROFILES). Every thread gets its own
+  connection on first use, so with the production profile lookups in one thread never block behind a write in another.
+  """
   global database_proxy
-  database_proxy.initialize(peewee.SqliteDatabase(path))
+  pragmas = PROFILES[profile]
+  # Write transactions take the write lock up front, a deferred upgrade could fail with SQLITE_BUSY under WAL
+  lock_type = "IMMEDIATE" if len(pragmas) > 0 else None
+  database_proxy.initialize(peewee.SqliteDatabase(path, pragmas=pragmas, lock_type=lock_type, thread_safe=True))
   database_proxy.connect()
-  database_proxy.create_tables([SymbolModel, SourceModel])
+  with write_lock:
+    _migrate(database_proxy.obj)
+    database_proxy.create_tables([SymbolModel, SourceModel])
 
 def dump():
     res = ''
@@ -45,47 +141,161 @@ def dump():
 
     return res
 
+def enable_lookup_cache(max_size: int = 100000, negative_ttl: float = 60.0, negative_share: float = 0.25,
+                        positive_ttl: float = 300.0) -> LookupCache:
+  """
+  Puts an in-process LRU cache in front of find_symbol_exact, misses are cached for negative_ttl seconds and
+  symbols for positive_ttl seconds. Symbols stored by other processes are seen once their entries expire.
+  """
+  global lookup_cache
+  lookup_cache = LookupCache(max_size, negative_ttl, negative_share, positive_ttl)
+  return lookup_cache
+
+def disable_lookup_cache() -> None:
+  global lookup_cache
+  lookup_cache = None
+
+def lookup_cache_stats() -> Optional[CacheStats]:
+  return lookup_cache.stats() if lookup_cache is not None else None
+
+def symbol_key(hash: str, filename: str) -> Tuple[str, str]:
+  """ Key of a symbol in caches and buffers, hash and filename match regardless of case as in the DB. """
+  return hash.lower(), filename.lower()
+
+def _invalidate_symbol(symbol: Symbol) -> None:
+  if lookup_cache is not None:
+    lookup_cache.invalidate(symbol_key(symbol.hash, symbol.filename))
+
+def _as_symbol(symbol: SymbolModel) -> Symbol:
+  symbol_opt = symbol.url if len(symbol.url) > 0 else None
+  store_path_opt = symbol.store_path if len(symbol.store_path) > 0 else None
+  return Symbol(symbol.hash, symbol.filename, symbol_opt, store_path_opt)
+
 def find_symbol(hash: str, filename: str) -> Optional[Symbol]:
+  """ Loose lookup, matches on hash or filename. Use find_symbol_exact to look up a specific symbol. """
   for symbol in SymbolModel.select().where(
     (SymbolModel.hash == hash) |
     (SymbolModel.filename == filename)):
-    symbol_opt = symbol.url if len(symbol.url) > 0 else None
-    store_path_opt = symbol.store_path if len(symbol.store_path) > 0 else None
-    return Symbol(symbol.hash, symbol.filename, symbol_opt, store_path_opt)
+    return _as_symbol(symbol)
 
   return None
 
+def find_symbol_exact(hash: str, filename: str) -> Optional[Symbol]:
+  """
+  Looks up the symbol stored under exactly this (hash, filename), a single probe of the unique index.
+  Both compare case-insensitively.
+  """
+  if lookup_cache is None:
+    return _find_symbol_exact(hash, filename)
+
+  key = symbol_key(hash, filename)
+  generation = lookup_cache.generation
+  symbol = lookup_cache.get(key)
+  if symbol is MISSING:
+    symbol = _find_symbol_exact(hash, filename)
+    lookup_cache.put(key, symbol, generation)
+  return symbol
+
+def _find_symbol_exact(hash: str, filename: str) -> Optional[Symbol]:
+  symbol = SymbolModel.get_or_none((SymbolModel.hash == hash) & (SymbolModel.filename == filename))
+  return _as_symbol(symbol) if symbol is not None else None
+
+def _chunks(iterable: Iterable, size: int) -> Iterator[List]:
+  iterator = iter(iterable)
+  while True:
+    chunk = list(islice(iterator, size))
+    if len(chunk) == 0:
+      return
+    yield chunk
+
 def store_symbol(symbol: Symbol) -> None:
-  url_not_null: str = symbol.url or ''
-  store_path_not_null: str = symbol.store_path or ''
-
-  for existing in SymbolModel.select().where(
-      (SymbolModel.hash == symbol.hash) |
-      (SymbolModel.filename == symbol.filename)):
-    existing.url = url_not_null
-    existing.store_path = store_path_not_null
-    existing.save()
-    return
-
-  SymbolModel.create(
-    hash = symbol.hash,
-    filename = symbol.filename,
-    url = url_not_null,
-    store_path = store_path_not_null)
+  store_symbols([symbol])
+
+def store_symbols(symbols: Iterable[Symbol], batch_size: int = BATCH_SIZE) -> int:
+  """ Inserts or updates symbols, batch_size of them per transaction. Returns the number of symbols stored. """
+  count = 0
+  for batch in _chunks(symbols, batch_size):
+    rows = [dict(
+      hash = symbol.hash,
+      filename = symbol.filename,
+      url = symbol.url or '',
+      store_path = symbol.store_path or '') for symbol in batch]
+
+    with write_lock, database_proxy.atomic():
+      for statement_rows in _chunks(rows, ROWS_PER_STATEMENT):
+        SymbolModel.insert_many(statement_rows).on_conflict(
+          conflict_target=[SymbolModel.hash, SymbolModel.filename],
+          update={
+            SymbolModel.url: peewee.EXCLUDED.url,
+            SymbolModel.store_path: peewee.EXCLUDED.store_path}).execute()
+
+    for symbol in batch:
+      _invalidate_symbol(symbol)
+    count += len(batch)
+  return count
+
+class SymbolBuffer:
+  """
+  Collects symbols to be stored and writes them with store_symbols once batch_size of them are buffered,
+  so publishing doesn't pay a transaction per file. Buffered symbols are visible through find. Thread safe.
+  """
+  def __init__(self, batch_size: int = BATCH_SIZE):
+    self.batch_size = batch_size
+    self.lock = threading.Lock()
+    self._symbols = {}
+
+  def add(self, symbol: Symbol) -> None:
+    with self.lock:
+      self._symbols[symbol_key(symbol.hash, symbol.filename)] = symbol
+      if len(self._symbols) >= self.batch_size:
+        self._flush()
+
+  def find(self, hash: str, filename: str) -> Optional[Symbol]:
+    with self.lock:
+      return self._symbols.get(symbol_key(hash, filename))
+
+  def flush(self) -> int:
+    with self.lock:
+      return self._flush()
+
+  def _flush(self) -> int:
+    count = store_symbols(self._symbols.values(), self.batch_size)
+    self._symbols = {}
+    return count
 
 def find_source(url: str) -> Optional[Source]:
   for source in SourceModel.select().where((SourceModel.path == url)):
-    return Source(source.url, source.loaded, source.failure_count)
+    return Source(source.path, source.loaded, source.failure_count, source.sha1, source.size, source.last_modified)
   return None
 
 def store_source(source: Source) -> None:
-  for existing in SourceModel.select().where((SourceModel.path == source.path)):
-    existing.loaded = source.stored
-    existing.failure_count = source.failures
-    existing.save()
-    return
-
-  SourceModel.create(
-    path = source.path,
-    loaded = source.stored,
-    failure_count = source.failures)
+  store_sources([source])
+
+def store_sources(sources: Iterable[Source], batch_size: int = BATCH_SIZE) -> int:
+  """ Inserts or updates sources, batch_size of them per transaction. Returns the number of sources stored. """
+  count = 0
+  for batch in _chunks(sources, batch_size):
+    rows = [dict(
+      path = source.path,
+      loaded = source.stored,
+      failure_count = source.failures,
+      sha1 = source.sha1,
+      size = source.size,
+      last_modified = source.last_modified) for source in batch]
+
+    with write_lock, database_proxy.atomic():
+      for statement_rows in _chunks(rows, ROWS_PER_STATEMENT):
+        SourceModel.insert_many(statement_rows).on_conflict(
+          conflict_target=[SourceModel.path],
+          update={
+            SourceModel.loaded: peewee.EXCLUDED.loaded,
+            SourceModel.failure_count: peewee.EXCLUDED.failure_count,
+            SourceModel.sha1: peewee.EXCLUDED.sha1,
+            SourceModel.size: peewee.EXCLUDED.size,
+            SourceModel.last_modified: peewee.EXCLUDED.last_modified}).execute()
+    count += len(batch)
+
+  if count > 0 and lookup_cache is not None:
+    # A newly loaded source may provide symbols that were missing until now
+    lookup_cache.invalidate_negative()
+  return count
@@ -1,16 +1,34 @@
 from typing import Optional
-from pdb import PDBFile
-from pe import PEFile
+from pdb import PDBFile, SIGNATURE as PDB_SIGNATURE
+from pe import PEFile, HEADERS_READ_SIZE
+import filereader
+
+# Enough to tell the formats apart and to hold the PDB header and the PE headers of most images
+HEADER_SIZE = HEADERS_READ_SIZE
+
+DOS_SIGNATURE = b"MZ"
 
 def hash(file) -> Optional[str]:
-  try:
-    return PEFile(file).hash
-  except:
-    pass
+  """
+  Returns the symbol store hash of a PE (exe, dll) or PDB file, None if the file is neither.
+  The format is told from the first bytes, so only the reads of the matching parser are made.
+  Local files are parsed from a memory map, httpio streams through a RemoteReader of their URL
+  and anything else through seek and read. A filereader reader can be passed instead of a file.
 
+  :raises errs.FileFormatError: if the file is truncated or corrupt
+  """
+  reader = filereader.open_reader(file)
   try:
-    return PDBFile(file).hash
-  except:
-    pass
+    header = bytes(reader.read_at(0, HEADER_SIZE))
+
+    if header.startswith(DOS_SIGNATURE):
+      return PEFile(reader, header).hash
+
+    if header.startswith(PDB_SIGNATURE):
+      return PDBFile(reader, header).hash
 
-  return None
+    return None
+  finally:
+    # readers passed in are closed by the caller
+    if reader is not file:
+      reader.close()
@@ -0,0 +1,235 @@
+from symbolmodel import Symbol
+from typing import Optional
+import argparse
+import logging
+import mmap
+import os
+import signal
+import struct
+import symboldb
+import tempfile
+import threading
+import time
+
+MAGIC = b"SYMIDX2\0"
+
+# Hashes are stored as fixed-width keys, a PDB hash (GUID + age) is at most 40 characters
+KEY_SIZE = 40
+
+# magic, key size, entry count, entries offset, blob offset
+HEADER = struct.Struct("<8sIIQQ")
+
+# hash key, offset of the entry's strings in the blob
+ENTRY = struct.Struct("<%dsQ" % KEY_SIZE)
+
+STRING_LENGTH = struct.Struct("<H")
+
+class IndexFormatError(Exception):
+    pass
+
+def _pack_string(value: str) -> bytes:
+    data = value.encode("utf-8")
+    return STRING_LENGTH.pack(len(data)) + data
+
+def _umask() -> int:
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+def export(output_path: str) -> int:
+    """
+    Exports the symbol table of the initialized symbol DB into a sorted index file. The file is written
+    next to output_path and renamed over it, so readers always see a complete snapshot.
+
+    Layout: header, count fixed-size entries sorted by (hash, filename), then a blob with the filename,
+    url and store path of each entry. Hashes and filenames are stored lowercase, lookups match them
+    regardless of case as the DB does.
+
+    :return: number of exported symbols
+    """
+    out_dir = os.path.dirname(os.path.abspath(output_path))
+    fd, tmp_path = tempfile.mkstemp(dir=out_dir, prefix=".symbolindex")
+    count = 0
+    try:
+        # mkstemp creates the file private, the index is read by the servers, which may run as other users
+        os.chmod(tmp_path, 0o666 & ~_umask())
+        # Deferred read transaction, a consistent snapshot without blocking the publisher
+        with symboldb.database_proxy.atomic("DEFERRED"):
+            total = symboldb.SymbolModel.select().count()
+            entries_offset = HEADER.size
+            blob_offset = entries_offset + total * ENTRY.size
+
+            with os.fdopen(fd, "wb") as entries, open(tmp_path, "r+b") as blob:
+                entries.seek(entries_offset)
+                blob.seek(blob_offset)
+                blob_size = 0
+
+                # hash and filename collate NOCASE, the rows come in the order of their lowercase keys
+                query = (symboldb.SymbolModel
+                         .select(symboldb.SymbolModel.hash, symboldb.SymbolModel.filename,
+                                 symboldb.SymbolModel.url, symboldb.SymbolModel.store_path)
+                         .order_by(symboldb.SymbolModel.hash, symboldb.SymbolModel.filename)
+                         .tuples())
+                for hash, filename, url, store_path in query.iterator():
+                    key = hash.lower().encode("utf-8")
+                    if len(key) > KEY_SIZE or count >= total:
+                        logging.warning(f"{filename}:{hash} can't be indexed, skipping")
+                        continue
+
+                    strings = _pack_string(filename.lower()) + _pack_string(url) + _pack_string(store_path)
+                    entries.write(ENTRY.pack(key, blob_size))
+                    blob.write(strings)
+                    blob_size += len(strings)
+                    count += 1
+
+                blob.flush()
+                entries.seek(0)
+                entries.write(HEADER.pack(MAGIC, KEY_SIZE, count, entries_offset, blob_offset))
+                entries.flush()
+                os.fsync(entries.fileno())
+
+        os.replace(tmp_path, output_path)
+    except BaseException as e:
+        os.unlink(tmp_path)
+        raise e
+
+    return count
+
+class SymbolIndex:
+    """
+    Read-only, memory-mapped view of an exported index file. Lookups are a binary search over the mapped
+    entries, processes mapping the same file share a single page cache copy of it. Each bisection step
+    copies out the key it compares (bytes order, a memoryview only compares for equality), so a lookup
+    allocates O(log n) small keys and nothing in proportion to the index.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.stat = os.fstat(f.fileno())
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mm) < HEADER.size:
+            raise IndexFormatError(f"{path} is truncated")
+        magic, key_size, self.count, self.entries_offset, self.blob_offset = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or key_size != KEY_SIZE:
+            raise IndexFormatError(f"{path} is not a symbol index")
+        if self.entries_offset + self.count * ENTRY.size > len(self._mm):
+            raise IndexFormatError(f"{path} is truncated")
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self._mm.close()
+
+    def _key_at(self, index: int) -> bytes:
+        offset = self.entries_offset + index * ENTRY.size
+        return self._mm[offset:offset + KEY_SIZE]
+
+    def _string_at(self, offset: int):
+        length, = STRING_LENGTH.unpack_from(self._mm, offset)
+        start = offset + STRING_LENGTH.size
+        return self._mm[start:start + length], start + length
+
+    def find(self, hash: str, filename: str) -> Optional[Symbol]:
+        key = hash.lower().encode("utf-8")
+        if len(key) > KEY_SIZE:
+            return None
+        key = key.ljust(KEY_SIZE, b"\0")
+        name = filename.lower().encode("utf-8")
+
+        # lower bound of the key
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        # entries with the same hash are sorted by filename, there are rarely more than a few
+        while lo < self.count and self._key_at(lo) == key:
+            offset = self.blob_offset + ENTRY.unpack_from(self._mm, self.entries_offset + lo * ENTRY.size)[1]
+            entry_name, offset = self._string_at(offset)
+            if entry_name == name:
+                url, offset = self._string_at(offset)
+                store_path, _ = self._string_at(offset)
+                return Symbol(hash, filename, url.decode("utf-8") or None, store_path.decode("utf-8") or None)
+            lo += 1
+
+        return None
+
+class LiveSymbolIndex:
+    """
+    SymbolIndex that swaps itself to a newly exported snapshot, when the file changes (checked at most
+    every check_interval seconds) or when a reload is requested, e.g. on SIGHUP. The old mapping is
+    released once the last lookup using it returns.
+    """
+    def __init__(self, path: str, check_interval: float = 1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self._index = SymbolIndex(path)
+        self._next_check = time.monotonic() + check_interval
+        self._reload_requested = False
+        logging.info(f"Loaded {len(self._index)} symbols from {path}")
+
+    def request_reload(self):
+        self._reload_requested = True
+
+    def _changed(self) -> bool:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        current = self._index.stat
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size) != (current.st_ino, current.st_mtime_ns, current.st_size)
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if not self._reload_requested and now < self._next_check:
+            return
+
+        with self.lock:
+            if not self._reload_requested and now < self._next_check:
+                return
+            reload = self._reload_requested or self._changed()
+            self._reload_requested = False
+            self._next_check = now + self.check_interval
+            if not reload:
+                return
+            try:
+                self._index = SymbolIndex(self.path)
+                logging.info(f"Reloaded {len(self._index)} symbols from {self.path}")
+            except (OSError, IndexFormatError) as e:
+                logging.error(f"Failed to reload {self.path}, keeping the previous snapshot: {e}")
+
+    def find(self, hash: str, filename: str) -> Optional[Symbol]:
+        self._maybe_reload()
+        return self._index.find(hash, filename)
+
+def install_sighup_reload(index: LiveSymbolIndex) -> None:
+    """ Reloads the index on SIGHUP, must be called from the main thread. """
+
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: index.request_reload())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(threadName)s:%(message)s")
+    logging.root.setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser(description="""
+        Exports the symbol database into a memory-mapped index file for the symbol server (--index).
+    """)
+
+    parser.add_argument("--db", type=str, required=True, help="Path to the symbol database.")
+    parser.add_argument("--dbProfile", type=str, choices=list(symboldb.PROFILES.keys()), default="production", help="SQLite tuning profile of the symbol database.")
+    parser.add_argument("--out", type=str, required=True, help="Path of the index file, replaced atomically.")
+
+    args = parser.parse_args()
+
+    symboldb.init_db(args.db, args.dbProfile)
+    start = time.monotonic()
+    count = export(args.out)
+    logging.info(f"Exported {count} symbols to {args.out} in {time.monotonic() - start:.1f}s")
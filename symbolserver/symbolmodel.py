@@ -11,3 +11,7 @@ class Source(NamedTuple):
   path: str
   stored: bool
   failures: int
+  # As listed by the source, used to tell whether it changed since it was stored
+  sha1: Optional[str] = None
+  size: Optional[int] = None
+  last_modified: Optional[str] = None
@@ -21,19 +21,27 @@
 # SOFTWARE.
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import partial
+from itertools import product
 from logging import DEBUG
-from typing import List, NamedTuple, Tuple
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
 from artifactory import ArtifactoryPath
 import asynctaskgraph as atg
+import errs
 import fileio
-import httpio
+import filereader
+import io
+import json
 import logging
 import os
-import pickle
 import requests
+import struct
+import symbolcodec
 import symboldb
 import symbolhash
+import threading
 from urllib.parse import urlparse
 import xml.etree.ElementTree as et
 import zipfile
@@ -41,11 +49,104 @@ import zipfile
 class Params(NamedTuple):
     excludes: List[str]
     store_path: str
-    skip_last_errors: bool # Not implemented
+    skip_last_errors: bool # Artifactory paths that failed in the last run are skipped
     threads: int
     link_mode: bool # Stored symbol will be a link to the source location
     artifactory: bool
     overwrite: bool
+    archive_workers: int = 4 # Members of an archive deployed in parallel
+    archive_memory: int = 256 * 1024 * 1024 # Bytes of archive handle and member buffers across the archive workers
+    aql: bool = False # Artifactory artifacts are discovered by paged AQL searches instead of listing folders
+    deploy_workers: int = 4 # Artifactory artifacts deployed in parallel
+    host_connections: int = 8 # Concurrent HTTP connections to a single host, shared by all deploys
+    codecs: Optional[Dict[str, symbolcodec.Codec]] = None # Stored files are compressed, see symbolcodec.parse_codecs
+
+# Local file header of a zip member: signature, file name length, extra field length
+ZIP_LOCAL_HEADER = struct.Struct("<4s22xHH")
+ZIP_LOCAL_SIGNATURE = b"PK\x03\x04"
+
+# Remote archives are read in blocks of this size, each handle caches at most ARCHIVE_CACHE_BLOCKS of them
+ARCHIVE_BLOCK_SIZE = 1024 * 1024
+ARCHIVE_CACHE_BLOCKS = 8
+
+# Read buffer of a remote archive handle, the blocks are cached below it already
+ARCHIVE_READ_BUFFER = 64 * 1024
+
+# Remote symbol files are transferred to the store in ranged requests of this size
+TRANSFER_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Artifacts returned by one AQL search request
+AQL_PAGE_SIZE = 10000
+
+# Names of the artifacts the AQL discovery asks for, the supported archives and symbol files
+AQL_NAME_PATTERNS = ["*.pdb", "*.dll", "*.exe", "*.zip", "*.nupkg"]
+
+class HttpPool:
+    """
+    One requests session shared by all deploys, so connections are kept alive and reused across files. At most
+    per_host connections are open to a host, further requests wait until one is released.
+    """
+    def __init__(self, per_host: int = 8):
+        self.session = requests.Session()
+        self.per_host = None
+        self.adapter = None
+        self.resize(per_host)
+
+    def resize(self, per_host: int) -> None:
+        """ Replaces the connection pools, the connections of the previous ones are closed. """
+        if per_host == self.per_host:
+            return
+        previous = self.adapter
+        self.per_host = per_host
+        self.adapter = requests.adapters.HTTPAdapter(pool_maxsize=per_host, pool_block=True)
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        if previous is not None:
+            previous.close()
+
+    def use_credentials(self, path: ArtifactoryPath) -> None:
+        """ Requests are sent with the authentication and TLS settings of the Artifactory path. """
+        self.session.auth = path.auth
+        self.session.cert = path.cert
+        self.session.verify = path.verify
+
+# Deployed symbols are written to the DB in batches, see flush_symbols
+symbol_buffer = symboldb.SymbolBuffer()
+
+# Connections of all remote reads
+http_pool = HttpPool()
+
+# (hash, name) of symbols being copied to the store, so parallel deploys of the same symbol copy it once
+deploying = set()
+deploying_lock = threading.Lock()
+
+class MemoryBudget:
+    """ Bytes of buffers the archive workers may have in flight. A reservation larger than the budget waits until it has the budget to itself. """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.available = size
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, size: int):
+        size = min(size, self.size)
+        with self.condition:
+            self.condition.wait_for(lambda: self.available >= size)
+            self.available -= size
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.available += size
+                self.condition.notify_all()
+
+def flush_symbols() -> None:
+    """ Stores all buffered symbols in the DB. """
+
+    count = symbol_buffer.flush()
+    if count > 0:
+        logging.info(f"Stored {count} symbols to DB")
 
 def is_excluded(path, excludes: List[str]):
     path_forward_slashes = str(path).replace("\\", "/")
@@ -72,41 +173,213 @@ def is_symbol_dll_exe(path):
             return True
     return False
 
-def deploy_zip_contents(opened_file, params: Params):
-    with zipfile.ZipFile(opened_file) as zip_contents:
-        for zip_info in zip_contents.infolist():
-            if not zip_info.is_dir():
-                if is_symbol_dll_exe(zip_info.filename) and not is_excluded(zip_info.filename, params.excludes):
-                    logging.debug(f"Deploying {zip_info.filename} from zip to DB")
-                    raise "Not implemented"
-                    #zip_contents.extract(zip_info, dest_path)
-
-def deploy_file(name, opened_file, params: Params):
-    logging.debug(f"Deploying {name} to DB")
-
-    hash = symbolhash.hash(opened_file)
+def zip_member_reader(archive_reader, zip_info: zipfile.ZipInfo):
+    """ Returns a reader over the data of a member stored without compression, read straight from the archive. """
+
+    header = bytes(archive_reader.read_at(zip_info.header_offset, ZIP_LOCAL_HEADER.size))
+    if len(header) < ZIP_LOCAL_HEADER.size:
+        raise errs.FileFormatError(f"{zip_info.filename} is beyond the end of the archive")
+
+    signature, name_length, extra_length = ZIP_LOCAL_HEADER.unpack(header)
+    if signature != ZIP_LOCAL_SIGNATURE:
+        raise errs.FileFormatError(f"{zip_info.filename} has no local file header")
+
+    data_offset = zip_info.header_offset + ZIP_LOCAL_HEADER.size + name_length + extra_length
+    return filereader.WindowReader(archive_reader, data_offset, zip_info.file_size)
+
+def deploy_zip_member(zip_contents: zipfile.ZipFile, zip_info: zipfile.ZipInfo, archive_reader, params: Params) -> Optional[symboldb.Symbol]:
+    """
+    Deploys a member of an opened archive, returns the deployed symbol or None if it was already stored.
+    Stored members are hashed from reads of the archive and only read whole when they are copied to the store.
+    Compressed members are decompressed once, into a spool that is hashed and then copied from, as seeking
+    back in them would decompress them again from the start.
+    """
+    name = os.path.basename(zip_info.filename)
+    # There is nothing to link to inside an archive, members are always copied
+    params = params._replace(link_mode=False)
+
+    if zip_info.compress_type == zipfile.ZIP_STORED:
+        hash = hash_symbol_file(name, zip_member_reader(archive_reader, zip_info))
+        if not needs_deploy(name, hash, params):
+            return None
+        with zip_contents.open(zip_info) as member:
+            return store_file(name, hash, member, None, params)
+
+    with zip_contents.open(zip_info) as member, filereader.SpoolReader(member, zip_info.file_size) as reader:
+        hash = hash_symbol_file(name, reader)
+        if not needs_deploy(name, hash, params):
+            return None
+        return store_file(name, hash, reader.spooled_file(), None, params)
+
+def is_remote_archive(path) -> bool:
+    return str(path).lower().startswith("http")
+
+def archive_buffer_sizes(path) -> Tuple[int, int]:
+    """
+    Buffers of a handle of the archive: (idle, busy). An idle handle keeps its read buffer, while a member is
+    deployed the block cache of a remote archive fills as well, it is cleared after each member.
+    """
+    if is_remote_archive(path):
+        return ARCHIVE_READ_BUFFER, ARCHIVE_CACHE_BLOCKS * ARCHIVE_BLOCK_SIZE
+    return io.DEFAULT_BUFFER_SIZE, 0
+
+def member_buffer_size(zip_info: zipfile.ZipInfo) -> int:
+    """
+    Buffers a member has in flight besides those of the archive handle: the copy buffer, for compressed members
+    also the in-memory part of the spool they are decompressed into and its read chunk.
+    """
+    size = fileio.COPY_BUFFER_SIZE
+    if zip_info.compress_type != zipfile.ZIP_STORED:
+        size += min(zip_info.file_size, filereader.SPOOL_MEMORY) + filereader.CHUNK_SIZE
+    return size
+
+def open_archive(path):
+    """ Opens an archive (local path or URL), returns the opened file and a reader of it. Remote archives are read with ranged requests and a bounded cache. """
+
+    if is_remote_archive(path):
+        reader = filereader.RemoteReader(str(path), http_pool.session, block_size=ARCHIVE_BLOCK_SIZE, max_blocks=ARCHIVE_CACHE_BLOCKS)
+        return io.BufferedReader(filereader.ReaderIO(reader), ARCHIVE_READ_BUFFER), reader
+
+    file = open(path, "rb")
+    return file, filereader.open_reader(file)
+
+def deploy_zip_contents(path, params: Params):
+    """
+    Deploys the symbol files of a zip archive (local path or URL), the central directory is read through ranged reads.
+    Members are deployed by params.archive_workers threads, each with its own handle of the archive, as long as their
+    buffers fit in params.archive_memory: the read buffers of the open handles are taken off the budget, every
+    member reserves its own buffers and the block cache of its handle.
+    """
+    handle_idle, handle_busy = archive_buffer_sizes(path)
+    budget = None
+    worker = threading.local()
+    archives = []
+    archives_lock = threading.Lock()
+
+    def worker_archive():
+        if not hasattr(worker, "archive"):
+            file, reader = open_archive(path)
+            with archives_lock:
+                archives.append((file, reader))
+            worker.archive = (zipfile.ZipFile(file), reader)
+        return worker.archive
+
+    def deploy(zip_info: zipfile.ZipInfo):
+        zip_contents, archive_reader = worker_archive()
+        with budget.reserve(member_buffer_size(zip_info) + handle_busy):
+            logging.debug(f"Deploying {zip_info.filename} from zip to DB")
+            try:
+                deploy_zip_member(zip_contents, zip_info, archive_reader, params)
+            except errs.FileFormatError as e:
+                logging.warning(f"Skipping {zip_info.filename}: {e}")
+            finally:
+                if hasattr(archive_reader, "clear_cache"):
+                    archive_reader.clear_cache()
 
-    existing_symbol = symboldb.find_symbol(hash, name)
+    try:
+        zip_contents, _ = worker_archive()
+        members = [zip_info for zip_info in zip_contents.infolist()
+                   if not zip_info.is_dir() and is_symbol_dll_exe(zip_info.filename) and not is_excluded(zip_info.filename, params.excludes)]
+
+        if params.archive_workers <= 1 or len(members) <= 1:
+            budget = MemoryBudget(max(params.archive_memory - handle_idle, 1))
+            for zip_info in members:
+                deploy(zip_info)
+            return
+
+        # The listing handle and one per worker stay open, their read buffers take at most half of the budget
+        workers = max(1, min(params.archive_workers, len(members), params.archive_memory // (2 * handle_idle) - 1))
+        budget = MemoryBudget(max(params.archive_memory - (workers + 1) * handle_idle, 1))
+        with ThreadPoolExecutor(workers, thread_name_prefix="archive") as executor:
+            for future in [executor.submit(deploy, zip_info) for zip_info in members]:
+                future.result()
+    finally:
+        for file, reader in archives:
+            file.close()
+            reader.close()
+
+def hash_symbol_file(name, file) -> str:
+    """ Returns the symbol store hash of file (opened file or filereader reader). """
+
+    hash = symbolhash.hash(file)
+    if hash is None:
+        raise errs.FileFormatError(f"{name} is neither a PE nor a PDB file")
+    return hash
+
+def needs_deploy(name, hash, params: Params) -> bool:
+    existing_symbol = symbol_buffer.find(hash, name) or symboldb.find_symbol_exact(hash, name)
     if existing_symbol and not params.overwrite:
         logging.info(f"{name}:{hash} already exists, skipping")
-        return
+        return False
 
     if existing_symbol and params.overwrite:
         logging.info(f"{name}:{hash} already exists, overwriting")
+    return True
+
+def store_file(name, hash, opened_file, link_path, params: Params) -> Optional[symboldb.Symbol]:
+    """
+    Copies the file to the store as name/hash/name, compressed as name/hash/name.zst etc. if params.codecs select
+    a codec for it. In link mode only its link_path is recorded and opened_file may be None. Returns None if the
+    same symbol is being or has just been deployed by another thread.
+    """
+    key = (hash, name)
+    with deploying_lock:
+        if key in deploying or (not params.overwrite and symbol_buffer.find(hash, name) is not None):
+            logging.info(f"{name}:{hash} is deployed by another thread, skipping")
+            return None
+        deploying.add(key)
+
+    try:
+        logging.info(f"{name}:{hash} deploying..")
+
+        codec = symbolcodec.choose_codec(params.codecs, name)
+        full_store_path = os.path.join(params.store_path, name, hash, name) + (codec.extension if codec else "")
+
+        store_path = full_store_path if not params.link_mode else None
+        symbol = symboldb.Symbol(hash, name, link_path if params.link_mode else None, store_path)
+
+        if not params.link_mode:
+            os.makedirs(os.path.dirname(full_store_path), exist_ok=True)
+            if codec is not None:
+                codec.write_opened_file(opened_file, full_store_path)
+            else:
+                fileio.write_opened_file(opened_file, full_store_path)
+
+        # Only recorded once the file is in the store
+        symbol_buffer.add(symbol)
+        return symbol
+    finally:
+        with deploying_lock:
+            deploying.discard(key)
+
+def deploy_file(name, opened_file, params: Params) -> Optional[symboldb.Symbol]:
+    """ Deploys an opened symbol file, returns the deployed symbol or None if it was already stored. """
+
+    logging.debug(f"Deploying {name} to DB")
+
+    hash = hash_symbol_file(name, opened_file)
+    if not needs_deploy(name, hash, params):
+        return None
 
-    logging.info(f"{name}:{hash} deploying..")
+    return store_file(name, hash, opened_file, opened_file.name if params.link_mode else None, params)
 
-    full_store_path = os.path.join(params.store_path, name)
+def deploy_remote_file(name, url: str, params: Params) -> Optional[symboldb.Symbol]:
+    """
+    Deploys a symbol file from an HTTP URL. The hash is probed from ranged reads of the headers (a few KB),
+    the file is only transferred when its (hash, name) is not stored yet. Returns the deployed symbol or None.
+    """
+    logging.debug(f"Probing {name} at {url}")
 
-    # TODO
-    store_path = full_store_path if not params.link_mode else None
-    link_path = opened_file.name if params.link_mode else None
-    symbol = symboldb.Symbol(hash, name, link_path, store_path)
+    with filereader.RemoteReader(url, http_pool.session) as reader:
+        hash = hash_symbol_file(name, reader)
+    if not needs_deploy(name, hash, params):
+        return None
 
-    symboldb.store_symbol(symbol)
-    
-    if not params.link_mode:
-        fileio.write_opened_file(opened_file, full_store_path)
+    if params.link_mode:
+        return store_file(name, hash, None, url, params)
+
+    with filereader.RemoteReader(url, http_pool.session, block_size=TRANSFER_BLOCK_SIZE, max_blocks=1) as reader:
+        return store_file(name, hash, io.BufferedReader(filereader.ReaderIO(reader), TRANSFER_BLOCK_SIZE), url, params)
 
 def deploy_file_or_archive(path, params: Params):
     """ Fetches the given symbol file path (str or convertible to it) to destination folder path, extracts files if it is a known archive. """
@@ -118,19 +391,16 @@ def deploy_file_or_archive(path, params: Params):
     if str(path).lower().startswith("http"):
         # Check if archive and extract all files
         if is_supported_archive(path):
-            with httpio.open(path, 1024 * 1024 * 4) as remote_file:
-                deploy_zip_contents(remote_file, params)
+            deploy_zip_contents(path, params)
         # Check if a supported file
         elif is_symbol_dll_exe(path):
-            with httpio.open(path, 1024 * 1024 * 4) as remote_file:
-                deploy_file(os.path.basename(urlparse(str(path)).path), remote_file, params)
+            deploy_remote_file(os.path.basename(urlparse(str(path)).path), str(path), params)
         else:
             raise Exception(f"Unsupported symbol file or archive of symbol files: {str(path)}")
     else:
         # Check if archive and extract all files
         if is_supported_archive(path):
-            with open(path, "rb") as file:
-                deploy_zip_contents(file, params)
+            deploy_zip_contents(path, params)
         # Check if a supported file
         elif is_symbol_dll_exe(path):
             with open(path, "rb") as file:
@@ -140,8 +410,8 @@ def deploy_file_or_archive(path, params: Params):
 
 def find_latest_artifact_in_maven_metadata_xml(maven_path_xml):
     # JsonFile.xml :)
-    json = requests.get(maven_path_xml).json()
-    xml = requests.get(json["downloadUri"]).text
+    json = http_pool.session.get(maven_path_xml).json()
+    xml = http_pool.session.get(json["downloadUri"]).text
     version = et.fromstring(xml).find("version").text
     path = maven_path_xml.split("maven-metadata.xml")[0].replace("api/storage/", "") + "/" + version
     arti = ArtifactoryPath(path)
@@ -159,8 +429,8 @@ def publish_path_or_maven_metadata(path, params: Params):
     actual_file_or_archive = find_latest_artifact_in_maven_metadata_xml(path) if str(path).lower().endswith(".xml") else path
     deploy_file_or_archive(actual_file_or_archive, params)
 
-def publish_path(url, params: Params) -> None:
-    """ Publishes a given symbol or archive of symbols and publishes it to the given symbol store path. """
+def publish_path(url, params: Params, flush: bool = True) -> None:
+    """ Publishes a given symbol or archive of symbols and publishes it to the given symbol store path. Without flush the symbols stay buffered until flush_symbols(). """
 
     if is_excluded(url, params.excludes):
         return
@@ -169,85 +439,115 @@ def publish_path(url, params: Params) -> None:
         publish_path_or_maven_metadata(url, params)    
     except Exception as e:
         raise e
+    finally:
+        if flush:
+            flush_symbols()
 
-# TODO: Replace with source
-class ArtifactorySet:
-    def __init__(self):
-        self.version = 0
-        self.string_set = set()
-
-    def __id_from_parts(self, parts: List[str]) -> str:
-        return "".join(parts)
-
-    def contains(self, parts: List[str]) -> bool:
-        return self.__id_from_parts(parts) in self.string_set
-
-    def set(self, parts: List[str]):
-        self.string_set.add(self.__id_from_parts(parts))
+class ArtifactoryEntry(NamedTuple):
+    path: ArtifactoryPath
+    folder: bool
+    size: Optional[int]
+    sha1: Optional[str]
+    last_modified: Optional[str]
 
 class ArtifactoryDatabase:
-    def __init__(self, path: str):
-        self.path = path
-        self.deploy_counter_buffer = 16
-        self.deploy_counter = 1
-        try:
-            with open(self.path, "rb") as f:
-                self.__set = pickle.load(f)
-                if self.__set.version != ArtifactorySet().version:
-                    msg = f"Incompatible database version in {self.path}"
-                    logging.warning(msg)
-                    raise Exception(msg)
-            logging.info(f"Artifactory DB loaded from {str(self.path)}")
-        except:
-            logging.warning(f"Artifactory DB failed to load from {str(self.path)}, creating new one.")
-            self.__set = ArtifactorySet()
-
-    def buffered_commit(self):
-        self.deploy_counter -= 1
-        if self.deploy_counter <= 0:
-            logging.info(f"DB reached {self.deploy_counter_buffer} buffered commits.")
+    """
+    Crawl state of Artifactory paths, kept as sources in the symbol DB: loaded paths are skipped, failed ones
+    count their failures. Recording a path only appends it to a buffer, every commit_every records are stored
+    in one transaction after the symbols they provide. Nothing is loaded up front, lookups probe the DB index.
+    Files are recorded with their sha1, size and last modification, a stored file is fetched again only once
+    its checksum changes. Folders are always listed, their own modification time does not change with that
+    of deeper descendants. Thread safe.
+    """
+    def __init__(self, commit_every: int = 16):
+        self.commit_every = commit_every
+        self.lock = threading.Lock()
+        self.pending: List[symboldb.Source] = []
+
+    def find(self, path) -> Optional[symboldb.Source]:
+        return symboldb.find_source(str(path))
+
+    def should_publish(self, source: Optional[symboldb.Source], params: Params) -> bool:
+        if source is None:
+            return True
+        if source.stored:
+            return False
+        return not params.skip_last_errors or source.failures == 0
+
+    def is_unchanged(self, source: Optional[symboldb.Source], entry: ArtifactoryEntry) -> bool:
+        """ Whether a stored file still has the checksum, or without one the modification time, of the listing. """
+        if source is None or not source.stored:
+            return False
+        if entry.sha1 is not None:
+            return source.sha1 == entry.sha1
+        return entry.last_modified is not None and source.last_modified == entry.last_modified
+
+    def record(self, source: symboldb.Source) -> None:
+        with self.lock:
+            self.pending.append(source)
+            full = len(self.pending) >= self.commit_every
+        if full:
             self.commit()
 
-    def commit(self):
-        self.deploy_counter = self.deploy_counter_buffer
-        logging.info(f"Commiting DB of {len(self.__set.string_set)} items to {self.path}")
-        with open(self.path, "wb") as f:
-            pickle.dump(self.__set, f, pickle.HIGHEST_PROTOCOL)
-
-    def get_set(self):
-        return self.__set
-
-def artifactory_deploy_task(db: ArtifactoryDatabase, path: ArtifactoryPath, params: Params, executor: atg.Executor) -> List[atg.Task]:
-    present = db.get_set().contains(path.parts)
-    logging.debug(f"{path.parts} present: {present}")
-    if not present:
+    def commit(self) -> None:
+        with self.lock:
+            pending, self.pending = self.pending, []
+        # Symbols of the recorded paths have to be in the DB before the paths are
+        flush_symbols()
+        if len(pending) > 0:
+            symboldb.store_sources(pending)
+            logging.info(f"Recorded {len(pending)} Artifactory paths")
+
+def artifactory_deploy_task(db: ArtifactoryDatabase, entry: ArtifactoryEntry, params: Params, executor: atg.Executor) -> List[atg.Task]:
+    path = entry.path
+    source = db.find(path)
+    logging.debug(f"{str(path)} state: {source}")
+    if db.is_unchanged(source, entry):
+        return []
+    # A stored artifact with another checksum was replaced and is deployed again
+    if source is not None and source.stored:
+        source = None
+    if db.should_publish(source, params):
         logging.info(f"Trying to publish {str(path)}")
         try:
-            publish_path(path, params) # move params
-            db.get_set().set(path.parts)
+            publish_path(path, params, False) # move params
+            db.record(symboldb.Source(str(path), True, 0, entry.sha1, entry.size, entry.last_modified))
             logging.info(f"Success {str(path)}")
-            db.buffered_commit()
         except Exception as e:
             logging.exception(e)
             logging.info(f"Fail {str(path)}")
+            db.record(symboldb.Source(str(path), False, (source.failures if source is not None else 0) + 1, entry.sha1, entry.size, entry.last_modified))
 
     return []
 
-def artifactory_traverse_step(path: ArtifactoryPath, params: Params) -> Tuple[List[ArtifactoryPath], List[ArtifactoryPath]]:
+def artifactory_list(path: ArtifactoryPath) -> List[ArtifactoryEntry]:
+    """ Lists the children of an Artifactory folder with their checksum, size and modification time in one storage API call. """
+
+    url = f"{path.drive}/api/storage/{path.repo}{path.path_in_repo.rstrip('/')}"
+    response = path.session.get(url, params="list&deep=0&listFolders=1&mdTimestamps=1")
+    response.raise_for_status()
+    entries = []
+    for item in response.json().get("files", []):
+        folder = item.get("folder", False)
+        entries.append(ArtifactoryEntry(
+            path / item["uri"].lstrip("/"),
+            folder,
+            None if folder else item.get("size"),
+            item.get("sha1"),
+            item.get("lastModified")))
+    return entries
+
+def artifactory_traverse_step(db: ArtifactoryDatabase, path: ArtifactoryPath, params: Params) -> Tuple[List[ArtifactoryEntry], List[ArtifactoryEntry]]:
     files = []
     dirs = []
     try:
-        for p in path:
-            try:
-                if not is_excluded(p, params.excludes):
-                    # TODO: is_dir sometimes throws 401
-                    if p.is_dir():
-                        dirs.append(p)
-                    else:
-                        if is_supported_archive(p) or is_symbol_dll_exe(p):
-                            files.append(p)
-            except:
-                logging.warning(f"Error accessing: {p}")
+        for entry in artifactory_list(path):
+            if is_excluded(entry.path, params.excludes):
+                continue
+            if entry.folder:
+                dirs.append(entry)
+            elif is_supported_archive(entry.path) or is_symbol_dll_exe(entry.path):
+                files.append(entry)
     except:
         logging.warning(f"Error accessing: {path}")
     return files, dirs
@@ -255,15 +555,60 @@ def artifactory_traverse_step(path: ArtifactoryPath, params: Params) -> Tuple[Li
 def artifactory_traverse_task(db: ArtifactoryDatabase, artifactory_path: ArtifactoryPath, params: Params, deploy_executor: atg.Executor, parallel_executor: atg.Executor) -> List[atg.Task]:
     logging.debug(f"artifactory_traverse_task: {artifactory_path}")
 
-    files, dirs = artifactory_traverse_step(artifactory_path, params)
+    files, dirs = artifactory_traverse_step(db, artifactory_path, params)
 
     for dir in dirs:
-        parallel_executor.schedule_func(artifactory_traverse_task, db, dir, params, deploy_executor)
+        parallel_executor.schedule_func(artifactory_traverse_task, db, dir.path, params, deploy_executor)
 
     for file in files:
         deploy_executor.schedule_func(artifactory_deploy_task, db, file, params)
     return []
 
+def case_variants(pattern: str) -> List[str]:
+    """ All upper/lower case spellings of pattern, $match compares case-sensitively and has no character classes. """
+
+    return ["".join(chars) for chars in product(*[sorted({c.lower(), c.upper()}) for c in pattern])]
+
+def artifactory_aql_query(path: ArtifactoryPath, offset: int, limit: int) -> str:
+    """ AQL search for the supported artifacts in the repository (and folder) of path, one page sorted by path and name. """
+
+    names = [{"name": {"$match": variant}} for pattern in AQL_NAME_PATTERNS for variant in case_variants(pattern)]
+    criteria = {"repo": path.repo, "type": "file", "$and": [{"$or": names}]}
+    folder = path.path_in_repo.strip("/")
+    if len(folder) > 0:
+        criteria["$and"].append({"$or": [{"path": folder}, {"path": {"$match": folder + "/*"}}]})
+    return (f"items.find({json.dumps(criteria)})"
+            f'.include("repo","path","name","size","actual_sha1","modified")'
+            f'.sort({{"$asc":["path","name"]}}).offset({offset}).limit({limit})')
+
+def artifactory_search(path: ArtifactoryPath, page_size: int = AQL_PAGE_SIZE) -> Iterator[ArtifactoryEntry]:
+    """ Finds the supported artifacts below path with paged AQL searches, one request per page_size artifacts. """
+
+    repo = ArtifactoryPath(f"{path.drive}/{path.repo}")
+    offset = 0
+    while True:
+        response = path.session.post(f"{path.drive}/api/search/aql", data=artifactory_aql_query(path, offset, page_size),
+                                     headers={"Content-Type": "text/plain"})
+        response.raise_for_status()
+        results = response.json().get("results", [])
+        for item in results:
+            folder = repo if item["path"] in ("", ".") else repo / item["path"]
+            yield ArtifactoryEntry(folder / item["name"], False, item.get("size"), item.get("actual_sha1"), item.get("modified"))
+        if len(results) < page_size:
+            return
+        offset += len(results)
+
+def artifactory_search_task(db: ArtifactoryDatabase, artifactory_path: ArtifactoryPath, params: Params, deploy_executor: atg.Executor, parallel_executor: atg.Executor) -> List[atg.Task]:
+    logging.debug(f"artifactory_search_task: {artifactory_path}")
+
+    try:
+        for entry in artifactory_search(artifactory_path):
+            if not is_excluded(entry.path, params.excludes) and (is_supported_archive(entry.path) or is_symbol_dll_exe(entry.path)):
+                deploy_executor.schedule_func(artifactory_deploy_task, db, entry, params)
+    except:
+        logging.warning(f"Error searching: {artifactory_path}")
+    return []
+
 def publish_artifactory(artifactory_path, params: Params):
     artifactory_root = ArtifactoryPath(artifactory_path)
 
@@ -278,14 +623,15 @@ def publish_artifactory(artifactory_path, params: Params):
         for repo in repositories:
             paths.append(ArtifactoryPath(str(artifactory_root / repo.name)))
 
-    db_store = params.store_path + os.path.sep +  "data.pickle"
-
-    db = ArtifactoryDatabase(db_store)
+    db = ArtifactoryDatabase()
+    http_pool.resize(params.host_connections)
+    http_pool.use_credentials(artifactory_root)
 
-    with atg.Executor(1) as deploy_executor:
+    with atg.Executor(params.deploy_workers) as deploy_executor:
         with atg.Executor(params.threads) as parallel_executor:
             for path in paths:
-                parallel_executor.schedule_func(artifactory_traverse_task, db, path, params, deploy_executor)
+                task = artifactory_search_task if params.aql else artifactory_traverse_task
+                parallel_executor.schedule_func(task, db, path, params, deploy_executor)
 
     db.commit()
     logging.info("All done")
@@ -303,9 +649,18 @@ if __name__ == "__main__":
     group.add_argument("--arti", type=str, help="URL of Artifactory server, will upload everything in all subdirectories (virtual repositories are skipped if they are not part of the given URL).")
     group.add_argument("--file", type=str, help="URL or file system path of symbol files (exe, dll, pdb) or archive (zip, nuget)")
 
+    parser.add_argument("--aql", dest="aql", action="store_true", help="Discover Artifactory artifacts with paged AQL searches instead of listing every folder.")
     parser.add_argument("--threads", type=int, default=8, help="Number of threads for parallel traversal.")
     parser.add_argument("--exclude", type=str, default="", help="Exclude files by comma separated keywords. If a keyword is found in a path, it is completely skipped. Only forward slashes are supported.")
     parser.add_argument("--store", type=str, required=True, help="Path to a symbole store. Committing to a non-existing symbol store will creata a new one.")
+    parser.add_argument("--db", type=str, default="", help="Path to the symbol database, symbols.db in the symbol store by default.")
+    parser.add_argument("--dbProfile", type=str, choices=list(symboldb.PROFILES.keys()), default="production", help="SQLite tuning profile of the symbol database.")
+    parser.add_argument("--overwrite", dest="overwrite", action="store_true", help="Symbols already present in the database are deployed again.")
+    parser.add_argument("--deployWorkers", type=int, default=4, help="Number of threads deploying Artifactory artifacts in parallel.")
+    parser.add_argument("--hostConnections", type=int, default=8, help="Maximum of concurrent HTTP connections to a single host.")
+    parser.add_argument("--codec", type=str, default="", help=f"Store files compressed, with one codec for all files (e.g. zstd) or per extension (e.g. pdb=zstd,dll=lz4). Codecs: {', '.join(symbolcodec.CODECS)}.")
+    parser.add_argument("--archiveWorkers", type=int, default=4, help="Number of threads deploying members of an archive in parallel.")
+    parser.add_argument("--archiveMemory", type=int, default=256, help="MiB of archive handle and member buffers the archive workers may have in flight.")
     parser.add_argument("--verbose", dest="verbose", action="store_true", help="Verbose mode, all messages will be printed.")
     parser.add_argument("--quiet", dest="quiet", action="store_true", help="Nothing will be printed")
     parser.add_argument("--skipLastErrors", dest="skipLastErrors", action="store_true", help="Last errored out items will be skipped.")
@@ -314,12 +669,32 @@ if __name__ == "__main__":
     parser.set_defaults(quiet=False)
     parser.set_defaults(skipLastErrors=False)
     parser.set_defaults(linkMode=False)
+    parser.set_defaults(overwrite=False)
+    parser.set_defaults(aql=False)
 
     args = parser.parse_args()
 
     excludes = [item.strip() for item in args.exclude.split(",")]
 
-    params = Params(args.store, excludes, args.skipLastErrors, args.threads, args.linkMode, True if args.arti else False)
+    try:
+        codecs = symbolcodec.parse_codecs(args.codec)
+    except ValueError as e:
+        parser.error(str(e))
+
+    params = Params(
+        excludes=excludes,
+        store_path=args.store,
+        skip_last_errors=args.skipLastErrors,
+        threads=args.threads,
+        link_mode=args.linkMode,
+        artifactory=True if args.arti else False,
+        overwrite=args.overwrite,
+        archive_workers=args.archiveWorkers,
+        archive_memory=args.archiveMemory * 1024 * 1024,
+        aql=args.aql,
+        deploy_workers=args.deployWorkers,
+        host_connections=args.hostConnections,
+        codecs=codecs)
 
     if args.verbose:
         logging.root.setLevel(logging.DEBUG)
@@ -327,6 +702,9 @@ if __name__ == "__main__":
     if args.quiet:
         logging.root.setLevel(logging.CRITICAL)
 
+    os.makedirs(args.store, exist_ok=True)
+    symboldb.init_db(args.db or os.path.join(args.store, "symbols.db"), args.dbProfile)
+
     if args.arti:
         publish_artifactory(args.arti, params)
 
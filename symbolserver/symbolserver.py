@@ -1,26 +1,462 @@
+from email.utils import formatdate
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from socketserver import ThreadingMixIn
-import threading
+from typing import Callable, List, NamedTuple, Optional, Tuple
+from urllib.parse import unquote, urlsplit
+import argparse
+import fileio
+import json
+import logging
+import os
+import symbolcodec
+import symboldb
+import uuid
 
 USE_HTTPS = True
 
+FILE_PTR = "file.ptr"
+
+# Lookup cache counters as JSON, never a valid symbol path
+STATS_PATH = "/_stats"
+
+CONTENT_TYPE = "application/octet-stream"
+
+# Requests with more ranges than this get the whole file
+MAX_RANGES = 64
+
+# Longest range of a compressed stored file served decompressed, longer ranges get the whole file
+MAX_DECODED_RANGE = 16 * 1024 * 1024
+
+MULTIPART_BOUNDARY = uuid.uuid4().hex
+
+# (hash, filename) -> symbol, the symbol DB or a symbolindex.LiveSymbolIndex
+symbol_lookup: Callable[[str, str], Optional[symboldb.Symbol]] = symboldb.find_symbol_exact
+
+class Resolution(NamedTuple):
+    """ Outcome of resolving a SymSrv request path, independent of the serving engine. """
+    status: int
+    file_path: Optional[str] = None # Local file to stream
+    location: Optional[str] = None # Redirect target for link mode symbols
+    body: bytes = b""
+    codec: Optional[symbolcodec.Codec] = None # Compression of the stored file, see symbolcodec
+    decode: bool = False # The client does not accept the compressed file, it is decompressed on the fly
+
+NOT_FOUND = Resolution(404)
+NOT_ACCEPTABLE = Resolution(406)
+
+# Headers of a file decompressed on the fly, its size is only known once it is sent
+DECODED_HEADERS = [("Content-Type", CONTENT_TYPE), ("Transfer-Encoding", "chunked"), ("Vary", "Accept-Encoding")]
+
+def parse_symbol_path(request_path: str):
+    """ Splits "/<filename>/<hash>/<requested name>" into its parts, any leading path prefix is ignored. """
+
+    parts = [part for part in unquote(urlsplit(request_path).path).split("/") if len(part) > 0]
+    if len(parts) < 3:
+        return None
+    return parts[-3], parts[-2], parts[-1]
+
+def is_compressed_name(filename: str, requested: str) -> bool:
+    """ Checks whether the requested name is the SymSrv "_" compressed variant of filename, e.g. foo.pd_ for foo.pdb """
+
+    return requested.endswith("_") and requested.lower() == filename[:-1].lower() + "_"
+
+def resolve_symbol(symbol: symboldb.Symbol) -> Resolution:
+    if symbol.store_path:
+        if os.path.isfile(symbol.store_path):
+            return Resolution(200, file_path=symbol.store_path, codec=symbolcodec.codec_of_path(symbol.store_path))
+        logging.warning(f"{symbol.filename}:{symbol.hash} is missing from the store at {symbol.store_path}")
+        return NOT_FOUND
+
+    if symbol.url:
+        if symbol.url.lower().startswith("http"):
+            return Resolution(302, location=symbol.url)
+        if os.path.isfile(symbol.url):
+            return Resolution(200, file_path=symbol.url)
+
+    return NOT_FOUND
+
+def resolve(request_path: str) -> Resolution:
+    """ Resolves a SymSrv request path to a stored file, a redirect or 404. """
+
+    if urlsplit(request_path).path == STATS_PATH:
+        stats = symboldb.lookup_cache_stats()
+        return Resolution(200, body=json.dumps(stats._asdict() if stats else {}).encode())
+
+    parsed = parse_symbol_path(request_path)
+    if parsed is None:
+        return NOT_FOUND
+    filename, hash, requested = parsed
+
+    if requested.lower() == FILE_PTR:
+        # Link mode symbols can be pointed at directly, everything else is served as a file
+        symbol = symbol_lookup(hash, filename)
+        if symbol and symbol.url and not symbol.store_path:
+            return Resolution(200, body=("PATH:" + symbol.url).encode())
+        return NOT_FOUND
+
+    if is_compressed_name(filename, requested):
+        # Serve the compressed variant only if that is how it was stored,
+        # otherwise the client retries with the uncompressed name
+        symbol = symbol_lookup(hash, requested) or symbol_lookup(hash, filename)
+        if symbol and symbol.store_path and symbol.store_path.endswith("_"):
+            return resolve_symbol(symbol)
+        return NOT_FOUND
+
+    if requested.lower() != filename.lower():
+        return NOT_FOUND
+
+    symbol = symbol_lookup(hash, filename)
+    if symbol is None:
+        return NOT_FOUND
+    return resolve_symbol(symbol)
+
+def accepts_encoding(accept_encoding: Optional[str], content_encoding: str) -> bool:
+    """
+    Checks whether an Accept-Encoding header names the content encoding, an explicit q=0 refuses it.
+    "*" does not count, clients get compressed files only when they opt into the codec.
+    """
+    for item in (accept_encoding or "").split(","):
+        token, _, params = item.partition(";")
+        if token.strip().lower() != content_encoding:
+            continue
+        name, _, value = params.strip().partition("=")
+        try:
+            return name.strip().lower() != "q" or float(value) > 0
+        except ValueError:
+            return True
+    return False
+
+def negotiate_encoding(resolution: Resolution, accept_encoding: Optional[str], range_header: Optional[str] = None) -> Resolution:
+    """
+    Decides how a compressed stored file is sent: as it is to clients accepting its encoding, decompressed
+    on the fly to the others, or 406 if the codec's package is not installed on the server. Range requests
+    always get the decompressed file, ranges of the compressed bytes are of no use to symbol clients.
+    """
+    codec = resolution.codec
+    if codec is None or not resolution.file_path or \
+            (not range_header and accepts_encoding(accept_encoding, codec.content_encoding)):
+        return resolution
+    if not codec.available:
+        logging.warning(f"{resolution.file_path} can't be decompressed, the {codec.package} package is not installed")
+        return NOT_ACCEPTABLE
+    return resolution._replace(decode=True)
+
+def encoding_headers(codec: Optional[symbolcodec.Codec]) -> List[Tuple[str, str]]:
+    """ Headers of a compressed stored file sent as it is. """
+
+    if codec is None:
+        return []
+    return [("Content-Encoding", codec.content_encoding), ("Vary", "Accept-Encoding")]
+
+class DecodedResponse(NamedTuple):
+    status: int
+    headers: List[Tuple[str, str]]
+    body: Optional[bytes] # None for the whole decompressed file, sent chunked
+
+def read_decoded(stream, count: int) -> bytes:
+    """ Reads count bytes of a decompressed stream, fewer only at its end. """
+
+    data = bytearray()
+    while len(data) < count:
+        buf = stream.read(min(count - len(data), symbolcodec.CHUNK_SIZE))
+        if not buf:
+            break
+        data += buf
+    return bytes(data)
+
+def skip_decoded(stream, count: int) -> int:
+    """ Skips count bytes of a decompressed stream, returns the number skipped, fewer only at its end. """
+
+    skipped = 0
+    while skipped < count:
+        buf = stream.read(min(count - skipped, symbolcodec.CHUNK_SIZE))
+        if not buf:
+            break
+        skipped += len(buf)
+    return skipped
+
+def decoded_response(codec: symbolcodec.Codec, f, range_header: Optional[str], if_range: Optional[str]) -> DecodedResponse:
+    """
+    Plans the response for a compressed stored file sent decompressed. The decompressed size is not stored,
+    so a single "start-end" range is served by decompressing up to its end, the size is only known when the
+    file ends within the range. Any other Range header gets the whole file, as does If-Range: decompressed
+    files are sent without validators.
+    """
+    whole = DecodedResponse(200, DECODED_HEADERS, None)
+    if not range_header or if_range is not None:
+        return whole
+
+    unit, sep, spec = range_header.partition("=")
+    first, dash, last = spec.strip().partition("-")
+    if not sep or not dash or unit.strip().lower() != "bytes" or "," in spec:
+        return whole
+    try:
+        start, end = int(first), int(last)
+    except ValueError:
+        return whole
+    if start < 0 or end < start or end - start + 1 > MAX_DECODED_RANGE:
+        return whole
+
+    with codec.open_decompressed(f) as decompressed:
+        skipped = skip_decoded(decompressed, start)
+        data = read_decoded(decompressed, end - start + 1) if skipped == start else b""
+
+    size = None
+    if skipped < start or len(data) < end - start + 1:
+        size = skipped + len(data)
+    if len(data) == 0:
+        return DecodedResponse(416, [("Content-Range", "bytes */%d" % size), ("Content-Length", "0")], b"")
+
+    headers = [("Content-Type", CONTENT_TYPE),
+               ("Content-Range", "bytes %d-%d/%s" % (start, start + len(data) - 1, "*" if size is None else size)),
+               ("Content-Length", str(len(data))),
+               ("Vary", "Accept-Encoding")]
+    return DecodedResponse(206, headers, data)
+
+def chunk(data: bytes) -> bytes:
+    """ Frames data as a chunk of a chunked transfer encoded body, empty data ends the body. """
+
+    return b"%x\r\n%s\r\n" % (len(data), data)
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+def parse_ranges(range_header: str, size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parses a "bytes=" Range header into a list of inclusive (start, end) pairs. Returns None when
+    the header should be ignored and the whole file served, raises RangeNotSatisfiable when
+    none of the ranges overlaps the file.
+    """
+
+    unit, sep, specs = range_header.partition("=")
+    if not sep or unit.strip().lower() != "bytes":
+        return None
+
+    ranges = []
+    for spec in specs.split(","):
+        first, sep, last = spec.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if len(first) == 0:
+                # Suffix range, the last N bytes
+                suffix = int(last)
+                if suffix <= 0:
+                    continue
+                ranges.append((max(size - suffix, 0), size - 1))
+                continue
+
+            start = int(first)
+            end = int(last) if len(last) > 0 else None
+        except ValueError:
+            return None
+
+        if end is not None and end < start:
+            return None
+        if start < size:
+            ranges.append((start, size - 1 if end is None else min(end, size - 1)))
+
+    if len(ranges) == 0 or size == 0:
+        raise RangeNotSatisfiable()
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+class FilePart(NamedTuple):
+    head: bytes # Bytes sent before the file data, e.g. a multipart part header
+    offset: int
+    count: int
+
+class FileResponse(NamedTuple):
+    status: int
+    headers: List[Tuple[str, str]]
+    parts: List[FilePart]
+    tail: bytes
+
+def file_response(size: int, mtime: float, range_header: Optional[str], if_range: Optional[str]) -> FileResponse:
+    """ Plans the response for a file, the whole file or the requested byte ranges. """
+
+    last_modified = formatdate(mtime, usegmt=True)
+    headers = [("Content-Type", CONTENT_TYPE),
+               ("Accept-Ranges", "bytes"),
+               ("Last-Modified", last_modified)]
+
+    ranges = None
+    # A stale If-Range validator means the client wants the whole, new file
+    if range_header and (if_range is None or if_range == last_modified):
+        try:
+            ranges = parse_ranges(range_header, size)
+        except RangeNotSatisfiable:
+            headers = [("Content-Range", "bytes */%d" % size), ("Content-Length", "0")]
+            return FileResponse(416, headers, [], b"")
+
+    if ranges is None:
+        headers.append(("Content-Length", str(size)))
+        return FileResponse(200, headers, [FilePart(b"", 0, size)], b"")
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers.append(("Content-Range", "bytes %d-%d/%d" % (start, end, size)))
+        headers.append(("Content-Length", str(end - start + 1)))
+        return FileResponse(206, headers, [FilePart(b"", start, end - start + 1)], b"")
+
+    parts = []
+    for start, end in ranges:
+        head = ("\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n" %
+                (MULTIPART_BOUNDARY, CONTENT_TYPE, start, end, size)).encode()
+        parts.append(FilePart(head, start, end - start + 1))
+    tail = ("\r\n--%s--\r\n" % MULTIPART_BOUNDARY).encode()
+
+    length = sum(len(part.head) + part.count for part in parts) + len(tail)
+    headers[0] = ("Content-Type", "multipart/byteranges; boundary=" + MULTIPART_BOUNDARY)
+    headers.append(("Content-Length", str(length)))
+    return FileResponse(206, headers, parts, tail)
+
 class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
     def do_GET(self):
-        for item in self.headers.items():
-            print("Header: " + str(item))
-        print("Request: " + str(self.path))
-        self.send_response(200)
+        self.send_resolution(negotiate_encoding(resolve(self.path), self.headers.get("Accept-Encoding"), self.headers.get("Range")), True)
+
+    def do_HEAD(self):
+        self.send_resolution(negotiate_encoding(resolve(self.path), self.headers.get("Accept-Encoding"), self.headers.get("Range")), False)
+
+    def send_resolution(self, resolution: Resolution, send_body: bool):
+        if resolution.file_path and resolution.decode:
+            self.send_decoded(resolution.file_path, resolution.codec, send_body)
+            return
+        if resolution.file_path:
+            self.send_file(resolution.file_path, send_body, encoding_headers(resolution.codec))
+            return
+
+        self.send_response(resolution.status)
+        if resolution.location:
+            self.send_header("Location", resolution.location)
+        self.send_header("Content-Length", str(len(resolution.body)))
         self.end_headers()
-        self.wfile.write(b'Hello world\t' + threading.currentThread().getName().encode() + b'\t' + str(threading.active_count()).encode() + b'\n')
+        if send_body and resolution.body:
+            self.wfile.write(resolution.body)
+
+    def send_file(self, path: str, send_body: bool, extra_headers: List[Tuple[str, str]] = []):
+        try:
+            f = open(path, "rb")
+        except OSError:
+            logging.warning(f"Failed to open {path}")
+            self.send_error(404)
+            return
+
+        with f:
+            fs = os.fstat(f.fileno())
+            response = file_response(fs.st_size, fs.st_mtime, self.headers.get("Range"), self.headers.get("If-Range"))
+            self.send_response(response.status)
+            for name, value in response.headers + extra_headers:
+                self.send_header(name, value)
+            self.end_headers()
+            if not send_body:
+                return
+
+            for part in response.parts:
+                if part.head:
+                    self.wfile.write(part.head)
+                fileio.send_file(self.connection, f, part.offset, part.count)
+            if response.tail:
+                self.wfile.write(response.tail)
+
+    def send_decoded(self, path: str, codec: symbolcodec.Codec, send_body: bool):
+        try:
+            f = open(path, "rb")
+        except OSError:
+            logging.warning(f"Failed to open {path}")
+            self.send_error(404)
+            return
+
+        with f:
+            try:
+                response = decoded_response(codec, f, self.headers.get("Range"), self.headers.get("If-Range"))
+            except Exception as e:
+                logging.warning(f"Failed to decompress {path}: {e}")
+                self.send_error(500)
+                return
+
+            self.send_response(response.status)
+            for name, value in response.headers:
+                self.send_header(name, value)
+            self.end_headers()
+            if not send_body:
+                return
+            if response.body is not None:
+                self.wfile.write(response.body)
+                return
+
+            try:
+                with codec.open_decompressed(f) as decompressed:
+                    while True:
+                        data = decompressed.read(symbolcodec.CHUNK_SIZE)
+                        self.wfile.write(chunk(data))
+                        if not data:
+                            break
+            except Exception as e:
+                # The status is sent already, the client sees the body cut short
+                logging.warning(f"Failed to decompress {path}: {e}")
+                self.close_connection = True
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s" % (self.address_string(), format % args))
 
 
 class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
-    pass
+    daemon_threads = True
 
-def run():
-    server = ThreadingSimpleServer(('0.0.0.0', 8000), Handler)
+def run(host: str = "0.0.0.0", port: int = 8000):
+    server = ThreadingSimpleServer((host, port), Handler)
+    logging.info(f"Serving symbols at {host}:{server.server_address[1]}")
     server.serve_forever()
 
 
 if __name__ == '__main__':
-    run()
+    logging.basicConfig(format="%(threadName)s:%(message)s")
+    logging.root.setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser(description="""
+        Symbol server answering SymSrv HTTP requests (/<filename>/<hash>/<filename>) from the symbol database.
+    """)
+
+    parser.add_argument("--db", type=str, default="", help="Path to the symbol database filled by the symbol publisher.")
+    parser.add_argument("--index", type=str, default="", help="Path to an index exported by symbolindex.py, served instead of the database and reloaded when it changes or on SIGHUP.")
+    parser.add_argument("--dbProfile", type=str, choices=list(symboldb.PROFILES.keys()), default="production", help="SQLite tuning profile, production enables WAL so lookups don't wait for the publisher.")
+    parser.add_argument("--host", type=str, default="0.0.0.0", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on.")
+    parser.add_argument("--engine", type=str, choices=["asyncio", "threads"], default="asyncio", help="Serving engine, asyncio handles many keep-alive connections without a thread per connection.")
+    parser.add_argument("--maxDiskReads", type=int, default=64, help="Maximum number of in-flight lookups and file transfers (asyncio engine).")
+    parser.add_argument("--keepAliveTimeout", type=float, default=60.0, help="Seconds an idle keep-alive connection is kept open (asyncio engine).")
+    parser.add_argument("--uvloop", dest="uvloop", action="store_true", help="Use uvloop as the event loop if it is installed (asyncio engine).")
+    parser.add_argument("--cacheSize", type=int, default=100000, help="Number of lookups kept in the in-process LRU cache, 0 disables the cache.")
+    parser.add_argument("--negativeTtl", type=float, default=60.0, help="Seconds a lookup of a missing symbol stays cached.")
+    parser.add_argument("--negativeShare", type=float, default=0.25, help="Share of the cache that missing symbols can take.")
+    parser.add_argument("--positiveTtl", type=float, default=300.0, help="Seconds a found symbol stays cached, bounds how long a symbol republished by another process is served stale.")
+    parser.add_argument("--verbose", dest="verbose", action="store_true", help="Verbose mode, all requests will be printed.")
+    parser.set_defaults(verbose=False)
+    parser.set_defaults(uvloop=False)
+
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.root.setLevel(logging.DEBUG)
+
+    if args.index:
+        import symbolindex
+        index = symbolindex.LiveSymbolIndex(args.index)
+        symbolindex.install_sighup_reload(index)
+        symbol_lookup = index.find
+    elif args.db:
+        symboldb.init_db(args.db, args.dbProfile)
+        if args.cacheSize > 0:
+            symboldb.enable_lookup_cache(args.cacheSize, args.negativeTtl, args.negativeShare, args.positiveTtl)
+    else:
+        parser.error("one of --db or --index is required")
+
+    if args.engine == "asyncio":
+        import asyncserver
+        asyncserver.run(args.host, args.port, args.maxDiskReads, args.keepAliveTimeout, args.uvloop, resolve)
+    else:
+        run(args.host, args.port)
@@ -1,12 +1,16 @@
 from __future__ import absolute_import
 
+import argparse
 import logging
+import multiprocessing
 import os
 import re
 import time
 import shutil
+import struct
 import threading
 import asynctaskgraph as atg
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 from functools import partial
 from os import path
@@ -15,6 +19,7 @@ from symstore import pdb
 from symstore import cab
 from symstore import errs
 from symstore import fileio
+from symstore import symbolcodec
 from datetime import datetime
 
 
@@ -39,7 +44,10 @@ TRANSACTION_DEL_RE = re.compile(
 ADMIN_DIR = "000Admin"
 LAST_ID_FILE = path.join(ADMIN_DIR, "lastid.txt")
 HISTORY_FILE = path.join(ADMIN_DIR, "history.txt")
+HISTORY_INDEX_FILE = path.join(ADMIN_DIR, "history.idx")
+PAYLOADS_FILE = path.join(ADMIN_DIR, "payloads.txt")
 SERVER_FILE = path.join(ADMIN_DIR, "server.txt")
+SERVER_INDEX_FILE = path.join(ADMIN_DIR, "server.idx")
 PINGME_FILE = "pingme.txt"
 
 PDB_IMAGE, PE_IMAGE = range(2)
@@ -95,10 +103,54 @@ def _is_empty_dir(dir_path):
 
 lock = threading.Lock()
 
+
+def _compress_cab(src_path, dest_path):
+    """
+    compress src_path to the CAB file dest_path, runs in the processes of
+    a CompressionPool
+    """
+    with fileio.atomic_path(dest_path) as temp_path:
+        cab.compress(src_path, temp_path)
+
+
+class CompressionPool:
+    """
+    CAB compression in worker processes
+
+    cab.compress holds the GIL for a large part of its work, so compressing
+    on the publishing threads does not scale. Workers receive only the file
+    paths and stream the source into the cabinet, files are never loaded
+    whole into memory. The processes are spawned, not forked, as forking a
+    process with running publish threads and GLib state is not safe.
+    """
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, src_path, dest_path):
+        """
+        :return: future of the compression, its result() raises
+                 the compression errors
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    self.workers, multiprocessing.get_context("spawn"))
+            return self._executor.submit(_compress_cab, src_path, dest_path)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
 class PublishMode(Enum):
     Raw = 1 # File gets written out as it is
     Compressed = 2 # File is compressed as cab and stores with _
     Link = 3 # File is replaced by link to its source
+    Encoded = 4 # File is compressed with the store's fast codec for its extension, see symbolcodec
 
 class TransactionEntry:
     def __init__(self, symstore, file_name, file_hash, source_file, mode, src_url):
@@ -123,9 +175,26 @@ class TransactionEntry:
                                     file_hash, file_name[:-1]+"_")
         # if both compressed and uncompressed versions of the file exists,
         # give preference to the compressed one
-        compressed = path.isfile(compressed_path)
+        if path.isfile(compressed_path):
+            mode = PublishMode.Compressed
+        elif cls._encoded_codec(symstore, file_name, file_hash) is not None:
+            mode = PublishMode.Encoded
+        else:
+            mode = PublishMode.Raw
 
-        return cls(symstore, file_name, file_hash, source_file, PublishMode.Compressed if compressed else PublishMode.Raw, "") 
+        return cls(symstore, file_name, file_hash, source_file, mode, "")
+
+    @staticmethod
+    def _encoded_codec(symstore, file_name, file_hash):
+        """
+        codec of the stored file encoded with a fast codec, None if there
+        is no such file
+        """
+        file_path = path.join(symstore._path, file_name, file_hash, file_name)
+        for codec in symbolcodec.CODECS.values():
+            if path.isfile(file_path + codec.extension):
+                return codec
+        return None
 
     def _dest_dir(self):
         return path.join(self._symstore._path, self.file_name, self.file_hash)
@@ -135,11 +204,18 @@ class TransactionEntry:
             raise NotImplementedError("reading compressed data not supported")
 
         fpath = path.join(self._dest_dir(), self.file_name)
+        if self.mode == PublishMode.Encoded:
+            codec = self._encoded_codec(self._symstore, self.file_name,
+                                        self.file_hash)
+            return codec.read_all(fpath + codec.extension)
         return fileio.read_all(fpath, "rb")
 
     def publish(self):
         """
         publish this entry's source file inside symstore
+
+        :return: future of the compression in the store's CompressionPool,
+                 None if the file was published right away
         """
         logging.debug(f"Publishing {self.source_file}")
 
@@ -157,20 +233,35 @@ class TransactionEntry:
             fast_compress = False
             if os.name == "nt":
                 try:
-                    ret = os.system(f"makecab {self.source_file} {dest_filename} 1> nul")
-                    if ret == 0:
-                        fast_compress = True
+                    with fileio.atomic_path(dest_filename) as temp_path:
+                        ret = os.system(f"makecab {self.source_file} {temp_path} 1> nul")
+                        if ret != 0:
+                            raise OSError(f"makecab failed with {ret}")
+                    fast_compress = True
                 except:
                     pass
             if not fast_compress:
-                cab.compress(self.source_file, dest_filename)
+                return self._symstore.compression.submit(self.source_file,
+                                                         dest_filename)
+        elif self.mode == PublishMode.Encoded:
+            codec = symbolcodec.choose_codec(self._symstore.codecs,
+                                             self.file_name)
+            if codec is None:
+                raise errs.UnknownFileExtension(
+                    path.splitext(self.file_name)[1][1:])
+            codec.compress_file(self.source_file,
+                                path.join(dest_dir,
+                                          self.file_name + codec.extension))
         elif self.mode == PublishMode.Link:
+            # the link file replaces any stored file of the same name, which
+            # may be hard linked to other payloads, so it must not be
+            # written in place
             dest_filename = path.join(dest_dir, self.file_name)
-            with open(dest_filename, "w") as file:
-                file.write(self.src_url)
+            with fileio.atomic_open(dest_filename) as file:
+                file.write(self.src_url.encode("utf-8"))
         else:
-            shutil.copy(self.source_file, dest_dir)
-            # TODO handle I/O errors
+            self._symstore.payloads.publish(
+                self.source_file, path.join(dest_dir, self.file_name))
 
     def __str__(self):
         return r""""%s\%s","%s""""" % \
@@ -250,9 +341,11 @@ class Transaction:
 
         return self._entries
 
-    def _entry_publish_task(self, entry, executor: atg.Executor):
+    def _entry_publish_task(self, entry, compressions, executor: atg.Executor):
         try:
-            entry.publish()
+            compression = entry.publish()
+            if compression is not None:
+                compressions.append(compression)
         except Exception as e:
             logging.error(e)
         return []
@@ -263,11 +356,19 @@ class Transaction:
         self.timestamp = now
         self.id = id
 
-        # publish all entries files to the store
+        # publish all entries files to the store, compressed files are
+        # finished by the compression processes
+        compressions = []
         for entry in self.entries:
-            executor.schedule_func(self._entry_publish_task, entry)
+            executor.schedule_func(self._entry_publish_task, entry,
+                                   compressions)
 
         executor.wait_until_tasks_done()
+        for compression in compressions:
+            try:
+                compression.result()
+            except Exception as e:
+                logging.error(e)
 
         # write new transaction file
         with self._entries_file("a") as efile:
@@ -338,57 +439,325 @@ class FilesMap:
         return deleted_entries
 
 
+class TransactionIndex:
+    """
+    persisted index of the lines of a transaction list file (server.txt,
+    history.txt), transaction id and offset of each line in file order
+
+    The index is a header and fixed size records, appended to as lines are
+    added, so opening a store reads neither the list file nor the index
+    until a transaction is looked up. Lookups by id bisect the records, the
+    ids in a list file are ascending. The header keeps the size and
+    modification time of the list file the index covers, if the file was
+    changed by other tools, e.g. symstore.exe, the index is rebuilt by
+    scanning the file's lines for their ids, without parsing them. Lines
+    read through the index are checked to be of the transaction looked up
+    as well, which catches changes the size and time miss.
+    """
+    # magic, version, size and modification time (ns) of the indexed file
+    HEADER = struct.Struct("<4sIQQ")
+    # transaction id, offset of its line
+    RECORD = struct.Struct("<QQ")
+    MAGIC = b"STIX"
+    VERSION = 2
+
+    def __init__(self, index_path, list_path):
+        self._index_path = index_path
+        self._list_path = list_path
+        self._records = None
+        # (size, modification time) of the list file the loaded records
+        # cover
+        self._list_state = None
+
+    def _current_list_state(self):
+        try:
+            stat = os.stat(self._list_path)
+        except FileNotFoundError:
+            return 0, 0
+        return stat.st_size, stat.st_mtime_ns
+
+    def _read(self):
+        """
+        records of the index file, None if it is missing or stale
+        """
+        list_state = self._current_list_state()
+        if list_state == (0, 0):
+            self._list_state = list_state
+            return bytearray()
+        try:
+            data = fileio.read_all(self._index_path, "rb")
+        except IOError:
+            return None
+
+        if len(data) < self.HEADER.size:
+            return None
+        magic, version, list_size, list_mtime = \
+            self.HEADER.unpack_from(data, 0)
+        records = bytearray(data[self.HEADER.size:])
+        if magic != self.MAGIC or version != self.VERSION or \
+                (list_size, list_mtime) != list_state or \
+                len(records) % self.RECORD.size != 0:
+            return None
+        self._list_state = list_state
+        return records
+
+    def _get_records(self):
+        if self._records is not None and \
+                self._list_state != self._current_list_state():
+            # the list file was changed behind our back
+            self._records = None
+        if self._records is None:
+            self._records = self._read()
+            if self._records is None:
+                self.rebuild()
+        return self._records
+
+    def _header(self, list_state):
+        return self.HEADER.pack(self.MAGIC, self.VERSION, *list_state)
+
+    def _write(self, records):
+        list_state = self._current_list_state()
+        with fileio.atomic_open(self._index_path) as ifile:
+            ifile.write(self._header(list_state))
+            ifile.write(records)
+        self._records = records
+        self._list_state = list_state
+
+    def _write_record(self, record):
+        """
+        add a record at the end of the index file and update its header in
+        place, the header is written last, an index cut short before it
+        does not match the list file and is rebuilt
+        """
+        list_state = self._current_list_state()
+        try:
+            ifile = open(self._index_path, "r+b")
+        except FileNotFoundError:
+            self._write(self._records + record)
+            return
+        with ifile:
+            end = self.HEADER.size + len(self._records)
+            ifile.seek(end)
+            ifile.write(record)
+            ifile.truncate(end + len(record))
+            ifile.seek(0)
+            ifile.write(self._header(list_state))
+        self._records += record
+        self._list_state = list_state
+
+    def load(self):
+        """
+        load the index, rebuilding it if the list file changed since it was
+        written, must precede appending a line to the list file
+        """
+        self._get_records()
+
+    def rebuild(self):
+        """
+        index all lines of the list file
+        """
+        records = bytearray()
+        if path.isfile(self._list_path):
+            with open(self._list_path, "rb") as lfile:
+                offset = 0
+                for line in lfile:
+                    transaction_id = _line_id(line)
+                    if transaction_id is not None:
+                        records += self.RECORD.pack(transaction_id, offset)
+                    offset += len(line)
+        self._write(records)
+
+    def __len__(self):
+        return len(self._get_records()) // self.RECORD.size
+
+    def __getitem__(self, position):
+        """
+        (transaction id, offset) of the line at position in the list file
+        """
+        return self.RECORD.unpack_from(self._get_records(),
+                                       position * self.RECORD.size)
+
+    def find(self, transaction_id):
+        """
+        offset of the line of the transaction, None if it is not listed
+        """
+        transaction_id = int(transaction_id)
+        records = self._get_records()
+        record_size = self.RECORD.size
+        low, high = 0, len(records) // record_size
+        while low < high:
+            middle = (low + high) // 2
+            if self.RECORD.unpack_from(records,
+                                       middle * record_size)[0] < \
+                    transaction_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(records) // record_size:
+            record_id, offset = self.RECORD.unpack_from(records,
+                                                        low * record_size)
+            if record_id == transaction_id:
+                return offset
+        return None
+
+    def _checked_line(self, transaction_id, offset):
+        line = _read_line(self._list_path, offset)
+        if _line_id(line) != transaction_id:
+            return None
+        return line
+
+    def find_line(self, transaction_id):
+        """
+        find the line of a transaction, rebuilding the index if the line
+        it points to is of another transaction
+
+        :return: (offset, line), None if the transaction is not listed
+        """
+        transaction_id = int(transaction_id)
+        for attempt in range(2):
+            if attempt > 0:
+                self.rebuild()
+            offset = self.find(transaction_id)
+            if offset is None:
+                return None
+            line = self._checked_line(transaction_id, offset)
+            if line is not None:
+                return offset, line
+        return None
+
+    def line_at(self, position):
+        """
+        the line at position in the list file, rebuilding the index if the
+        line it points to is of another transaction
+
+        :raises IndexError: if there are not that many lines
+        """
+        for attempt in range(2):
+            if attempt > 0:
+                self.rebuild()
+            if not 0 <= position < len(self):
+                raise IndexError("transaction index out of range")
+            transaction_id, offset = self[position]
+            line = self._checked_line(transaction_id, offset)
+            if line is not None:
+                return line
+        raise IndexError("transaction list changed while reading it")
+
+    def append(self, transaction_id, offset, list_size):
+        """
+        index a line appended to the list file
+
+        :param transaction_id: id of the transaction on the line
+        :param offset: offset of the line in the list file
+        :param list_size: size of the list file before the line was
+                          appended, the index was loaded before it
+        """
+        if self._records is None or self._list_state[0] != list_size:
+            # the index did not cover the file before the new line,
+            # scanning the file indexes the new line as well
+            self.rebuild()
+            return
+        self._write_record(self.RECORD.pack(int(transaction_id), offset))
+
+    def remove(self, transaction_id, line_size):
+        """
+        drop the line of the transaction removed from the list file
+
+        :param transaction_id: id of the transaction on the removed line
+        :param line_size: size of the removed line, the offsets of the
+                          following lines move by it
+        """
+        # the records loaded when the line was looked up, reloading them
+        # would rebuild the index of the already changed list file
+        records = bytearray()
+        for record_id, offset in self.RECORD.iter_unpack(self._records):
+            if record_id == int(transaction_id):
+                continue
+            if record_id > int(transaction_id):
+                offset -= line_size
+            records += self.RECORD.pack(record_id, offset)
+        self._write(records)
+
+
+def _read_line(file_path, offset):
+    """
+    read the line starting at offset of a transaction list file
+    """
+    with open(file_path, "rb") as lfile:
+        lfile.seek(offset)
+        return lfile.readline()
+
+
+def _line_id(line):
+    """
+    transaction id of a transaction list line, None for other lines
+    """
+    transaction_id = line.split(b",", 1)[0].strip()
+    if not transaction_id.isdigit():
+        return None
+    return int(transaction_id)
+
+
+def _parse_line(line):
+    return parse_transaction_line(line.decode("utf-8").rstrip("\r\n"))
+
+
 class Transactions:
     transaction_class = Transaction
 
     def __init__(self, symstore):
         self._symstore = symstore
-        self._transactions = None
+        self._index = TransactionIndex(symstore._server_index_file,
+                                       symstore._server_file)
 
-    def _server_file(self, mode="r"):
+    def _server_file(self, mode="rb"):
         return open(self._symstore._server_file, mode=mode)
 
     def _server_file_exists(self):
         return path.isfile(self._symstore._server_file)
 
-    def _parse_server_file(self):
+    def _iter_server_file(self):
+        """
+        parse the transactions of the server file one line at a time
+        """
         if not self._server_file_exists():
-            return {}
-
-        transactions = {}
+            return
 
         with self._server_file() as sfile:
-            for line in sfile.readlines():
-                transaction = self.transaction_class(
-                    self._symstore, **parse_transaction_line(line))
-
-                transactions[transaction.id] = transaction
-
-        return transactions
-
-    def _get_transactions(self):
-        if self._transactions is None:
-            self._transactions = self._parse_server_file()
-        return self._transactions
+            for line in sfile:
+                if len(line.strip()) == 0:
+                    continue
+                yield self.transaction_class(self._symstore,
+                                             **_parse_line(line))
 
     def find(self, transaction_id):
-        return self._get_transactions().get(transaction_id)
+        found = self._index.find_line(transaction_id)
+        if found is None:
+            return None
+
+        _, line = found
+        return self.transaction_class(self._symstore, **_parse_line(line))
 
     def get_files_map(self):
         fmap = FilesMap()
 
-        for transaction in self._get_transactions().values():
+        for transaction in self._iter_server_file():
             for entry in transaction.entries:
                 fmap.add_entry(entry, transaction)
 
         return fmap
 
     def items(self):
-        return self._get_transactions().items()
+        for transaction in self._iter_server_file():
+            yield transaction.id, transaction
 
     def add(self, transaction):
-        with self._server_file("a") as sfile:
-            sfile.write("%s\n" % transaction)
+        self._index.load()
+        with self._server_file("ab") as sfile:
+            sfile.seek(0, os.SEEK_END)
+            offset = sfile.tell()
+            sfile.write(("%s%s" % (transaction, os.linesep)).encode("utf-8"))
+        self._index.append(transaction.id, offset, offset)
         # TODO handle I/O errors
 
     def rewrite_server_file(self, transactions):
@@ -400,9 +769,11 @@ class Transactions:
         # make sure transactions list is sorted by transaction IDs
         transactions.sort(key=lambda v: v.id)
 
-        with self._server_file("w") as sfile:
+        with fileio.atomic_open(self._symstore._server_file) as sfile:
             for transaction in transactions:
-                sfile.write("%s\n" % transaction)
+                sfile.write(("%s%s" % (transaction, os.linesep))
+                            .encode("utf-8"))
+        self._index.rebuild()
 
     def delete(self, transaction):
         # figure out what files can be removed
@@ -419,13 +790,30 @@ class Transactions:
             if _is_empty_dir(parent_dir):
                 shutil.rmtree(parent_dir)
 
-        # create a list of transaction without the deleted transaction
-        new_transactions = [
-            v for v in self._transactions.values()
-            if v.id != transaction.id]
-
-        # 'delete' transaction listing from server file
-        self.rewrite_server_file(new_transactions)
+        # 'delete' transaction listing from server file, copying the other
+        # lines as they are
+        found = self._index.find_line(transaction.id)
+        if found is None:
+            return
+        offset, line = found
+        line_size = len(line)
+        # the server file is closed before the new one replaces it, open
+        # files can't be replaced on Windows
+        with fileio.atomic_open(self._symstore._server_file) as new_file:
+            with self._server_file() as sfile:
+                _copy_bytes(sfile, new_file, offset)
+                sfile.seek(offset + line_size)
+                shutil.copyfileobj(sfile, new_file, fileio.COPY_BUFFER_SIZE)
+        self._index.remove(transaction.id, line_size)
+
+
+def _copy_bytes(src, dest, count):
+    while count > 0:
+        buf = src.read(min(count, fileio.COPY_BUFFER_SIZE))
+        if not buf:
+            break
+        dest.write(buf)
+        count -= len(buf)
 
 
 class History:
@@ -433,41 +821,42 @@ class History:
 
     def __init__(self, symstore):
         self._symstore = symstore
-        self._transactions = None
+        self._index = TransactionIndex(symstore._history_index_file,
+                                       symstore._history_file)
 
-    def _history_file(self, mode="r"):
+    def _history_file(self, mode="rb"):
         return open(self._symstore._history_file, mode=mode)
 
     def _history_file_exists(self):
         return path.isfile(self._symstore._history_file)
 
-    def _parse_history_file(self):
+    def __iter__(self):
+        """
+        parse the transactions of the history file one line at a time
+        """
         if not self._history_file_exists():
-            return []
-
-        transactions = []
+            return
 
         with self._history_file() as hfile:
-            for line in hfile.readlines():
-                transaction = self.transaction_class(
-                    self._symstore, **parse_transaction_line(line))
-
-                transactions.append(transaction)
-
-        return transactions
-
-    def _get_transactions(self):
-        if self._transactions is None:
-            self._transactions = self._parse_history_file()
-        return self._transactions
+            for line in hfile:
+                if len(line.strip()) == 0:
+                    continue
+                yield self.transaction_class(self._symstore,
+                                             **_parse_line(line))
 
     def __len__(self):
-        return len(self._get_transactions())
+        return len(self._index)
 
     def __getitem__(self, item):
-        return self._get_transactions()[item]
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+
+        if item < 0:
+            item += len(self)
+        line = self._index.line_at(item)
+        return self.transaction_class(self._symstore, **_parse_line(line))
 
-    def _write_line(self, new_line):
+    def _write_line(self, transaction_id, new_line):
         def prefix_with_newline(f):
             """
             figure out if we need to prefix the new transaction line
@@ -488,27 +877,184 @@ class History:
 
             return ch != b'\n'
 
+        self._index.load()
         with self._history_file("ab+") as hfile:
+            hfile.seek(0, os.SEEK_END)
+            list_size = hfile.tell()
             if prefix_with_newline(hfile):
                 # add line break if appending to existing non-empty file
-                hfile.write(b"\n")
+                hfile.write(os.linesep.encode("utf-8"))
 
+            offset = hfile.tell()
             hfile.write(new_line.encode("utf-8"))
 
+        self._index.append(transaction_id, offset, list_size)
         # TODO handle I/O errors
 
     def add(self, transaction):
-        self._write_line("%s" % transaction)
+        self._write_line(transaction.id, "%s" % transaction)
 
     def delete(self, transaction_id, next_transaction_id):
-        self._write_line("%s,del,%s" % (next_transaction_id, transaction_id))
+        self._write_line(next_transaction_id,
+                         "%s,del,%s" % (next_transaction_id, transaction_id))
+
+
+class Payloads:
+    """
+    content hash index of the uncompressed files in the store
+
+    Files with the same contents as an already stored one are linked to it,
+    as a reflink clone or a hard link, instead of being copied. The index
+    maps the sha1 of the contents to the path of a stored copy, relative to
+    the store, one "sha1,path" line per payload in 000Admin/payloads.txt.
+    A payload whose stored copy was removed gets a new line for its next
+    copy, so later lines win.
+    """
+    def __init__(self, symstore):
+        self._symstore = symstore
+        self._payloads = None
+        self._lock = threading.Lock()
+
+    def _payloads_file(self, mode="r"):
+        return open(self._symstore._payloads_file, mode=mode)
+
+    def _parse_payloads_file(self):
+        if not path.isfile(self._symstore._payloads_file):
+            return {}
+
+        payloads = {}
+        with self._payloads_file() as pfile:
+            for line in pfile.readlines():
+                digest, _, file_path = line.rstrip("\n").partition(",")
+                # a later line replaces a removed copy of the payload
+                payloads[digest] = file_path
+
+        return payloads
+
+    def _get_payloads(self):
+        if self._payloads is None:
+            self._payloads = self._parse_payloads_file()
+        return self._payloads
+
+    def _find(self, digest, size):
+        """
+        absolute path of a stored copy with the given contents, None if
+        there is none or it was removed from the store since
+        """
+        relative_path = self._get_payloads().get(digest)
+        if relative_path is None:
+            return None
+
+        file_path = path.join(self._symstore._path, relative_path)
+        if not path.isfile(file_path) or path.getsize(file_path) != size:
+            return None
+        return file_path
+
+    def _add(self, digest, file_path):
+        relative_path = path.relpath(file_path, self._symstore._path)
+        self._get_payloads()[digest] = relative_path
+
+        self._symstore._create_dirs()
+        with self._payloads_file("a") as pfile:
+            pfile.write("%s,%s\n" % (digest, relative_path))
+
+    def publish(self, source_file, dest_path):
+        """
+        store source_file at dest_path, linked to a stored copy of the same
+        contents if there is one
+        """
+        digest = fileio.file_digest(source_file)
+
+        with self._lock:
+            existing = self._find(digest, path.getsize(source_file))
+            if existing is not None:
+                if path.exists(dest_path) and \
+                        path.samefile(existing, dest_path):
+                    # already stored as this payload
+                    return
+                if fileio.link_file(existing, dest_path) is not None:
+                    return
+
+        with fileio.open_rb(source_file) as file:
+            fileio.write_opened_file(file, dest_path)
+
+        with self._lock:
+            if self._find(digest, path.getsize(dest_path)) is None:
+                self._add(digest, dest_path)
+
+    def _data_files(self):
+        """
+        the uncompressed files of the store, laid out as name/hash/name
+        """
+        for file_name in os.listdir(self._symstore._path):
+            if file_name == ADMIN_DIR:
+                continue
+            name_dir = path.join(self._symstore._path, file_name)
+            if not path.isdir(name_dir):
+                continue
+            for file_hash in os.listdir(name_dir):
+                file_path = path.join(name_dir, file_hash, file_name)
+                if path.isfile(file_path):
+                    yield file_path
+
+    def dedup(self):
+        """
+        link all files of the store with identical contents to one copy
+        and rebuild the index
+
+        Files hard linked to an already hashed file are not read again,
+        files already sharing the data of the kept copy are left as they
+        are. The size of a linked file counts as freed when it was the last
+        name of its data.
+
+        :return: (number of files linked, bytes freed)
+        """
+        linked = 0
+        freed = 0
+        payloads = {}
+        inode_digests = {}
+        for file_path in self._data_files():
+            stat = os.stat(file_path)
+            inode = (stat.st_dev, stat.st_ino)
+            digest = inode_digests.get(inode)
+            if digest is None:
+                digest = inode_digests[inode] = fileio.file_digest(file_path)
+
+            existing = payloads.setdefault(digest, file_path)
+            if existing == file_path or \
+                    fileio.shares_data(existing, file_path):
+                continue
+            if fileio.link_file(existing, file_path) is not None:
+                linked += 1
+                if stat.st_nlink == 1:
+                    freed += stat.st_size
+
+        with self._lock:
+            self._symstore._create_dirs()
+            with self._payloads_file("w") as pfile:
+                for digest, file_path in payloads.items():
+                    pfile.write("%s,%s\n" % (
+                        digest, path.relpath(file_path, self._symstore._path)))
+            self._payloads = None
+
+        return linked, freed
 
 
 class Store:
-    def __init__(self, store_path):
+    def __init__(self, store_path, compress_workers=None, codecs=None):
+        """
+        :param compress_workers: number of processes compressing files,
+                                 the number of CPUs by default
+        :param codecs: fast codecs of PublishMode.Encoded entries,
+                       extension (or "" for all files) -> codec, as parsed
+                       by symbolcodec.parse_codecs
+        """
         self._path = store_path
+        self.codecs = codecs or {}
+        self.compression = CompressionPool(compress_workers)
         self.transactions = Transactions(self)
         self.history = History(self)
+        self.payloads = Payloads(self)
 
     @property
     def modify_timestamp(self):
@@ -531,10 +1077,22 @@ class Store:
     def _history_file(self):
         return path.join(self._path, HISTORY_FILE)
 
+    @property
+    def _history_index_file(self):
+        return path.join(self._path, HISTORY_INDEX_FILE)
+
     @property
     def _server_file(self):
         return path.join(self._path, SERVER_FILE)
 
+    @property
+    def _server_index_file(self):
+        return path.join(self._path, SERVER_INDEX_FILE)
+
+    @property
+    def _payloads_file(self):
+        return path.join(self._path, PAYLOADS_FILE)
+
     @property
     def _pingme_file(self):
         return path.join(self._path, PINGME_FILE)
@@ -590,16 +1148,60 @@ class Store:
         self._write_transaction_id(next_transaction_id)
         self._touch_pingme(round(time.time()))
 
+    def close(self):
+        """
+        stop the compression processes
+        """
+        self.compression.shutdown()
+
+    def dedup(self):
+        """
+        link the files with identical contents of an existing store
+
+        :return: (number of files linked, bytes freed)
+        """
+        return self.payloads.dedup()
+
     def commit(self, transaction, executor: atg.Executor):
         self._create_dirs()
 
         now = round(time.time())
 
-        transaction.commit(self._next_transaction_id(),
-                           datetime.fromtimestamp(now), executor)
+        # the compression processes are only needed while the entries are
+        # published, the next commit starts them again
+        try:
+            transaction.commit(self._next_transaction_id(),
+                               datetime.fromtimestamp(now), executor)
+        finally:
+            self.compression.shutdown()
 
         self.transactions.add(transaction)
         self.history.add(transaction)
 
         self._write_transaction_id(transaction.id)
         self._touch_pingme(now)
+
+
+def main(argv=None):
+    """
+    store maintenance commands
+
+    :param argv: command line arguments, sys.argv[1:] if None
+    """
+    parser = argparse.ArgumentParser(description="Symbol store maintenance.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    dedup = commands.add_parser(
+        "dedup", help="Link the files with identical contents of a store "
+                      "to a single copy, as reflink clones where the "
+                      "filesystem supports them, hard links otherwise.")
+    dedup.add_argument("store", help="Path to the symbol store.")
+    args = parser.parse_args(argv)
+
+    if args.command == "dedup":
+        linked, freed = Store(args.store).dedup()
+        logging.info(f"Linked {linked} files, freed {freed} bytes")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    main()
@@ -1,14 +1,40 @@
 from time import sleep
-from zipfile import ZipFile
-from testserver import start_server
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+from artifactory import ArtifactoryPath
+from testserver import start_server, ArtifactoryStandIn
+import asyncio
+import asynctaskgraph as atg
+import asyncserver
+import errno
+import errs
+import hashlib
+import io
 import fileio
+import filereader
+import http.client
+import importlib.metadata
+import importlib.util
+import lookupcache
+import pdb
+import pe
+import socket
+import sqlite3
+import struct
+import threading
+import urllib.error
+import urllib.request
 import httpio
 import os
 import shutil
 import symboldb
+import symbolcodec
 import symbolhash
+import symbolindex
 import symbolpublisher
+import symbolserver
+import sys
 import tempfile
+import types
 
 
 def prepare_and_get_test_data_dir() -> str:
@@ -31,6 +57,39 @@ def prepare_and_get_test_data_dir() -> str:
     return test_data_dir
 
 
+def import_symstore():
+    """
+    Imports symstore.py the way it ships, as the symstore package's module. The package's own pe, pdb, cab
+    and errs are used with fileio and symbolcodec of this directory. Returns None if symstore is not installed.
+    """
+    try:
+        distribution = importlib.metadata.distribution("symstore")
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+    package = types.ModuleType("symstore")
+    package.__path__ = []
+    sys.modules["symstore"] = package
+
+    def add_module(name, module):
+        sys.modules["symstore." + name] = module
+        setattr(package, name, module)
+
+    def load_module(name, file_path):
+        spec = importlib.util.spec_from_file_location("symstore." + name, file_path)
+        module = importlib.util.module_from_spec(spec)
+        add_module(name, module)
+        spec.loader.exec_module(module)
+        return module
+
+    load_module("errs", distribution.locate_file("symstore/errs.py"))
+    add_module("fileio", fileio)
+    add_module("symbolcodec", symbolcodec)
+    for name in ["pe", "pdb", "cab"]:
+        load_module(name, distribution.locate_file(f"symstore/{name}.py"))
+    return load_module("symstore", os.path.join(os.path.dirname(os.path.abspath(__file__)), "symstore.py"))
+
+
 def fill_test_data():
     symboldb.store_symbol(
         symboldb.Symbol("DEADBEEF", "poo.exe", "http://example.com/poo.exe", None)
@@ -75,29 +134,897 @@ def hash_test(server_addr: str, path_fs: str):
             assert(hash == current_hash)
             print(f'{http_path}: {current_hash}')
 
+        # the test server serves only the first of multiple ranges, the stream pages take a request each
+        with filereader.RemoteReader(http_path) as reader:
+            assert(symbolhash.hash(reader) == hash)
+            assert(reader.requests == (5 if file.endswith('.pdb') else 1))
+            # a PE file takes a single range, multi-range requests are only tried for PDBs
+            assert(reader.multi_range == (not file.endswith('.pdb')))
+
+        # the stream's session and request arguments are reused
+        with httpio.open(http_path, 1024 * 1024 * 4, headers={'X-Test': '1'}) as f:
+            reader = filereader.open_reader(f)
+            assert(reader._session is f._session and reader._kwargs == {'headers': {'X-Test': '1'}})
+            assert(symbolhash.hash(reader) == hash)
+            reader.close()
+            assert(f.read(2) == fileio.read_all(os.path.join(path_fs, 'testdata', file), "rb")[:2])
+
         disk_path = os.path.join(path_fs, 'testdata', file)
         with fileio.open_rb(disk_path) as f:
             current_hash = symbolhash.hash(f)
             assert(hash == current_hash)
             print(f'{disk_path}: {current_hash}')
 
+        # in memory files can't be mapped, these go through seek and read
+        assert(symbolhash.hash(io.BytesIO(fileio.read_all(disk_path, "rb"))) == hash)
+
+
+def codeview_test(path_fs: str):
+    files_to_test = [
+        ('HelloWorld.exe', 'HelloWorld.pdb', '59442B4112F54557AE800C736F2B5DAD1'),
+        ('HelloDll.dll', 'HelloDll.pdb', '7BE215C28E704CFC85F579A7025B1C131'),
+    ]
+
+    for file, pdb_name, pdb_hash in files_to_test:
+        with fileio.open_rb(os.path.join(path_fs, 'testdata', file)) as f:
+            pe_file = pe.PEFile(f)
+            assert(pe_file.Machine == 0x8664)
+            codeview = pe_file.read_codeview()
+            assert(codeview.pdb_hash == pdb_hash)
+            assert(codeview.pdb_path.endswith(pdb_name))
+
+            with filereader.open_reader(f) as reader:
+                assert(isinstance(reader, filereader.MappedReader))
+                mapped_codeview = pe.PEFile(reader).read_codeview()
+                assert(mapped_codeview.pdb_hash == pdb_hash)
+                assert(mapped_codeview.pdb_path == codeview.pdb_path)
+
+
+def truncated_hash_test(path_fs: str):
+    assert(symbolhash.hash(io.BytesIO(b'not a symbol file')) is None)
+    assert(symbolhash.hash(io.BytesIO(b'')) is None)
+
+    for file, size in [('HelloWorld.exe', 64), ('HelloWorld.exe', 300), ('HelloWorld.pdb', 40), ('HelloWorld.pdb', 4096)]:
+        data = fileio.read_all(os.path.join(path_fs, 'testdata', file), "rb")[:size]
+        try:
+            symbolhash.hash(io.BytesIO(data))
+            assert(False)
+        except errs.FileFormatError as e:
+            print(f'{file} truncated to {size} bytes: {e}')
+
+
+def pdb_root_test():
+    # synthetic MSF file with thousands of streams, root pages are not contiguous
+    page_size = 512
+    sizes = [(i * 37) % 2000 for i in range(3000)]
+    sizes[5] = pdb.NIL_STREAM_SIZE
+    stream_pages = []
+    next_page = 1000
+    for size in sizes:
+        count = 0 if size == pdb.NIL_STREAM_SIZE else pdb.pages(size, page_size)
+        stream_pages.append(list(range(next_page, next_page + count)))
+        next_page += count
+    root = struct.pack(f'<I{len(sizes)}I', len(sizes), *sizes)
+    root += b''.join(struct.pack(f'<{len(p)}I', *p) for p in stream_pages)
+    root_pages = [2 + 2 * i for i in range(pdb.pages(len(root), page_size))]
 
-def test():
-    symboldb.init_db(":memory:")
+    data = bytearray((root_pages[-1] + 1) * page_size)
+    data[:pdb.HEADER_SIZE + 4] = pdb.SIGNATURE + struct.pack('<IIIIII', page_size, 0, 0, len(root), 0, 1)
+    data[page_size:page_size + 4 * len(root_pages)] = struct.pack(f'<{len(root_pages)}I', *root_pages)
+    for idx, page in enumerate(root_pages):
+        chunk = root[idx * page_size:(idx + 1) * page_size]
+        data[page * page_size:page * page_size + len(chunk)] = chunk
+
+    root = pdb.Root(io.BytesIO(bytes(data)), page_size, len(root))
+    assert(root.num_streams() == len(sizes))
+    assert(root.stream_size(5) == 0 and len(root.stream_pages(5)) == 0)
+    for idx in (0, 1, 6, 1234, len(sizes) - 1):
+        assert(list(root.stream_pages(idx)) == stream_pages[idx])
+        assert(root.stream_size(idx) == sizes[idx])
+    try:
+        root.stream_pages(len(sizes))
+        assert(False)
+    except pdb.PDBFormatError:
+        pass
+
+
+def test(db_path: str):
+    symboldb.init_db(db_path)
     fill_test_data()
     print(symboldb.find_symbol("FEEdBABE", "foo.pd_"))
+    assert(symboldb.find_symbol_exact("FEEDBABE", "foo.pd_").url == "http://example.com/foo.pdb")
+    assert(symboldb.find_symbol_exact("FEEDBABE", "boo.dll").store_path == "stored/FEEDBABE/boo.dll")
+    assert(symboldb.find_symbol_exact("FEEDBABE", "poo.exe") is None)
+    # SymSrv clients vary the case of hashes and filenames
+    assert(symboldb.find_symbol_exact("feedbabe", "BOO.DLL").filename == "boo.dll")
+    symboldb.store_symbol(symboldb.Symbol("feedbabe", "Boo.dll", None, "stored/FEEDBABE/Boo.dll"))
+    assert(symboldb.SymbolModel.select().where(symboldb.SymbolModel.hash == "FEEDBABE").count() == 2)
+    assert(symboldb.find_symbol_exact("FEEDBABE", "boo.dll").store_path == "stored/FEEDBABE/Boo.dll")
     print(symboldb.dump())
     pass
 
 
+def crawl_state_test():
+    state = symbolpublisher.ArtifactoryDatabase(commit_every=2)
+    params = symbolpublisher.Params([], '', False, 1, False, True, False)
+    loaded = 'http://artifactory.example.com/repo/loaded.zip'
+    failed = 'http://artifactory.example.com/repo/failed.zip'
+    assert(state.should_publish(state.find(loaded), params))
+
+    state.record(symboldb.Source(loaded, True, 0))
+    assert(state.find(loaded) is None) # buffered until commit_every records
+    state.record(symboldb.Source(failed, False, 1))
+    assert(state.find(loaded) == symboldb.Source(loaded, True, 0))
+    assert(not state.should_publish(state.find(loaded), params))
+
+    assert(state.should_publish(state.find(failed), params))
+    assert(not state.should_publish(state.find(failed), params._replace(skip_last_errors=True)))
+
+
+def migration_test(db_path: str):
+    # database created before the (hash, filename) unique index, with duplicate rows
+    with sqlite3.connect(db_path) as db:
+        db.execute('CREATE TABLE "symbolmodel" ("id" INTEGER NOT NULL PRIMARY KEY, "hash" VARCHAR(255) NOT NULL, '
+                   '"filename" VARCHAR(255) NOT NULL, "url" VARCHAR(255) NOT NULL, "store_path" VARCHAR(255) NOT NULL)')
+        db.execute('CREATE INDEX "symbolmodel_hash" ON "symbolmodel" ("hash")')
+        db.executemany('INSERT INTO symbolmodel (hash, filename, url, store_path) VALUES (?, ?, ?, ?)', [
+            ("FEEDBABE", "foo.pdb", "old", ""),
+            ("FEEDBABE", "foo.pdb", "new", ""),
+            ("FEEDBABE", "boo.dll", "boo", ""),
+            ("0DDBA11", "Bar.pdb", "old", ""),
+            ("0ddba11", "bar.PDB", "new", ""),
+        ])
+        db.execute('CREATE TABLE "sourcemodel" ("id" INTEGER NOT NULL PRIMARY KEY, "path" VARCHAR(255) NOT NULL, '
+                   '"loaded" INTEGER NOT NULL, "failure_count" INTEGER NOT NULL)')
+        db.execute('CREATE INDEX "sourcemodel_path" ON "sourcemodel" ("path")')
+        db.executemany('INSERT INTO sourcemodel (path, loaded, failure_count) VALUES (?, ?, ?)', [
+            ("C:\\foo.pdb", 0, 1),
+            ("C:\\foo.pdb", 1, 1),
+        ])
+    db.close()
+
+    symboldb.init_db(db_path)
+    assert(symboldb.find_symbol_exact("FEEDBABE", "foo.pdb").url == "new")
+    assert(symboldb.find_symbol_exact("FEEDBABE", "boo.dll").url == "boo")
+    # rows differing in case only are merged, the latest one is kept
+    assert(symboldb.find_symbol_exact("0DDBA11", "BAR.pdb").url == "new")
+    assert(symboldb.SymbolModel.select().count() == 3)
+    plan = symboldb.database_proxy.execute_sql(
+        "EXPLAIN QUERY PLAN SELECT * FROM symbolmodel WHERE hash = 'feedbabe' AND filename = 'FOO.pdb'").fetchall()
+    assert("symbolmodel_hash_filename" in str(plan))
+    assert(symboldb.SourceModel.get(symboldb.SourceModel.path == "C:\\foo.pdb").loaded)
+    assert(symboldb.SourceModel.select().count() == 1)
+    assert(symboldb.find_source("C:\\foo.pdb") == symboldb.Source("C:\\foo.pdb", True, 1))
+
+
+def profile_test(db_path: str):
+    symboldb.init_db(db_path, "production")
+    assert(symboldb.database_proxy.execute_sql("PRAGMA journal_mode").fetchone()[0] == "wal")
+    symboldb.store_symbol(symboldb.Symbol("0000CAFE", "wal.dll", None, "stored/0000CAFE/wal.dll"))
+
+    # a lookup from another thread doesn't wait for an open write transaction
+    writing = threading.Event()
+    done = threading.Event()
+    def write():
+        with symboldb.write_lock, symboldb.database_proxy.atomic():
+            symboldb.SymbolModel.create(hash="0001CAFE", filename="wal.dll", url="", store_path="")
+            writing.set()
+            done.wait(10)
+        symboldb.database_proxy.close()
+    writer = threading.Thread(target=write)
+    writer.start()
+    writing.wait(10)
+    assert(symboldb.find_symbol_exact("0000CAFE", "wal.dll") is not None)
+    assert(symboldb.find_symbol_exact("0001CAFE", "wal.dll") is None)
+    done.set()
+    writer.join()
+    assert(symboldb.find_symbol_exact("0001CAFE", "wal.dll") is not None)
+
+
+def bulk_test():
+    symbols = [symboldb.Symbol("%08X" % i, "bulk%d.dll" % (i % 7), None, "stored/%d" % i) for i in range(2500)]
+    assert(symboldb.store_symbols(symbols, 1000) == 2500)
+    # upserts, the last value wins
+    symboldb.store_symbols([symbols[0]._replace(store_path="updated"), symbols[0]._replace(store_path="updated twice")])
+    assert(symboldb.find_symbol_exact(symbols[0].hash, symbols[0].filename).store_path == "updated twice")
+    assert(symboldb.SymbolModel.select().where(symboldb.SymbolModel.filename.startswith("bulk")).count() == 2500)
+
+    buffer = symboldb.SymbolBuffer(2)
+    buffer.add(symboldb.Symbol("0000BEEF", "buffered.dll", None, "stored/0000BEEF"))
+    assert(buffer.find("0000BEEF", "buffered.dll") is not None)
+    assert(symboldb.find_symbol_exact("0000BEEF", "buffered.dll") is None)
+    buffer.add(symboldb.Symbol("0001BEEF", "buffered.dll", None, "stored/0001BEEF"))
+    assert(symboldb.find_symbol_exact("0000BEEF", "buffered.dll") is not None)
+    assert(buffer.find("0000BEEF", "buffered.dll") is None)
+
+    symboldb.store_sources([symboldb.Source("C:\\bulk.pdb", False, 1), symboldb.Source("C:\\bulk.pdb", True, 1)])
+    assert(symboldb.SourceModel.get(symboldb.SourceModel.path == "C:\\bulk.pdb").loaded)
+
+
+def index_test(index_path: str):
+    count = symbolindex.export(index_path)
+    assert(count == symboldb.SymbolModel.select().count())
+    # readable by servers of other users as the umask allows
+    umask = os.umask(0)
+    os.umask(umask)
+    assert(os.stat(index_path).st_mode & 0o777 == 0o666 & ~umask)
+
+    live_index = symbolindex.LiveSymbolIndex(index_path, check_interval=0)
+    for symbol in symboldb.SymbolModel.select():
+        found = live_index.find(symbol.hash, symbol.filename)
+        assert(found == symboldb.find_symbol_exact(symbol.hash, symbol.filename))
+    assert(live_index.find("FEEDBABE", "missing.dll") is None)
+    assert(live_index.find("00000000", "bulk0.dll") is not None)
+    assert(live_index.find("0", "bulk0.dll") is None)
+    # hashes and filenames match regardless of case, as in the DB
+    assert(live_index.find("feedbabe", "FOO.PD_").store_path == "stored/FEEDBABE/foo.pd_")
+
+    # a new export is picked up by the live index
+    symboldb.store_symbol(symboldb.Symbol("0000D00D", "exported.dll", None, "stored/0000D00D/exported.dll"))
+    assert(live_index.find("0000D00D", "exported.dll") is None)
+    symbolindex.export(index_path)
+    assert(live_index.find("0000D00D", "exported.dll").store_path == "stored/0000D00D/exported.dll")
+
+
+def lookup_cache_test():
+    now = [0.0]
+    cache = lookupcache.LookupCache(8, negative_ttl=10.0, negative_share=0.25, positive_ttl=100.0, clock=lambda: now[0])
+
+    assert(cache.get('a') is lookupcache.MISSING)
+    cache.put('a', 'A')
+    assert(cache.get('a') == 'A')
+
+    # misses only get their share of the cache and expire
+    for key in range(4):
+        cache.put(key, None)
+    assert(cache.stats().negative_size == 2)
+    assert(cache.get(3) is None)
+    now[0] = 11.0
+    assert(cache.get(3) is lookupcache.MISSING)
+
+    # a result looked up before an invalidation is not cached
+    generation = cache.generation
+    cache.invalidate('a')
+    cache.put('b', 'B', generation)
+    assert(cache.get('a') is lookupcache.MISSING and cache.get('b') is lookupcache.MISSING)
+
+    stats = cache.stats()
+    assert(stats.hits == 1 and stats.negative_hits == 1 and stats.evictions == 2 and stats.expirations == 1)
+
+    # found results expire as well, changes by other processes never invalidate them
+    cache.put('c', 'C')
+    now[0] = 110.0
+    assert(cache.get('c') == 'C')
+    now[0] = 112.0
+    assert(cache.get('c') is lookupcache.MISSING)
+    assert(cache.stats().expirations == 2)
+
+    # publishing makes a cached miss visible right away
+    symboldb.enable_lookup_cache(16)
+    assert(symboldb.find_symbol_exact("0BADF00D", "new.dll") is None)
+    symboldb.store_symbol(symboldb.Symbol("0BADF00D", "new.dll", None, "stored/0BADF00D/new.dll"))
+    assert(symboldb.find_symbol_exact("0BADF00D", "new.dll").store_path == "stored/0BADF00D/new.dll")
+    assert(symboldb.find_symbol_exact("0badf00d", "NEW.dll").store_path == "stored/0BADF00D/new.dll")
+    print(symboldb.lookup_cache_stats())
+    symboldb.disable_lookup_cache()
+
+
+def range_test(server_addr: str, path: str, expected: bytes):
+    def get(range):
+        request = urllib.request.Request(server_addr + path, headers={'Range': range})
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.headers, response.read()
+
+    status, _, body = get('bytes=2-9')
+    assert(status == 206 and body == expected[2:10])
+
+    status, _, body = get('bytes=-16')
+    assert(status == 206 and body == expected[-16:])
+
+    status, headers, body = get('bytes=0-1,100-199')
+    assert(status == 206)
+    assert(headers['Content-Type'].startswith('multipart/byteranges'))
+    assert(int(headers['Content-Length']) == len(body))
+    assert(expected[0:2] in body and expected[100:200] in body)
+
+    try:
+        get(f'bytes={len(expected)}-')
+        assert(False)
+    except urllib.error.HTTPError as e:
+        assert(e.code == 416)
+
+    with filereader.RemoteReader(server_addr + path, block_size=1024, merge_gap=0) as reader:
+        reader.prefetch([(0, 10), (5000, 100), (len(expected) - 10, 10)])
+        assert(reader.requests == 1 and reader.multi_range and reader.size == len(expected))
+        assert(reader.read_at(5000, 100) == expected[5000:5100])
+        assert(reader.read_at(len(expected) - 10, 100) == expected[-10:])
+        assert(reader.read_at(len(expected), 10) == b'')
+        assert(reader.requests == 1)
+
+
+def atomic_write_test(path_fs: str, symstore_dir: str):
+    directory = tempfile.mkdtemp(dir=symstore_dir)
+    source = os.path.join(path_fs, 'testdata', 'HelloWorld.pdb')
+    expected = fileio.read_all(source, "rb")
+
+    # regular file, copied by the kernel, over an existing file
+    target = os.path.join(directory, 'HelloWorld.pdb')
+    with open(target, 'wb') as f:
+        f.write(b'stale')
+    with open(source, 'rb') as f:
+        assert(fileio.write_opened_file(f, target) is None)
+    assert(fileio.read_all(target, "rb") == expected)
+
+    # an in-memory spool is copied through the buffer, not written to disk for the kernel copy
+    with tempfile.SpooledTemporaryFile(len(expected) + 1) as spool:
+        spool.write(expected)
+        spool.seek(0)
+        fileio.write_opened_file(spool, target)
+        assert(not spool._rolled)
+    assert(fileio.read_all(target, "rb") == expected)
+
+    # checksum computed while copying
+    target = os.path.join(directory, 'copy.pdb')
+    digest = fileio.write_opened_file(io.BytesIO(expected), target, 'sha1')
+    assert(digest == hashlib.sha1(expected).hexdigest())
+    assert(fileio.read_all(target, "rb") == expected)
+
+    # a failed copy leaves neither the file nor the temporary file
+    class Failing(io.BytesIO):
+        def read(self, size=-1):
+            if self.tell() > 0:
+                raise IOError(errno.EIO, 'read error')
+            return super().read(size)
+    try:
+        fileio.write_opened_file(Failing(expected), os.path.join(directory, 'failed.pdb'))
+        assert(False)
+    except IOError:
+        pass
+    assert(sorted(os.listdir(directory)) == ['HelloWorld.pdb', 'copy.pdb'])
+
+    # the copy shares the data of the first file, a failed link keeps it as it is
+    assert(fileio.file_digest(target) == digest)
+    assert(fileio.link_file(os.path.join(directory, 'HelloWorld.pdb'), target) in ('reflink', 'hardlink'))
+    assert(fileio.read_all(target, "rb") == expected)
+    assert(sorted(os.listdir(directory)) == ['HelloWorld.pdb', 'copy.pdb'])
+
+
+def symstore_commit(store, file: str, mode):
+    transaction = store.new_transaction("test", "1")
+    transaction.add_file(file, mode, "http://localhost/" + os.path.basename(file))
+    with atg.Executor(2) as executor:
+        store.commit(transaction, executor)
+    entry = transaction.entries[0]
+    return transaction, os.path.join(store._path, entry.file_name, entry.file_hash, entry.file_name)
+
+
+def symstore_payloads_test(symstore, path_fs: str, symstore_dir: str):
+    directory = tempfile.mkdtemp(dir=symstore_dir)
+    store_path = os.path.join(directory, 'store')
+    source = os.path.join(path_fs, 'testdata', 'HelloWorld.pdb')
+    expected = fileio.read_all(source, "rb")
+    copies = {}
+    for name in ['Other.pdb', 'Third.pdb', 'Fourth.pdb', 'Fifth.pdb']:
+        copies[name] = os.path.join(directory, name)
+        shutil.copyfile(source, copies[name])
+
+    # hard linked copies are the same file, reflinked copies only have the same contents
+    probe = os.path.join(directory, 'probe.pdb')
+    hardlinks = fileio.link_file(source, probe) == 'hardlink'
+    os.remove(probe)
+    def shares_data(a: str, b: str) -> bool:
+        return fileio.read_all(a, "rb") == fileio.read_all(b, "rb") and (not hardlinks or os.path.samefile(a, b))
+
+    store = symstore.Store(store_path)
+    first, hello_world = symstore_commit(store, source, symstore.PublishMode.Raw)
+    _, other = symstore_commit(store, copies['Other.pdb'], symstore.PublishMode.Raw)
+    assert(shares_data(hello_world, other))
+
+    # a link file replaces the linked payload, it must not write through the link
+    symstore_commit(store, copies['Other.pdb'], symstore.PublishMode.Link)
+    assert(fileio.read_all(other, "rb") == b'http://localhost/Other.pdb')
+    assert(fileio.read_all(hello_world, "rb") == expected)
+
+    # the indexed copy is deleted, the next copy is indexed and found after a restart
+    store.delete_transaction(first.id)
+    assert(not os.path.exists(hello_world))
+    _, third = symstore_commit(store, copies['Third.pdb'], symstore.PublishMode.Raw)
+    store = symstore.Store(store_path)
+    _, fourth = symstore_commit(store, copies['Fourth.pdb'], symstore.PublishMode.Raw)
+    assert(shares_data(third, fourth))
+
+    # dedup links copies stored without the index, from the store and from the command line
+    os.remove(store._payloads_file)
+    store = symstore.Store(store_path)
+    _, fifth = symstore_commit(store, copies['Fifth.pdb'], symstore.PublishMode.Raw)
+    assert(not hardlinks or not os.path.samefile(third, fifth))
+    linked, freed = store.dedup()
+    assert(linked == 1 and freed == len(expected))
+    assert(shares_data(third, fifth) and shares_data(fourth, fifth))
+    assert(store.dedup() == (0, 0))
+
+    shutil.copyfile(source, fifth + '.copy')
+    os.replace(fifth + '.copy', fifth)
+    symstore.main(['dedup', store_path])
+    assert(shares_data(third, fifth))
+    assert(fileio.read_all(fifth, "rb") == expected)
+
+    # a copy also linked from outside the store keeps its data, it is linked but frees nothing
+    outside = os.path.join(directory, 'outside.pdb')
+    shutil.copyfile(source, outside)
+    os.remove(fifth)
+    os.link(outside, fifth)
+    assert(symstore.Store(store_path).dedup() == (1, 0))
+    assert(symstore.Store(store_path).dedup() == (0, 0))
+    assert(fileio.shares_data(third, fifth) and not fileio.shares_data(outside, fifth))
+
+
+def symstore_transactions_test(symstore, path_fs: str, symstore_dir: str):
+    store_path = os.path.join(tempfile.mkdtemp(dir=symstore_dir), 'store')
+    source = os.path.join(path_fs, 'testdata', 'HelloWorld.pdb')
+    store = symstore.Store(store_path)
+    ids = [symstore_commit(store, source, symstore.PublishMode.Raw)[0].id for _ in range(4)]
+    assert(ids == ['%010d' % i for i in range(1, 5)])
+
+    # lookups through the persisted index of a reopened store
+    store = symstore.Store(store_path)
+    assert(store.transactions.find('0000000003').id == '0000000003')
+    assert(store.transactions.find(99) is None)
+    assert(len(store.history) == 4 and store.history[-1].id == ids[-1])
+    assert([t.id for t in store.history[1:3]] == ids[1:3])
+
+    # adding a transaction appends its record to the index file in place
+    index_file = os.path.join(store_path, '000Admin', 'server.idx')
+    index_stat = os.stat(index_file)
+    added, _ = symstore_commit(store, source, symstore.PublishMode.Raw)
+    assert(os.stat(index_file).st_ino == index_stat.st_ino)
+    assert(os.path.getsize(index_file) == index_stat.st_size + symstore.TransactionIndex.RECORD.size)
+    store.delete_transaction(added.id)
+    store = symstore.Store(store_path)
+    ids.append(added.id)
+
+    # server.txt is closed before the new one replaces it, Windows can't replace open files
+    replace = os.replace
+    def checked_replace(src, dst):
+        if os.path.basename(dst) == 'server.txt' and os.path.isdir('/proc/self/fd'):
+            for fd in os.listdir('/proc/self/fd'):
+                try:
+                    assert(os.readlink(os.path.join('/proc/self/fd', fd)) != os.path.abspath(dst))
+                except OSError:
+                    pass
+        replace(src, dst)
+    os.replace = checked_replace
+    try:
+        store.delete_transaction(ids[1])
+    finally:
+        os.replace = replace
+    store = symstore.Store(store_path)
+    assert(store.transactions.find(ids[1]) is None)
+    assert([id for id, _ in store.transactions.items()] == [ids[0], ids[2], ids[3]])
+    assert([t.id for t in store.history] == ids + ['0000000006', '0000000007'])
+    assert(store.history[-1].type == 'del' and store.history[-1].deleted_id == ids[1])
+
+    # another tool replaces a line keeping the size and the modification time of server.txt,
+    # the lines read through the stale index are of other transactions
+    server_file = os.path.join(store_path, '000Admin', 'server.txt')
+    stat = os.stat(server_file)
+    with open(server_file, 'rb') as f:
+        lines = f.readlines()
+    lines = [lines[0], lines[2], lines[1].replace(ids[2].encode(), b'0000000006', 1)]
+    with open(server_file, 'wb') as f:
+        f.writelines(lines)
+    os.utime(server_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert(os.path.getsize(server_file) == stat.st_size)
+
+    assert(store.transactions.find(ids[2]) is None)
+    assert(store.transactions.find(ids[3]).id == ids[3])
+    assert(store.transactions.find('0000000006').id == '0000000006')
+
+    # appends after an external change index the whole file
+    with open(server_file, 'wb') as f:
+        f.writelines(lines[:2])
+    added, _ = symstore_commit(store, source, symstore.PublishMode.Raw)
+    store = symstore.Store(store_path)
+    assert([id for id, _ in store.transactions.items()] == [ids[0], ids[3], added.id])
+    assert(store.transactions.find(added.id).id == added.id)
+
+
+def symstore_compress_test(symstore, path_fs: str, symstore_dir: str):
+    if symstore.cab.compress is None:
+        print('cab compression skipped, no cab compressor is available')
+        return
+
+    store = symstore.Store(os.path.join(tempfile.mkdtemp(dir=symstore_dir), 'store'), compress_workers=1)
+    source = os.path.join(path_fs, 'testdata', 'HelloWorld.pdb')
+    _, stored = symstore_commit(store, source, symstore.PublishMode.Compressed)
+    compressed = stored[:-1] + '_'
+    assert(os.path.isfile(compressed) and not os.path.exists(stored))
+    with open(compressed, 'rb') as f:
+        assert(f.read(4) == b'MSCF')
+    # the worker processes are stopped with the commit
+    assert(store.compression._executor is None)
+
+
+def remote_publish_test(server_addr: str, path_fs: str, symstore_dir: str):
+    url = server_addr + '/testdata/HelloWorld.pdb'
+    params = symbolpublisher.Params([], symstore_dir, False, 1, False, False, False)
+    symbol = symbolpublisher.deploy_remote_file('HelloWorld.pdb', url, params)
+    assert(symbol.hash == '59442B4112F54557AE800C736F2B5DAD1')
+    assert(fileio.read_all(symbol.store_path, "rb") == fileio.read_all(os.path.join(path_fs, 'testdata', 'HelloWorld.pdb'), "rb"))
+
+    # already stored, only the headers are read
+    assert(symbolpublisher.deploy_remote_file('HelloWorld.pdb', url, params) is None)
+
+    url = server_addr + '/testdata/HelloDll.pdb'
+    params = symbolpublisher.Params([], symstore_dir, False, 1, True, False, False)
+    symbolpublisher.publish_path(url, params)
+    assert(symboldb.find_symbol_exact('7BE215C28E704CFC85F579A7025B1C131', 'HelloDll.pdb').url == url)
+
+
+def zip_publish_test(server_addr: str, path_fs: str, symstore_dir: str):
+    testdata = os.path.join(path_fs, 'testdata')
+    with ZipFile(os.path.join(testdata, 'symbols.nupkg'), 'w') as archive:
+        archive.write(os.path.join(testdata, 'HelloWorld.exe'), 'lib/HelloWorld.exe', compress_type=ZIP_STORED)
+        archive.write(os.path.join(testdata, 'HelloWorld.pdb'), 'lib/HelloWorld.pdb', compress_type=ZIP_STORED)
+        archive.write(os.path.join(testdata, 'HelloDll.pdb'), 'lib/HelloDll.pdb', compress_type=ZIP_DEFLATED)
+        archive.write(os.path.join(testdata, 'HelloDll.pdb'), 'lib/net6.0/HelloDll.pdb', compress_type=ZIP_DEFLATED)
+        archive.write(os.path.join(testdata, 'HelloDll.dll'), 'excluded/HelloDll.dll', compress_type=ZIP_DEFLATED)
+        archive.writestr('readme.txt', 'not a symbol file')
+        archive.writestr('lib/Broken.dll', 'not a PE file')
+
+    # overwrite, the test data is already published from other tests
+    sources = [
+        (os.path.join(testdata, 'symbols.nupkg'), 4, 256 * 1024 * 1024),
+        (server_addr + '/testdata/symbols.nupkg', 2, 1024), # every member needs the whole budget
+        (server_addr + '/testdata/symbols.nupkg', 1, 1024 * 1024),
+    ]
+    for source, workers, memory in sources:
+        store_path = tempfile.mkdtemp(dir=symstore_dir)
+        params = symbolpublisher.Params(['excluded/'], store_path, False, 1, False, False, True, workers, memory)
+        symbolpublisher.publish_path(source, params)
+        assert(sorted(os.listdir(store_path)) == ['HelloDll.pdb', 'HelloWorld.exe', 'HelloWorld.pdb'])
+        for file, hash in [('HelloDll.pdb', '7BE215C28E704CFC85F579A7025B1C131'), ('HelloWorld.exe', '62A0EB958000'),
+                           ('HelloWorld.pdb', '59442B4112F54557AE800C736F2B5DAD1')]:
+            stored = os.path.join(store_path, file, hash, file)
+            assert(symboldb.find_symbol_exact(hash, file).store_path == stored)
+            assert(fileio.read_all(stored, "rb") == fileio.read_all(os.path.join(testdata, file), "rb"))
+        print(f'{source} with {workers} workers: OK')
+
+    # the budget counts the block cache of remote handles and the spool of compressed members
+    idle, busy = symbolpublisher.archive_buffer_sizes(server_addr + '/testdata/symbols.nupkg')
+    assert(busy == symbolpublisher.ARCHIVE_CACHE_BLOCKS * symbolpublisher.ARCHIVE_BLOCK_SIZE)
+    assert(idle == symbolpublisher.ARCHIVE_READ_BUFFER)
+    assert(symbolpublisher.archive_buffer_sizes(os.path.join(testdata, 'symbols.nupkg'))[1] == 0)
+    with ZipFile(os.path.join(testdata, 'symbols.nupkg')) as archive:
+        stored, compressed = archive.getinfo('lib/HelloWorld.pdb'), archive.getinfo('lib/HelloDll.pdb')
+        assert(symbolpublisher.member_buffer_size(stored) == fileio.COPY_BUFFER_SIZE)
+        assert(symbolpublisher.member_buffer_size(compressed) >= fileio.COPY_BUFFER_SIZE + compressed.file_size)
+
+    # compressed members are decompressed once, the reader never seeks back in them
+    class ForwardOnly(io.RawIOBase):
+        def __init__(self, f):
+            self.f = f
+        def readable(self):
+            return True
+        def readinto(self, b):
+            data = self.f.read(len(b))
+            b[:len(data)] = data
+            return len(data)
+    expected = fileio.read_all(os.path.join(testdata, 'HelloDll.pdb'), "rb")
+    with ZipFile(os.path.join(testdata, 'symbols.nupkg')) as archive, archive.open('lib/HelloDll.pdb') as member:
+        with filereader.SpoolReader(ForwardOnly(member), len(expected), spool_memory=16 * 1024) as reader:
+            assert(symbolhash.hash(reader) == '7BE215C28E704CFC85F579A7025B1C131')
+            assert(reader.spooled_file().read() == expected)
+
+
+def artifactory_crawl_test(path_fs: str, symstore_dir: str):
+    host_path = tempfile.mkdtemp(dir=symstore_dir)
+    repo = os.path.join(host_path, 'artifactory', 'repo')
+    for folder, file in [('exe', 'HelloWorld.exe'), ('pdb', 'HelloWorld.pdb'), ('a/b', 'HelloWorld.exe')]:
+        os.makedirs(os.path.join(repo, folder))
+        shutil.copyfile(os.path.join(path_fs, 'testdata', file), os.path.join(repo, folder, file))
+    with open(os.path.join(repo, 'readme.txt'), 'w') as readme:
+        readme.write('not a symbol file')
+
+    server = ArtifactoryStandIn(host_path)
+    try:
+        params = symbolpublisher.Params([], tempfile.mkdtemp(dir=symstore_dir), False, 2, True, True, False)
+        storage = '/artifactory/api/storage/repo'
+
+        symbolpublisher.publish_artifactory(server.url + '/repo', params)
+        folders = [storage, storage + '/a', storage + '/a/b', storage + '/exe', storage + '/pdb']
+        assert(sorted(path for path in server.requests if path.startswith(storage)) == folders)
+        exe = symboldb.find_source(server.url + '/repo/exe/HelloWorld.exe')
+        assert(exe.stored and exe.failures == 0 and exe.size == os.path.getsize(os.path.join(repo, 'exe', 'HelloWorld.exe')))
+        assert(len(exe.sha1) == 40)
+        assert(symboldb.find_source(server.url + '/repo/a/b/HelloWorld.exe').stored)
+
+        # nothing changed, the folders are listed but no artifact is fetched
+        server.requests.clear()
+        symbolpublisher.publish_artifactory(server.url + '/repo', params)
+        assert(sorted(server.requests) == folders)
+
+        # only the new files are fetched, also when only a deeper descendant of a folder changed
+        server.requests.clear()
+        shutil.copyfile(os.path.join(path_fs, 'testdata', 'HelloDll.pdb'), os.path.join(repo, 'pdb', 'HelloDll.pdb'))
+        shutil.copyfile(os.path.join(path_fs, 'testdata', 'HelloWorld.pdb'), os.path.join(repo, 'a', 'b', 'HelloWorld.pdb'))
+        symbolpublisher.publish_artifactory(server.url + '/repo', params)
+        assert(sorted(set(server.requests)) == sorted(folders + ['/artifactory/repo/a/b/HelloWorld.pdb', '/artifactory/repo/pdb/HelloDll.pdb']))
+        assert(symboldb.find_source(server.url + '/repo/pdb/HelloDll.pdb').stored)
+        assert(symboldb.find_source(server.url + '/repo/a/b/HelloWorld.pdb').stored)
+    finally:
+        server.close()
+
+
+def artifactory_aql_test(path_fs: str, symstore_dir: str):
+    host_path = tempfile.mkdtemp(dir=symstore_dir)
+    repo = os.path.join(host_path, 'artifactory', 'repo')
+    for folder, file, name in [('a/b', 'HelloWorld.exe', 'HelloWorld.exe'), ('', 'HelloWorld.pdb', 'HelloWorld.pdb'),
+                               ('excluded', 'HelloDll.pdb', 'HelloDll.pdb'), ('c', 'HelloDll.pdb', 'HelloDll.Pdb')]:
+        os.makedirs(os.path.join(repo, folder), exist_ok=True)
+        shutil.copyfile(os.path.join(path_fs, 'testdata', file), os.path.join(repo, folder, name))
+    with open(os.path.join(repo, 'a', 'readme.txt'), 'w') as readme:
+        readme.write('not a symbol file')
+
+    server = ArtifactoryStandIn(host_path)
+    try:
+        aql = '/artifactory/api/search/aql'
+        found = [str(entry.path) for entry in symbolpublisher.artifactory_search(ArtifactoryPath(server.url + '/repo'), page_size=1)]
+        # names are matched in any case
+        assert(found == [server.url + '/repo/HelloWorld.pdb', server.url + '/repo/a/b/HelloWorld.exe', server.url + '/repo/c/HelloDll.Pdb',
+                         server.url + '/repo/excluded/HelloDll.pdb'])
+        assert(server.requests == [aql] * 5) # the last page is empty
+
+        found = list(symbolpublisher.artifactory_search(ArtifactoryPath(server.url + '/repo/a')))
+        assert([str(entry.path) for entry in found] == [server.url + '/repo/a/b/HelloWorld.exe'])
+        assert(found[0].size == os.path.getsize(os.path.join(repo, 'a', 'b', 'HelloWorld.exe')) and len(found[0].sha1) == 40)
+
+        server.requests.clear()
+        # more deploy workers than connections, they wait for the shared connection
+        params = symbolpublisher.Params(['excluded/'], tempfile.mkdtemp(dir=symstore_dir), False, 2, True, True, False, aql=True,
+                                        deploy_workers=4, host_connections=1)
+        symbolpublisher.publish_artifactory(server.url + '/repo', params)
+        assert(not any(path.startswith('/artifactory/api/storage') for path in server.requests))
+        assert(symboldb.find_source(server.url + '/repo/a/b/HelloWorld.exe').stored)
+        assert(symboldb.find_source(server.url + '/repo/HelloWorld.pdb').stored)
+        assert(symboldb.find_source(server.url + '/repo/c/HelloDll.Pdb').stored)
+        assert(symboldb.find_source(server.url + '/repo/excluded/HelloDll.pdb') is None)
+
+        # unchanged artifacts are not fetched again
+        server.requests.clear()
+        symbolpublisher.publish_artifactory(server.url + '/repo', params)
+        assert(server.requests == [aql])
+
+        # resizing the pool closes the connections of the previous one
+        adapter = symbolpublisher.http_pool.adapter
+        assert(len(adapter.poolmanager.pools) > 0)
+        symbolpublisher.http_pool.resize(params.host_connections + 1)
+        assert(len(adapter.poolmanager.pools) == 0 and symbolpublisher.http_pool.adapter is not adapter)
+    finally:
+        server.close()
+
+
+def codec_test(path_fs: str, symstore_dir: str):
+    expected = fileio.read_all(os.path.join(path_fs, 'testdata', 'HelloWorld.pdb'), "rb")
+    for codec in symbolcodec.CODECS.values():
+        if not codec.available:
+            print(f'{codec.name} codec skipped, {codec.package} is not installed')
+            continue
+        compressed = io.BytesIO()
+        codec.compress_stream(io.BytesIO(expected), compressed)
+        assert(len(compressed.getvalue()) < len(expected))
+        with codec.open_decompressed(io.BytesIO(compressed.getvalue())) as decompressed:
+            assert(decompressed.read() == expected)
+
+    codecs = symbolcodec.parse_codecs('pdb=gzip')
+    assert(symbolcodec.choose_codec(codecs, 'HelloWorld.PDB').name == 'gzip')
+    assert(symbolcodec.choose_codec(codecs, 'HelloWorld.exe') is None)
+    assert(symbolcodec.choose_codec(symbolcodec.parse_codecs('gzip'), 'HelloWorld.exe').name == 'gzip')
+    try:
+        symbolcodec.parse_codecs('pdb=rar')
+        assert(False)
+    except ValueError:
+        pass
+
+    # the store keeps the pdb gzip compressed
+    store_path = tempfile.mkdtemp(dir=symstore_dir)
+    params = symbolpublisher.Params([], store_path, False, 1, False, False, True, codecs=codecs)
+    symbolpublisher.publish_path(os.path.join(path_fs, 'testdata', 'HelloWorld.pdb'), params)
+    symbol = symboldb.find_symbol_exact('59442B4112F54557AE800C736F2B5DAD1', 'HelloWorld.pdb')
+    assert(symbol.store_path.endswith('HelloWorld.pdb.gz'))
+    assert(symbolcodec.CODECS['gzip'].read_all(symbol.store_path) == expected)
+
+    # both engines pass the file through to clients accepting gzip and decompress it for the others
+    path = '/HelloWorld.pdb/59442B4112F54557AE800C736F2B5DAD1/HelloWorld.pdb'
+    server = symbolserver.ThreadingSimpleServer(("localhost", 0), symbolserver.Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    loop = asyncio.new_event_loop()
+    async_server = asyncserver.AsyncSymbolServer("localhost", 0, 4)
+    loop.run_until_complete(async_server.start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    try:
+        for port in [server.server_address[1], async_server.port]:
+            connection = http.client.HTTPConnection("localhost", port)
+            connection.request("GET", path, headers={'Accept-Encoding': 'gzip'})
+            response = connection.getresponse()
+            assert(response.getheader('Content-Encoding') == 'gzip')
+            assert(response.read() == fileio.read_all(symbol.store_path, "rb"))
+
+            # keep-alive, the chunked body ends where it should
+            for accept_encoding in [None, 'gzip;q=0', '*']:
+                connection.request("GET", path, headers={'Accept-Encoding': accept_encoding} if accept_encoding else {})
+                response = connection.getresponse()
+                assert(response.status == 200 and response.getheader('Content-Encoding') is None)
+                assert(response.getheader('Transfer-Encoding') == 'chunked')
+                assert(response.read() == expected)
+
+            connection.request("HEAD", path)
+            response = connection.getresponse()
+            assert(response.status == 200)
+            response.read()
+
+            # ranges are of the decompressed file, whatever the client accepts
+            size = len(expected)
+            for range_header, status, content_range, body in [
+                    ('bytes=100-199', 206, 'bytes 100-199/*', expected[100:200]),
+                    (f'bytes={size - 10}-{size + 100}', 206, f'bytes {size - 10}-{size - 1}/{size}', expected[-10:]),
+                    (f'bytes={size + 10}-{size + 20}', 416, f'bytes */{size}', b''),
+                    ('bytes=0-9,20-29', 200, None, expected)]:
+                connection.request("GET", path, headers={'Accept-Encoding': 'gzip, deflate', 'Range': range_header})
+                response = connection.getresponse()
+                assert(response.status == status and response.getheader('Content-Encoding') is None)
+                assert(response.getheader('Content-Range') == content_range)
+                assert(response.read() == body)
+            connection.close()
+
+            # the file is hashed over ranges, by a session asking for gzip by default
+            with filereader.RemoteReader(f'http://localhost:{port}{path}') as reader:
+                assert(symbolhash.hash(reader) == '59442B4112F54557AE800C736F2B5DAD1')
+            print(f'port {port}: encoded file served')
+    finally:
+        server.shutdown()
+        server.server_close()
+        loop.call_soon_threadsafe(loop.stop)
+
+
+def symbolserver_test(path_fs: str):
+    server = symbolserver.ThreadingSimpleServer(("localhost", 0), symbolserver.Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server_addr = f'http://localhost:{server.server_address[1]}'
+
+    try:
+        files_to_test = [
+            ('HelloWorld.exe', '62A0EB958000'),  # stored
+            ('HelloDll.dll', '62A0EC129000'),    # link mode
+        ]
+        for file, hash in files_to_test:
+            with urllib.request.urlopen(f'{server_addr}/{file}/{hash}/{file}') as response:
+                served = response.read()
+            assert(served == fileio.read_all(os.path.join(path_fs, 'testdata', file), "rb"))
+            print(f'{server_addr}/{file}/{hash}/{file}: {len(served)} bytes')
+
+        missing = [
+            '/HelloWorld.exe/DEADBEEF/HelloWorld.exe',
+            '/HelloWorld.exe/62A0EB958000/HelloWorld.ex_',
+            '/HelloWorld.exe/62A0EB958000/file.ptr',
+        ]
+        for path in missing:
+            try:
+                urllib.request.urlopen(server_addr + path)
+                assert(False)
+            except urllib.error.HTTPError as e:
+                assert(e.code == 404)
+
+        with urllib.request.urlopen(f'{server_addr}/HelloDll.dll/62A0EC129000/file.ptr') as response:
+            assert(response.read() == b'PATH:' + os.path.join(path_fs, 'testdata', 'HelloDll.dll').encode())
+
+        range_test(server_addr, '/HelloWorld.exe/62A0EB958000/HelloWorld.exe',
+                   fileio.read_all(os.path.join(path_fs, 'testdata', 'HelloWorld.exe'), "rb"))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def asyncserver_test(path_fs: str):
+    loop = asyncio.new_event_loop()
+    server = asyncserver.AsyncSymbolServer("localhost", 0, 4)
+    loop.run_until_complete(server.start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    try:
+        expected = fileio.read_all(os.path.join(path_fs, 'testdata', 'HelloWorld.exe'), "rb")
+        path = '/HelloWorld.exe/62A0EB958000/HelloWorld.exe'
+
+        # keep-alive, both requests go over the same connection
+        connection = http.client.HTTPConnection("localhost", server.port)
+        for _ in range(2):
+            connection.request("GET", path)
+            response = connection.getresponse()
+            assert(response.status == 200)
+            assert(response.read() == expected)
+        connection.request("GET", '/HelloWorld.exe/DEADBEEF/HelloWorld.exe')
+        response = connection.getresponse()
+        assert(response.status == 404)
+        response.read()
+        connection.close()
+
+        range_test(f'http://localhost:{server.port}', path, expected)
+
+        # pipelining, responses arrive in request order
+        with socket.create_connection(("localhost", server.port)) as s:
+            request = f'HEAD {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'
+            missing = 'HEAD /HelloWorld.exe/DEADBEEF/HelloWorld.exe HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n'
+            s.sendall((request + missing).encode())
+            received = b''
+            while True:
+                data = s.recv(4096)
+                if not data:
+                    break
+                received += data
+            statuses = [line.split(b' ')[1] for line in received.split(b'\r\n') if line.startswith(b'HTTP/1.1')]
+            assert(statuses == [b'200', b'404'])
+
+        # a malformed Content-Length is rejected and the connection closed
+        for length in ['abc', '-1']:
+            with socket.create_connection(("localhost", server.port)) as s:
+                s.sendall(f'GET {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {length}\r\n\r\n'.encode())
+                received = b''
+                while True:
+                    data = s.recv(4096)
+                    if not data:
+                        break
+                    received += data
+                assert(received.startswith(b'HTTP/1.1 400 '))
+        print(f'asyncio server at port {server.port}: OK')
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+
+    # clients that stall their downloads don't hold the lookup slots
+    with tempfile.TemporaryDirectory() as big_dir:
+        big_path = os.path.join(big_dir, 'big.pdb')
+        with open(big_path, 'wb') as f:
+            f.truncate(64 * 1024 * 1024)
+        resolve = lambda target: symbolserver.Resolution(200, file_path=big_path) if target == '/big' else symbolserver.NOT_FOUND
+        loop = asyncio.new_event_loop()
+        server = asyncserver.AsyncSymbolServer("localhost", 0, 2, resolve=resolve)
+        loop.run_until_complete(server.start())
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        stalled = []
+        try:
+            for _ in range(server.max_disk_reads):
+                s = socket.create_connection(("localhost", server.port))
+                s.sendall(b'GET /big HTTP/1.1\r\nHost: localhost\r\n\r\n')
+                stalled.append(s)
+            sleep(0.5)
+            connection = http.client.HTTPConnection("localhost", server.port, timeout=5)
+            connection.request("GET", '/missing')
+            assert(connection.getresponse().status == 404)
+            connection.close()
+        finally:
+            for s in stalled:
+                s.close()
+            # the transfers end with the reset connections
+            sleep(0.5)
+            loop.call_soon_threadsafe(loop.stop)
+
+
 if __name__ == "__main__":
     with tempfile.TemporaryDirectory() as symstore_dir:
         test_data_dir = prepare_and_get_test_data_dir()
 
         try:
             server_addr = start_server(test_data_dir)
-            test()
+            migration_test(os.path.join(symstore_dir, "migrated.db"))
+            profile_test(os.path.join(symstore_dir, "production.db"))
+            test(os.path.join(symstore_dir, "symbols.db"))
+            crawl_state_test()
+            bulk_test()
+            index_test(os.path.join(symstore_dir, "symbols.idx"))
+            lookup_cache_test()
             hash_test(server_addr, test_data_dir)
+            truncated_hash_test(test_data_dir)
+            pdb_root_test()
+            codeview_test(test_data_dir)
 
             link_mode = False
             params = symbolpublisher.Params([], symstore_dir, False, 1, link_mode, False, False)
@@ -109,7 +1036,22 @@ if __name__ == "__main__":
             symbolpublisher.publish_path(
                 os.path.join(test_data_dir, "testdata", "HelloDll.dll"), params
             )
+            atomic_write_test(test_data_dir, symstore_dir)
+            symstore = import_symstore()
+            if symstore is not None:
+                symstore_payloads_test(symstore, test_data_dir, symstore_dir)
+                symstore_transactions_test(symstore, test_data_dir, symstore_dir)
+                symstore_compress_test(symstore, test_data_dir, symstore_dir)
+            else:
+                print("symstore is not installed, skipping the symstore tests")
+            remote_publish_test(server_addr, test_data_dir, symstore_dir)
+            zip_publish_test(server_addr, test_data_dir, symstore_dir)
+            artifactory_crawl_test(test_data_dir, symstore_dir)
+            artifactory_aql_test(test_data_dir, symstore_dir)
+            codec_test(test_data_dir, symstore_dir)
             print(symboldb.dump())
+            symbolserver_test(test_data_dir)
+            asyncserver_test(test_data_dir)
 
         except Exception as e:
             raise e
@@ -1,5 +1,10 @@
+from datetime import datetime, timezone
+from fnmatch import fnmatchcase
+import hashlib
 import http.server
+import json
 import os
+import re
 import socketserver
 import threading
 
@@ -32,9 +37,10 @@ class RangeHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
 
         # Parse range header
         # Range headers look like 'bytes=500-1000'
+        # multiple ranges are not supported, only the first one is served
         start, end = 0, size-1
         if 'Range' in self.headers:
-            start, end = self.headers.get('Range').strip().strip('bytes=').split('-')
+            start, end = self.headers.get('Range').strip().strip('bytes=').split(',')[0].split('-')
         if start == "":
             ## If no start, then the request is for last N bytes
             ## e.g. bytes=-500
@@ -93,11 +99,13 @@ class RangeHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         start, end = self.range
         infile.seek(start)
         bufsize=64*1024 ## 64KB
-        while True:
-            buf = infile.read(bufsize)
+        remaining = end - start + 1
+        while remaining > 0:
+            buf = infile.read(min(bufsize, remaining))
             if not buf:
                 break
             outfile.write(buf)
+            remaining -= len(buf)
 
 class TestServer:
     def __init__(self, host_path: str):
@@ -112,6 +120,113 @@ class TestServer:
         threading.Thread(target=self.http.serve_forever, daemon=True).start()
 
 
+class ArtifactoryHandler(RangeHTTPRequestHandler):
+    """Stand-in for the parts of the Artifactory REST API used by the publisher,
+    the repositories are the directories in host_path/artifactory"""
+
+    storage_prefix = '/artifactory/api/storage/'
+    aql_path = '/artifactory/api/search/aql'
+
+    def do_GET(self):
+        self.server.requests.append(self.path.partition('?')[0])
+        if self.path.startswith(self.storage_prefix):
+            return self.send_storage_list()
+        return super().do_GET()
+
+    def do_POST(self):
+        self.server.requests.append(self.path)
+        if self.path != self.aql_path:
+            return self.send_error(404)
+        query = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        criteria = json.loads(re.search(r'items\.find\((.*?)\)\.include', query).group(1))
+        offset = int(re.search(r'\.offset\((\d+)\)', query).group(1))
+        limit = int(re.search(r'\.limit\((\d+)\)', query).group(1))
+
+        items = []
+        repositories = os.path.join(self.directory, 'artifactory')
+        for root, _, names in os.walk(repositories):
+            repo, _, path = os.path.relpath(root, repositories).replace(os.sep, '/').partition('/')
+            if repo == '.':
+                continue
+            for name in names:
+                file_path = os.path.join(root, name)
+                with open(file_path, 'rb') as f:
+                    sha1 = hashlib.sha1(f.read()).hexdigest()
+                item = {'repo': repo, 'path': path or '.', 'name': name, 'type': 'file',
+                        'size': os.path.getsize(file_path), 'actual_sha1': sha1}
+                if self.aql_matches(item, criteria):
+                    items.append(item)
+        items.sort(key=lambda item: (item['path'], item['name']))
+        page = items[offset:offset + limit]
+        self.send_json({'results': page, 'range': {'start_pos': offset, 'end_pos': offset + len(page), 'total': len(items), 'limit': limit}})
+
+    @classmethod
+    def aql_matches(cls, item, criteria):
+        """Evaluates the subset of AQL criteria the publisher sends: $and, $or, equality and $match"""
+        for key, value in criteria.items():
+            if key == '$and':
+                matches = all(cls.aql_matches(item, c) for c in value)
+            elif key == '$or':
+                matches = any(cls.aql_matches(item, c) for c in value)
+            elif isinstance(value, dict):
+                matches = fnmatchcase(item[key], value['$match'])
+            else:
+                matches = item[key] == value
+            if not matches:
+                return False
+        return True
+
+    def send_json(self, value):
+        body = json.dumps(value).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_storage_list(self):
+        repo_path = self.path.partition('?')[0][len(self.storage_prefix):].strip('/')
+        folder = os.path.join(self.directory, 'artifactory', *repo_path.split('/'))
+        if not os.path.isdir(folder):
+            return self.send_error(404)
+
+        files = []
+        for entry in sorted(os.scandir(folder), key=lambda entry: entry.name):
+            stat = entry.stat()
+            item = {
+                'uri': '/' + entry.name,
+                'folder': entry.is_dir(),
+                'size': -1 if entry.is_dir() else stat.st_size,
+                'lastModified': datetime.fromtimestamp(stat.st_mtime_ns / 1e9, timezone.utc).isoformat(),
+            }
+            if not entry.is_dir():
+                with open(entry.path, 'rb') as f:
+                    item['sha1'] = hashlib.sha1(f.read()).hexdigest()
+            files.append(item)
+
+        self.send_json({'uri': self.path, 'files': files})
+
+
+class ArtifactoryStandIn:
+    def __init__(self, host_path: str):
+        class Handler(ArtifactoryHandler):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, directory=host_path, **kwargs)
+        self.http = socketserver.ThreadingTCPServer(("localhost", 0), Handler)
+        self.http.daemon_threads = True
+        self.http.requests = [] # paths of the GET requests
+        self.url = f'http://localhost:{self.http.server_address[1]}/artifactory'
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+
+    @property
+    def requests(self):
+        return self.http.requests
+
+    def close(self):
+        self.http.shutdown()
+        self.http.server_close()
+
+
 def start_server(host_path: str):
     server = TestServer(host_path)
     return f'http://{server.http.server_address[0]}:{server.http.server_address[1]}'